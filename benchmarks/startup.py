@@ -0,0 +1,101 @@
+#!/usr/bin/python3 -u
+"""
+Measure the fixed startup cost of the tfbuild command line.
+
+Every run spawns a fresh interpreter executing the tfbuild entry point,
+and reports the wall-clock time per command along with the heavy
+modules loaded by it.
+
+Usage:
+    python benchmarks/startup.py [--runs=20] [--json=<path>] [command ...]
+"""
+
+import getopt
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+HEAVY_MODULES = ['confuse', 'git', 'hcl', 'jsonpickle', 'pkg_resources', 'requests']
+
+RUNNER = """
+import json, sys
+sys.argv = ['tfbuild'] + sys.argv[1:]
+from tfbuild.cli import main
+try:
+    main()
+except SystemExit:
+    pass
+sys.stderr.write('\\n' + json.dumps(sorted(m for m in {heavy} if m in sys.modules)) + '\\n')
+""".format(heavy=HEAVY_MODULES)
+
+def run_once(command):
+    start = time.perf_counter()
+    output = subprocess.run([sys.executable, '-c', RUNNER] + command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    elapsed = time.perf_counter() - start
+    lines = output.stderr.decode().strip().splitlines()
+    try:
+        modules = json.loads(lines[-1])
+    except (IndexError, ValueError):
+        modules = None
+    return elapsed, modules
+
+def measure(command, runs):
+    timings = []
+    modules = None
+    for _ in range(runs):
+        elapsed, modules = run_once(command)
+        timings.append(elapsed * 1000)
+    return {
+        "command": " ".join(command),
+        "runs": runs,
+        "min_ms": round(min(timings), 2),
+        "median_ms": round(statistics.median(timings), 2),
+        "mean_ms": round(statistics.mean(timings), 2),
+        "heavy_modules": modules,
+    }
+
+def baseline(runs):
+    """
+    Bare interpreter startup, to separate Python from tfbuild overhead.
+    """
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, '-c', 'pass'])
+        timings.append((time.perf_counter() - start) * 1000)
+    return round(statistics.median(timings), 2)
+
+def main():
+    opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["runs=", "json="])
+    options = dict(opts)
+    runs = int(options.get("--runs", 20))
+    commands = args or ["help", "version", "config"]
+
+    results = {
+        "python": sys.version.split()[0],
+        "interpreter_median_ms": baseline(runs),
+        "commands": [measure([command], runs) for command in commands],
+    }
+
+    print("{:<10} {:>9} {:>11} {:>9}  {}".format("Command", "Min (ms)", "Median (ms)", "Mean (ms)", "Heavy modules loaded"))
+    print("{:<10} {:>9} {:>11} {:>9}".format("python", "", results["interpreter_median_ms"], ""))
+    for result in results["commands"]:
+        print("{:<10} {:>9} {:>11} {:>9}  {}".format(
+            result["command"],
+            result["min_ms"],
+            result["median_ms"],
+            result["mean_ms"],
+            "n/a (command failed)" if result["heavy_modules"] is None else ", ".join(result["heavy_modules"]) or "-"
+        ))
+
+    if "--json" in options:
+        with open(options["--json"], 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [sys.path[0], os.environ.get("PYTHONPATH")]))
+    main()
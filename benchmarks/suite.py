@@ -0,0 +1,390 @@
+#!/usr/bin/python3 -u
+"""
+Measure the tfbuild overhead as the repository grows.
+
+For every resource count, a synthetic git repository following the
+tfbuild naming conventions is generated (<prefix>-aws-<project>, an
+<account>-<environment> branch per environment, common/environments
+hcl and tfvars files for every environment and site, and resource
+directories with their environments/env_*.tfvars files). A stub
+terraform executable is put first on PATH, and a local mock of the
+Terraform Cloud workspaces API is served behind Workspace, through
+TFBUILD_TFC_URL.
+
+Measured, in milliseconds:
+    startup_cold_ms      tfbuild test in a new process, no context cache
+    startup_cached_ms    tfbuild test in a new process, context cache hit
+    core_resolution_ms   Core context resolution in-process, per context
+    resolver_ms          Resolver bulk resolution, per context
+    init_ms              Action.init, forced, stub terraform included
+    reinit_ms            Action.reinit, stub terraform included
+    init_skip_ms         Action.init with an up to date initialization
+    terraform_stub_ms    a single stub terraform run, for reference
+    tfc_list_ms          Workspace.get_workspaces, N workspaces
+    tfc_lookup_ms        Workspace.get_workspace, per call
+    tfc_create_ms        Workspace.create_workspace, per call
+    tfc_provision_ms     WorkspaceProvisioner.provision of N workspaces
+
+Results are written as JSON, and compared to a previous result file
+with --compare.
+
+Usage:
+    python benchmarks/suite.py [--resources=10,50,200] [--environments=2]
+        [--sites=2] [--runs=5] [--json=<path>] [--compare=<path>]
+"""
+
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+import getopt
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ACCOUNT = "123456"
+REPO_NAME = "bench-aws-k8s"
+
+TERRAFORM_STUB = """#!/bin/sh
+case "$1" in
+  version) echo '{"terraform_version":"1.5.7"}';;
+  init) mkdir -p "${TF_DATA_DIR:-.terraform}"; touch .terraform.lock.hcl;;
+esac
+exit 0
+"""
+
+TERRAFORM_STUB_CMD = """@echo off
+if "%1"=="version" echo {"terraform_version":"1.5.7"}
+if "%1"=="init" if not exist .terraform mkdir .terraform
+exit /b 0
+"""
+
+RUNNER = """
+import sys
+sys.argv = ['tfbuild'] + sys.argv[1:]
+from tfbuild.cli import main
+main()
+"""
+
+def git(repo, *args):
+    subprocess.run(['git', '-c', 'user.name=bench', '-c', 'user.email=bench@example.com'] + list(args), cwd=repo, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def write(path, content):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as fp:
+        fp.write(content)
+
+def make_repo(root, resources, environments, sites):
+    """
+    Generate the synthetic repository, checked out on the branch of
+    the first environment. Returns its path and the resource names.
+    """
+    repo = os.path.join(root, REPO_NAME)
+    names = ["group{:02d}/resource{:04d}".format(index % 10, index) for index in range(resources)]
+    git(root, 'init', '-q', REPO_NAME)
+    git(repo, 'remote', 'add', 'origin', 'https://git.example.com/infra/' + REPO_NAME + '.git')
+    write(os.path.join(repo, 'modules', 'network', 'main.tf'), 'variable "name" {}\n')
+    for environment in environments:
+        env_dir = os.path.join(repo, 'common', 'environments')
+        write(os.path.join(env_dir, 'env_{}.hcl'.format(environment)), 'region = "us-east-1"\nbackend = "aws"\ntf_cli_args = "-lock-timeout=300s"\n')
+        write(os.path.join(env_dir, 'env_{}_common.tfvars'.format(environment)), 'owner = "bench"\n')
+        for site in sites:
+            write(os.path.join(env_dir, 'env_{}_{}.hcl'.format(environment, site)), 'region = "us-west-2"\nbackend = "aws"\ntarget_environment_type = "site"\n')
+            write(os.path.join(env_dir, 'env_{}_{}_common.tfvars'.format(environment, site)), 'owner = "bench"\n')
+    for name in names:
+        write(os.path.join(repo, name, 'main.tf'), 'module "network" {\n  source = "../../modules/network"\n  name   = "' + name + '"\n}\n')
+        for environment in environments:
+            write(os.path.join(repo, name, 'environments', 'env_{}.tfvars'.format(environment)), 'size = 1\n')
+            for site in sites:
+                write(os.path.join(repo, name, 'environments', 'env_{}_{}.tfvars'.format(environment, site)), 'size = 1\n')
+    git(repo, 'add', '-A')
+    git(repo, 'commit', '-q', '-m', 'Synthetic repository')
+    for environment in environments:
+        git(repo, 'branch', '{}-{}'.format(ACCOUNT, environment))
+    git(repo, 'checkout', '-q', '{}-{}'.format(ACCOUNT, environments[0]))
+    return repo, names
+
+def make_terraform_stub(root):
+    bin_dir = os.path.join(root, 'bin')
+    os.makedirs(bin_dir)
+    if sys.platform.startswith("win"):
+        write(os.path.join(bin_dir, 'terraform.cmd'), TERRAFORM_STUB_CMD)
+    else:
+        write(os.path.join(bin_dir, 'terraform'), TERRAFORM_STUB)
+        os.chmod(os.path.join(bin_dir, 'terraform'), 0o755)
+    return bin_dir
+
+class TFCHandler(BaseHTTPRequestHandler):
+    """
+    Mock of the Terraform Cloud workspaces API: lookup by name,
+    paginated listing, and creation.
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+    wbufsize = 65536
+    workspaces = set()
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, code, body):
+        content = json.dumps(body).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/vnd.api+json")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        parts = url.path.rstrip('/').split('/')
+        if len(parts) == 7:
+            if parts[6] in self.workspaces:
+                return self.send(200, {"data": {"attributes": {"name": parts[6]}}})
+            return self.send(404, {"errors": [{"title": "not found"}]})
+        query = parse_qs(url.query)
+        number = int(query.get("page[number]", ["1"])[0])
+        size = int(query.get("page[size]", ["20"])[0])
+        names = sorted(self.workspaces)
+        next_url = None
+        if number * size < len(names):
+            next_url = "http://{}{}?page[number]={}&page[size]={}".format(self.headers["Host"], url.path, number + 1, size)
+        self.send(200, {"data": [{"attributes": {"name": name}} for name in names[(number - 1) * size:number * size]], "links": {"next": next_url}})
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        name = body["data"]["attributes"]["name"]
+        with self.lock:
+            if name in self.workspaces:
+                return self.send(422, {"errors": [{"title": "has already been taken"}]})
+            self.workspaces.add(name)
+        self.send(201, body)
+
+@contextmanager
+def mock_tfc(workspaces):
+    TFCHandler.workspaces = set(workspaces)
+    server = ThreadingHTTPServer(("127.0.0.1", 0), TFCHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{}".format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+@contextmanager
+def quiet():
+    """
+    Silence the output of tfbuild and of the commands it runs.
+    """
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(1), os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(saved[0], 1)
+        os.dup2(saved[1], 2)
+        for fd in saved + (devnull,):
+            os.close(fd)
+
+@contextmanager
+def working_directory(path):
+    saved = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(saved)
+
+def timed(function, runs):
+    timings = []
+    for _ in range(runs):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return timings
+
+def median(timings):
+    return round(statistics.median(timings), 3)
+
+def measure_startup(repo, names, runs):
+    def run(environment):
+        subprocess.run([sys.executable, '-c', RUNNER, 'test'], cwd=os.path.join(repo, names[0]), env=environment, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    cold = dict(os.environ, TFBUILD_CONTEXT_CACHE='false')
+    run(os.environ)
+    return {
+        "startup_cold_ms": median(timed(lambda: run(cold), runs)),
+        "startup_cached_ms": median(timed(lambda: run(os.environ), runs)),
+    }
+
+def measure_resolution(repo, names, sites, runs):
+    from tfbuild.core import Core
+    from tfbuild.resolver import Resolver
+    os.environ['TFBUILD_CONTEXT_CACHE'] = 'false'
+    targets = [(name, site) for name in names for site in [None] + sites]
+    sample = targets[:50]
+
+    def resolve_core():
+        for name, site in sample:
+            with working_directory(os.path.join(repo, name)):
+                Core('test', site)
+
+    def resolve_bulk():
+        resolver = Resolver(repo, '{}-{}'.format(ACCOUNT, os.environ['BENCH_ENVIRONMENT']))
+        for name, site in targets:
+            resolver.resolve(name, site)
+
+    try:
+        with quiet():
+            core = timed(resolve_core, runs)
+            bulk = timed(resolve_bulk, runs)
+    finally:
+        del os.environ['TFBUILD_CONTEXT_CACHE']
+    return {
+        "core_resolution_ms": round(statistics.median(core) / len(sample), 3),
+        "resolver_ms": round(statistics.median(bulk) / len(targets), 4),
+    }
+
+def measure_init(repo, names, runs):
+    from tfbuild.actions import Action
+    sample = names[:10]
+
+    def run(action, method):
+        for name in sample:
+            with working_directory(os.path.join(repo, name)):
+                getattr(Action(action, None), method)()
+
+    with quiet():
+        init = timed(lambda: run('init', 'init'), runs)
+        reinit = timed(lambda: run('reinit', 'reinit'), runs)
+        skip = timed(lambda: run('plan', 'init'), runs)
+        stub = timed(lambda: subprocess.run(['terraform', 'version'], stdout=subprocess.DEVNULL, shell=sys.platform.startswith("win")), runs * 5)
+    return {
+        "init_ms": round(statistics.median(init) / len(sample), 3),
+        "reinit_ms": round(statistics.median(reinit) / len(sample), 3),
+        "init_skip_ms": round(statistics.median(skip) / len(sample), 3),
+        "terraform_stub_ms": median(stub),
+    }
+
+def measure_tfc(resources, runs):
+    from tfbuild.workspace import Workspace, WorkspaceProvisioner
+    existing = ["bench-ws-{:05d}".format(index) for index in range(resources)]
+    with mock_tfc(existing) as url:
+        os.environ['TFBUILD_TFC_URL'] = url
+        with quiet():
+            workspace = Workspace(None, 'linux', '1.5.7', 'bench')
+            listing = timed(workspace.get_workspaces, runs)
+            lookups = timed(lambda: [workspace.get_workspace(name) for name in existing[:20]], runs)
+            counter = iter(range(1000000))
+            creates = timed(lambda: workspace.create_workspace("bench-new-{:06d}".format(next(counter)), '1.5.7'), runs * 4)
+            batches = iter(range(1000000))
+            provision = timed(lambda: WorkspaceProvisioner(workspace, 8).provision(["bench-batch{}-{:05d}".format(next(batches), index) for index in range(resources)], '1.5.7'), runs)
+    return {
+        "tfc_list_ms": median(listing),
+        "tfc_lookup_ms": round(statistics.median(lookups) / 20, 3),
+        "tfc_create_ms": median(creates),
+        "tfc_provision_ms": median(provision),
+    }
+
+def run_size(resources, environments, sites, runs):
+    root = tempfile.mkdtemp(prefix="tfbuild-bench-")
+    saved_env = dict(os.environ)
+    try:
+        repo, names = make_repo(root, resources, environments, sites)
+        os.environ.update({
+            'PATH': make_terraform_stub(root) + os.pathsep + os.environ.get('PATH', ''),
+            'HOME': os.path.join(root, 'home'),
+            'USERPROFILE': os.path.join(root, 'home'),
+            'APPDATA': os.path.join(root, 'home'),
+            'TFBUILD_CACHE_DIR': os.path.join(root, 'cache'),
+            'TFBUILD_DAEMON': 'false',
+            'TF_TOKEN': 'bench',
+            'BENCH_ENVIRONMENT': environments[0],
+        })
+        os.makedirs(os.environ['HOME'])
+        for name in list(os.environ):
+            if name.startswith(('TFBUILD_REPORT', 'TFBUILD_PROFILE', 'TF_DATA_DIR', 'TF_CLI_ARGS', 'GIT_DIR', 'GIT_WORK_TREE')):
+                del os.environ[name]
+        metrics = {}
+        metrics.update(measure_startup(repo, names, runs))
+        metrics.update(measure_resolution(repo, names, sites, runs))
+        metrics.update(measure_init(repo, names, runs))
+        metrics.update(measure_tfc(resources, runs))
+        return {"resources": resources, "environments": len(environments), "sites": len(sites), "metrics": metrics}
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        shutil.rmtree(root, ignore_errors=True)
+
+def get_version():
+    try:
+        output = subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=os.path.dirname(os.path.abspath(__file__)), stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+        return output.stdout.decode().strip() or None
+    except OSError:
+        return None
+
+def display(results):
+    metrics = list(results["results"][0]["metrics"]) if results["results"] else []
+    sizes = [result["resources"] for result in results["results"]]
+    print("{:<20} ".format("Metric (ms)") + " ".join("{:>12}".format("N=" + str(size)) for size in sizes))
+    for metric in metrics:
+        print("{:<20} ".format(metric[:-3]) + " ".join("{:>12}".format(result["metrics"][metric]) for result in results["results"]))
+
+def compare(results, previous):
+    """
+    Display the ratio of every metric to a previous result file,
+    matched by resource count.
+    """
+    previous_sizes = dict((result["resources"], result["metrics"]) for result in previous["results"])
+    print("\nCompared to {} ({})".format(previous.get("version"), previous.get("created")))
+    print("{:<20} {:>8} {:>12} {:>12} {:>8}".format("Metric (ms)", "N", "Before", "After", "Ratio"))
+    for result in results["results"]:
+        before = previous_sizes.get(result["resources"])
+        if before is None:
+            continue
+        for metric, value in result["metrics"].items():
+            if before.get(metric):
+                print("{:<20} {:>8} {:>12} {:>12} {:>7.2f}x".format(metric[:-3], result["resources"], before[metric], value, value / before[metric]))
+
+def main():
+    opts, args = getopt.gnu_getopt(sys.argv[1:], "", ["resources=", "environments=", "sites=", "runs=", "json=", "compare="])
+    options = dict(opts)
+    sizes = [int(size) for size in options.get("--resources", "10,50,200").split(",")]
+    environments = ["env{}".format(index) for index in range(max(1, int(options.get("--environments", 2))))]
+    sites = ["site{}".format(index) for index in range(int(options.get("--sites", 2)))]
+    runs = int(options.get("--runs", 5))
+
+    results = {
+        "version": get_version(),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "parameters": {"resources": sizes, "environments": len(environments), "sites": len(sites), "runs": runs},
+        "results": [run_size(size, environments, sites, runs) for size in sizes],
+    }
+    display(results)
+
+    if "--compare" in options:
+        with open(options["--compare"], 'r') as fp:
+            compare(results, json.load(fp))
+    if "--json" in options:
+        with open(options["--json"], 'w') as fp:
+            json.dump(results, fp, indent=4)
+
+if __name__ == "__main__":
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+    os.environ["PYTHONPATH"] = os.pathsep.join(filter(None, [sys.path[0], os.environ.get("PYTHONPATH")]))
+    main()
@@ -1,13 +1,11 @@
 #!/usr/bin/python3 -u
 
 from .core import Core
-from .workspace import Workspace
+from .report import RunReport
+from contextlib import contextmanager
 from py_console import console
-from importlib.metadata import version, PackageNotFoundError
 import json
-import jsonpickle
 import os
-import pkg_resources
 import sys
 import shutil, stat
 import subprocess
@@ -17,39 +15,53 @@ class Action(Core):
     Inherits the Base Class and its attributes.
     Adding in 2 child atts, action, and target_environment.
     """
-    def __init__(self, action, target_environment):
+    def __init__(self, action, target_environment, report=None):
         self.action = action
         self.target_environment = target_environment
+        self.returncode = 0
+        self.report = report or RunReport(action, target_environment)
         Core.__init__(self, action, target_environment)
 
     def __str__(self):
         return ' '.join((self.repo_name, self.location))
 
-    def command(self, command):
+    def command(self, command, env=None, fatal=True):
         """
         Re-usable function to execute a shell command, 
         with error handling, and ability to execute quietly, 
-        or display output.
+        or display output. Every command is recorded in the run report,
+        failing the run unless fatal is False.
         """
-        output = subprocess.Popen(command, env=self.my_env)
-        output.communicate()
-        
+        self.returncode = self.report.run(command, env=env or self.my_env, fatal=fatal)
+        return self.returncode
+
     def apply(self):
         self.init()
+        if self.apply_saved_plan(prompt=True):
+            return
         console.success("  Running Terraform Apply", showTime=False)
         apply = ['terraform', 'apply'] + self.var_file_args + sys.argv[2:]
         self.command(apply) 
 
     def applynoprompt(self):
         self.reinit()
+        if self.apply_saved_plan(prompt=False):
+            return
         console.success("  Running Terraform Apply", showTime=False)
         applynoprompt = ['terraform', 'apply', '-input=false', '-auto-approve'] + self.var_file_args + sys.argv[2:]
         self.command(applynoprompt) 
 
+    def applyall(self):
+        """
+        Apply, with no prompt, every resource of the current environment
+        in parallel, in waves following the remote state dependencies.
+        """
+        self.run_all('applynoprompt', ordered=True)
+
     def config(self):
         import getopt, yaml
         options_list = [item + '=' for item in list(self.options_dict.keys())]
-        config_file_name = self.user_config_path
+        config_file_name = self.load_configs()[1]
 
         try:
             opts, args = getopt.getopt(sys.argv[2:], "", options_list)
@@ -105,55 +117,303 @@ class Action(Core):
         Usage:
            {0} <command>
            {0} <command>-<site>
+           {0} <command>-<site|default>,<site>[,<site>...]
 
         Example:
            {0} plan
            {0} plan-dr
+           {0} plan-us-east-2,us-west-2,eu-west-1
+           {0} plan-default,dr
+           {0} plan-all --concurrency=8
+           {0} plan-all --affected=origin/main
+           {0} plan --summary=plan-summary.json
+           {0} ls --environment=prod --bucket=inf.tfstate.123456789012.prod
+           {0} matrix --branches=123456789012-dev,origin/123456789012-prod
+           {0} taint 'module.app.aws_instance.web[*]'
            {0} config --bucket_prefix=test_bucket --tf_cloud_org=test_org
 
         Commands:
-           apply          Apply Terraform Configuration
+           affected       List the resources affected by the changes since a git base ref
+           apply          Apply Terraform Configuration, or the matching saved plan
+           applyall       Apply all repository resources in parallel, in remote state dependency order, with no prompt
            config         Configure {0} deployment global variables
            destroy        Destroy Terraform Configuration
+           graph          Display the remote state dependency graph and apply waves (--json)
+           drift          Check the resource for drift, exit code 2 when drifted (--full for a normal plan)
+           driftall       Check all repository resources and sites for drift in parallel, with a report
            destroyforce   Destroy Terraform Configuration with no prompt
            help           Display the help menu that shows available commands
            init           Initialize Terraform backend and clean local cache
-           plan           Create Terraform plan with clean local cache
+           ls             List the indexed resources, env files and state keys of every environment and site
+           matrix         Resolve all resources and sites of several branches from git, with no checkout, and report state key collisions
+           plan           Create Terraform plan, saved for a following apply
+           planall        Create Terraform plans for all repository resources in parallel
            plandestroy    Create a Plan for a Destroy scenario
+           provision      Create the Terraform Cloud workspaces of all repository resources
            reinit         Initialize Terraform backend and keep local cache
            replan         Create Terraform plan with existing local cache
-           taint          Taint specific module and resources
+           replace        Replace resources matching address patterns in a single apply
+           serve          Run the tfbuild daemon serving resolved contexts (--stop, --status)
+           taint          Taint resources matching address patterns, or selected interactively, one terraform run each (see replace)
            test           Test run showing all project variables
            tfimport       Import states for existing resources
            update         Update Terraform modules
+           validate       Validate Terraform Configuration with no backend
+           validateall    Validate all repository resources in parallel, sharing the initializations (--fail-fast, --warm)
            version        App version
+           warmcache      Fill the provider mirror with the providers of all repository resources, installed from the mirror only once mirrored
         """
         print(help.format(self.app_name))
 
+    def get_init_fingerprint(self):
+        """
+        Fingerprint of everything terraform init depends on: backend
+        configuration, module and provider sources and versions of the
+        resource and of its local modules, CLI configuration and
+        arguments, and the lock file.
+        """
+        import hashlib, re
+        from .plancache import get_module_dirs
+        from .providers import get_cli_config_path
+        source_re = re.compile(r'"?\b(source|version)"?\s*[=:]\s*"[^"]*"')
+        sources = []
+        for directory in get_module_dirs(self.location):
+            for file_name in sorted(os.listdir(directory)):
+                if file_name.endswith((".tf", ".tf.json")) and os.path.isfile(os.path.join(directory, file_name)):
+                    with open(os.path.join(directory, file_name), 'r', errors='replace') as fp:
+                        found = [match.group(0) for match in source_re.finditer(fp.read())]
+                    if found:
+                        sources.append([os.path.relpath(os.path.join(directory, file_name), self.location).replace('\\', '/')] + found)
+
+        def file_hash(path):
+            if not os.path.isfile(path):
+                return None
+            with open(path, 'rb') as fp:
+                return hashlib.sha256(fp.read()).hexdigest()
+
+        fingerprint = {
+            "backend_type": self.backend_type,
+            "backend_region": self.backend_region,
+            "bucket": self.bucket,
+            "bucket_key": self.bucket_key,
+            "account": self.account,
+            "environment": self.environment,
+            "tf_cloud_backend": self.tf_cloud_backend,
+            "tf_cloud_backend_org": self.tf_cloud_backend_org,
+            "secret": file_hash(self.secret_path) if self.backend_type == "azr" else None,
+            "sources": sources,
+            "cli_config": file_hash(get_cli_config_path(self.my_env)),
+            "cli_args": [self.my_env.get(name) for name in ('TF_CLI_ARGS', 'TF_CLI_ARGS_init', 'TF_PLUGIN_CACHE_DIR')],
+            "lock": file_hash(os.path.join(self.location, '.terraform.lock.hcl')),
+        }
+        return hashlib.sha256(json.dumps(fingerprint, sort_keys=True).encode()).hexdigest()
+
+    def is_initialized(self):
+        """
+        Check if the local cache was initialized with the current
+        init fingerprint. TFBUILD_FORCE_INIT=true disables the check.
+        """
+        if os.environ.get('TFBUILD_FORCE_INIT', '').lower() == 'true':
+            return False
+        fingerprint_file = os.path.join(self.data_dir, 'tfbuild.fingerprint')
+        if not os.path.isfile(fingerprint_file):
+            return False
+        with open(fingerprint_file, 'r') as fp:
+            return fp.read().strip() == self.get_init_fingerprint()
+
+    def save_init_fingerprint(self):
+        if self.returncode == 0 and os.path.isdir(self.data_dir):
+            with open(os.path.join(self.data_dir, 'tfbuild.fingerprint'), 'w') as fp:
+                fp.write(self.get_init_fingerprint())
+
     def init(self):
         """
         Initialize the terraform backend using the appropriate env,
-        and variables.
-        """
-        console.success("  Initializing Terraform", showTime=False)
-        cleanup_list = ['.terraform.lock.hcl', '.terraform']
-        for item in cleanup_list:
-            if os.path.exists(item):
-                console.success("  Removing " + item, showTime=False)
-                def del_rw(action, name, exc):
-                    os.chmod(name, stat.S_IWRITE)
-                    os.remove(name)
-                if os.path.isfile(item):
-                    os.remove(item)
-                else:
-                    shutil.rmtree(item, onerror=del_rw)
-        self.reinit()
+        and variables. The local cache is only cleaned when init is
+        called explicitly, or when the init fingerprint changed. The
+        dependency lock file is kept with a site data directory, as the
+        other sites of the resource may be using it.
+        """
+        if self.action != "init" and self.is_initialized():
+            console.success("  Terraform initialization is up to date, skipping init", showTime=False)
+            return
+        with self.init_lock():
+            console.success("  Initializing Terraform", showTime=False)
+            cleanup_list = [self.data_dir]
+            if os.path.realpath(self.data_dir) == os.path.realpath(os.path.join(self.location, '.terraform')):
+                cleanup_list.insert(0, '.terraform.lock.hcl')
+            for item in cleanup_list:
+                if os.path.exists(item):
+                    console.success("  Removing " + item, showTime=False)
+                    def del_rw(action, name, exc):
+                        os.chmod(name, stat.S_IWRITE)
+                        os.remove(name)
+                    if os.path.isfile(item):
+                        os.remove(item)
+                    else:
+                        shutil.rmtree(item, onerror=del_rw)
+            self.reinit()
+
+    @contextmanager
+    def init_lock(self):
+        """
+        Serialize the initializations sharing the resource lock file,
+        ie: the sites of a multi-site run, or sharing a Terraform plugin
+        cache configured by the user, not safe for concurrent writes.
+        The parallel commands of tfbuild set no plugin cache: their
+        initializations install the providers from the provider mirror,
+        each into its own data directory, so they run in parallel. The
+        provider mirror is locked shared, so it is not written meanwhile.
+        """
+        from .cache import file_lock
+        from .providers import ProviderMirror, get_plugin_cache_dir
+        import hashlib
+        if getattr(self, 'init_locked', False):
+            yield
+            return
+        plugin_cache_dir = get_plugin_cache_dir(self.my_env)
+        if plugin_cache_dir:
+            lock_name = "plugin-cache-" + hashlib.sha1(os.path.abspath(os.path.expanduser(plugin_cache_dir)).encode()).hexdigest()
+        else:
+            lock_name = hashlib.sha1(self.location.encode()).hexdigest()
+        with ProviderMirror().lock(shared=True), file_lock(os.path.join(self.get_cache_dir("locks"), lock_name + ".lock")):
+            self.init_locked = True
+            try:
+                yield
+            finally:
+                self.init_locked = False
 
     def plan(self):
+        summary_path, args = self.get_summary_option()
+        sys.argv = sys.argv[:2] + args
         self.init()
         console.success("  Creating a Terraform Plan", showTime=False)
         plan = ['terraform', 'plan'] + self.var_file_args + sys.argv[2:]
-        self.command(plan) 
+        store, key = self.get_plan_store()
+        if store is not None:
+            plan_file = store.get_plan_file(key)
+            self.command(plan + ['-out=' + store.get_temp_file(key)])
+        elif summary_path and not any(arg.startswith('-out=') for arg in sys.argv[2:]):
+            plan_file = os.path.join(self.data_dir, 'tfbuild-summary.tfplan')
+            self.command(plan + ['-out=' + plan_file])
+        else:
+            plan_file = ([arg.split('=', 1)[1] for arg in sys.argv[2:] if arg.startswith('-out=')] or [None])[-1]
+            self.command(plan)
+        succeeded = self.returncode == 0 or (self.returncode == 2 and '-detailed-exitcode' in sys.argv[2:])
+
+        if store is not None:
+            if succeeded and os.path.isfile(store.get_temp_file(key)):
+                store.save(key, store.get_temp_file(key), {"resource": self.resource, "site": self.site, "bucket_key": self.bucket_key})
+                console.success("  Saved plan " + plan_file, showTime=False)
+            else:
+                store.discard(key)
+                plan_file = None
+        if summary_path and plan_file and succeeded:
+            self.summarize_plan(plan_file, summary_path)
+        if plan_file == os.path.join(self.data_dir, 'tfbuild-summary.tfplan') and os.path.exists(plan_file):
+            os.remove(plan_file)
+
+    def get_summary_option(self):
+        """
+        Extract the --summary[=<path>] option from the arguments. With
+        no path, the summary is written to TFBUILD_PLAN_SUMMARY, or the
+        repository cache reports directory. Returns the summary path,
+        or None, and the remaining arguments.
+        """
+        summary_path = None
+        args = []
+        for arg in sys.argv[2:]:
+            if arg == '--summary' or arg.startswith('--summary='):
+                summary_path = arg.split('=', 1)[1] if '=' in arg else os.environ.get('TFBUILD_PLAN_SUMMARY')
+                if not summary_path:
+                    summary_path = os.path.join(
+                        self.get_cache_dir("reports"),
+                        "plan_{}_{}.json".format(self.get_file_prefix(), self.resource.replace('/', '_'))
+                        )
+            else:
+                args.append(arg)
+        return summary_path, args
+
+    def summarize_plan(self, plan_file, summary_path):
+        """
+        Summarize a saved plan, streamed from terraform show -json,
+        on the terminal and in a JSON file.
+        """
+        from .cache import write_json
+        from .plansummary import PlanSummary
+        try:
+            with self.span('summarize_plan'):
+                summary = PlanSummary().load(plan_file, self.my_env)
+        except subprocess.CalledProcessError:
+            console.error("  Unable to read the saved plan " + plan_file + " !\n", showTime=False)
+            return
+        summary.display()
+        os.makedirs(os.path.dirname(os.path.abspath(summary_path)), exist_ok=True)
+        write_json(summary_path, dict(summary.to_dict(), resource=self.resource, site=self.site, bucket_key=self.bucket_key))
+        console.success("\n  Plan summary written to " + summary_path, showTime=False)
+
+    def get_plan_store(self):
+        """
+        Return the plan store and the key of the plan matching the
+        current configuration, variables, backend and arguments, or
+        (None, None) when the plan cache does not apply: disabled, or
+        an explicit -out or plan file argument.
+        """
+        from .plancache import PlanStore, split_args, split_cli_args
+        if any(arg.startswith('-out') or not arg.startswith('-') for arg in sys.argv[2:]):
+            return None, None
+        store = PlanStore(self.get_cache_dir("plans"))
+        if not store.enabled:
+            return None, None
+        var_files = list(self.var_file_args_list)
+        for arg in split_cli_args(self.tf_cli_args)[0]:
+            if arg.startswith('-var-file='):
+                var_files.append(arg.split('=', 1)[1])
+        backend = [self.backend_type, self.backend_region, self.bucket, self.bucket_key, self.tf_cloud_backend_org]
+        key = store.get_key(self.location, var_files, self.my_env, backend, split_args(sys.argv[2:])[0])
+        return store, key
+
+    def apply_saved_plan(self, prompt=True):
+        """
+        Apply the saved plan matching the current state of the
+        resource, if any. Returns False when there is none, or when
+        its apply failed (a stale plan), so the caller falls back to a
+        regular apply. A saved plan is used once.
+        """
+        from .plancache import split_args, split_cli_args
+        import shlex
+        store, key = self.get_plan_store()
+        plan_file = store.lookup(key) if store else None
+        if plan_file is None:
+            if store:
+                console.success("  No matching saved plan, running a full apply", showTime=False)
+            return False
+
+        runtime_args = split_args(sys.argv[2:])[1]
+        env = dict(self.my_env, TF_CLI_ARGS=shlex.join(split_cli_args(self.tf_cli_args)[1]))
+        if prompt and '-auto-approve' not in runtime_args:
+            self.command(['terraform', 'show', plan_file], env)
+            goapply = input("Apply the saved plan? [y/n] : ")
+            if goapply != 'y':
+                console.success("  Apply cancelled", showTime=False)
+                return True
+        elif not prompt:
+            runtime_args = ['-input=false'] + [arg for arg in runtime_args if arg != '-auto-approve']
+
+        console.success("  Running Terraform Apply of the saved plan", showTime=False)
+        self.command(['terraform', 'apply'] + runtime_args + [plan_file], env, fatal=False)
+        store.discard(key)
+        if self.returncode != 0:
+            console.warn("  Unable to apply the saved plan, running a full apply", showTime=False)
+            return False
+        return True
+
+    def planall(self):
+        """
+        Create a plan for every resource of the current environment
+        in parallel.
+        """
+        self.run_all('plan')
 
     def plandestroy(self):
         self.init()
@@ -169,8 +429,20 @@ class Action(Core):
     def reinit(self):
         """
         Initialize the terraform backend using the appropriate env,
-        and variables.
+        and variables. Skipped when the init fingerprint is unchanged,
+        unless reinit is called explicitly.
         """
+        if self.action != "reinit" and self.is_initialized():
+            console.success("  Terraform backend is up to date, skipping init", showTime=False)
+            return
+        with self.init_lock():
+            self.init_backend()
+
+    def init_backend(self):
+        """
+        Run terraform init for the backend type of the resource.
+        """
+        self.link_modules()
         if self.backend_type == "aws":
             console.success("  Initializing AWS Backend", showTime=False)
             self.command(
@@ -193,19 +465,23 @@ class Action(Core):
                     ]
                 )
         elif self.backend_type == "tfc" or self.tf_cloud_backend == "true":
+            from .workspace import Workspace
             console.success("  Initializing Terraform Cloud Backend", showTime=False)
-            Workspace(self.bucket_key, self.platform, self.version_tf(), self.tf_cloud_backend_org)
-            if not os.path.exists('.terraform'):
+            Workspace(self.bucket_key, self.platform, self.version_tf, self.tf_cloud_backend_org)
+            # The token may just have been written to the CLI configuration,
+            # which the generated one is built from.
+            self.export_environment()
+            backend_config = os.path.join(self.data_dir, 'backend-'+self.environment+'.hcl')
+            if not os.path.exists(self.data_dir):
                 console.success("  Creating .terraform directory and backend configuration", showTime=False)
-                os.makedirs('.terraform')
-                backend_config = '.terraform/backend-'+self.environment+'.hcl'
+                os.makedirs(self.data_dir)
                 with open(backend_config, 'w') as config_object:
                     config_object.write('workspaces { name = \"'+self.bucket_key+'" }')
             self.command(
                 [
                     'terraform', 'init',
                     '-backend-config', 'organization='+self.account, 
-                    '-backend-config', '.terraform/backend-'+self.environment+'.hcl'
+                    '-backend-config', backend_config
                     ]
                 )
         else:
@@ -215,6 +491,45 @@ class Action(Core):
                     'terraform', 'init'
                     ]
                 )
+        if self.returncode != 0:
+            console.error("  Terraform initialization failed !\n", showTime=False)
+            sys.exit(self.returncode)
+        self.save_init_fingerprint()
+        self.save_modules()
+
+    def link_modules(self):
+        """
+        Install the remote modules of the resource from the shared
+        module cache, leaving the missing ones to terraform init.
+        """
+        from .modules import ModuleCache
+        cache = ModuleCache()
+        if not cache.enabled:
+            return
+        try:
+            linked, missing = cache.link(self.location, self.data_dir)
+        except OSError as e:
+            console.warn("  Module cache not used: " + str(e), showTime=False)
+            return
+        if linked:
+            console.success("  Linked " + str(len(linked)) + " cached modules, " + str(len(missing)) + " to download", showTime=False)
+
+    def save_modules(self, refresh=False):
+        """
+        Add the remote modules downloaded by Terraform to the shared
+        module cache.
+        """
+        from .modules import ModuleCache
+        cache = ModuleCache()
+        if not cache.enabled or self.returncode != 0:
+            return
+        try:
+            stored = cache.save(self.location, self.data_dir, refresh)
+        except OSError as e:
+            console.warn("  Module cache not updated: " + str(e), showTime=False)
+            return
+        if stored:
+            console.success("  Stored " + str(stored) + " modules in the module cache", showTime=False)
 
     def replan(self):
         self.reinit()
@@ -222,98 +537,568 @@ class Action(Core):
         plan = ['terraform', 'plan'] + self.var_file_args + sys.argv[2:]
         self.command(plan) 
 
-    def taintresources(self):
+    def get_concurrency(self):
+        """
+        Return the concurrency of repository wide commands, from the
+        --concurrency option or the config, and the remaining arguments.
+        """
+        concurrency = self.concurrency
+        args = []
+        for arg in sys.argv[2:]:
+            if arg.startswith('--concurrency='):
+                concurrency = arg.split('=', 1)[1]
+            else:
+                args.append(arg)
+
+        if not str(concurrency).isdigit() or int(concurrency) < 1:
+            console.error("  Invalid concurrency value: " + str(concurrency) + "\n  Please provide a positive number !\n", showTime=False)
+            sys.exit(2)
+        return int(concurrency), args
+
+    def provision(self):
+        """
+        Create the Terraform Cloud workspaces of every resource and
+        site of the repository ahead of their initialization.
+        """
+        from .workspace import Workspace, WorkspaceProvisioner
+        concurrency = self.get_concurrency()[0]
+        workspaces = {}
+        for context in self.get_resource_contexts():
+            if context.backend_type == "tfc" or context.tf_cloud_backend == "true":
+                workspaces.setdefault(context.tf_cloud_backend_org, set()).add(context.bucket_key)
+
+        if not workspaces:
+            console.success("  No Terraform Cloud backed resources found", showTime=False)
+            return
+
+        failures = 0
+        for org, names in sorted(workspaces.items(), key=lambda item: str(item[0])):
+            console.success("  Provisioning " + str(len(names)) + " workspaces in organization " + str(org), showTime=False)
+            workspace = Workspace(None, self.platform, self.version_tf, org)
+            results = WorkspaceProvisioner(workspace, concurrency).provision(names, self.version_tf)
+            for name in sorted(results):
+                if results[name].startswith('failed'):
+                    failures += 1
+                    console.error("  {:<60} {}".format(name, results[name]), showTime=False)
+                else:
+                    console.success("  {:<60} {}".format(name, results[name]), showTime=False)
+        if failures:
+            sys.exit(1)
+
+    def get_dependency_graph(self, resources):
+        """
+        Build the remote state dependency graph of the resources, for
+        the current target environment.
+        """
+        from .graph import DependencyGraph
+        contexts = []
+        for resource in resources:
+            try:
+                contexts.append(self.get_resource_context(resource, self.target_environment))
+            except SystemExit:
+                console.error("  Skipping resource " + resource + " (" + self.get_file_prefix() + ")\n", showTime=False)
+        return DependencyGraph(contexts)
+
+    def graph(self):
+        """
+        Display the remote state dependency graph of the resources of
+        the current environment, as apply waves, or as JSON with --json.
+        """
+        from .orchestrator import find_resources
+        resources = find_resources(self.repo_root, self.get_file_prefix())
+        if not resources:
+            console.error("  No resources found with an environments/env_" + self.get_file_prefix() + ".tfvars file !\n", showTime=False)
+            sys.exit(2)
+        graph = self.get_dependency_graph(resources)
+        if '--json' in sys.argv[2:]:
+            print(json.dumps(graph.to_dict(), indent=2))
+            cycles = graph.get_cycles()
+        else:
+            cycles = graph.display()
+        if cycles:
+            sys.exit(2)
+
+    def run_all(self, action, ordered=False):
         """
-        Create Taint resources list.
+        Run an action for every resource directory holding a matching
+        environment file, through a bounded pool of workers. Ordered
+        runs follow the remote state dependencies: resources run in
+        waves, after the resources they depend on, and the dependents
+        of a failed resource are skipped. Resources whose context can't
+        be resolved are not run, and reported as failed.
         """
+        from .orchestrator import Orchestrator, find_resources
+        concurrency, args = self.get_concurrency()
+        base_ref, args = self.get_base_ref(args, '--affected')
+        resources = find_resources(self.repo_root, self.get_file_prefix())
+        if not resources:
+            console.error("  No resources found with an environments/env_" + self.get_file_prefix() + ".tfvars file !\n", showTime=False)
+            sys.exit(2)
+        if base_ref:
+            resources = [resource for resource, reason in self.get_affected_resources(resources, base_ref)]
+            if not resources:
+                console.success("  No resources affected by the changes since " + base_ref, showTime=False)
+                return
+
+        orchestrator = Orchestrator(self.repo_root, self.get_cache_dir("logs", self.get_file_prefix()), concurrency)
+        argv = [sys.argv[0], action] + args
+        if ordered:
+            # Dependencies on resources not selected are ignored, so with
+            # --affected only the affected resources are resolved.
+            graph = self.get_dependency_graph(resources)
+            if graph.display_problems(dangling=not base_ref):
+                console.error("  Resolve the dependency cycles before running " + action + " !\n", showTime=False)
+                sys.exit(2)
+            waves = graph.get_waves([resource for resource in resources if resource in graph.dependencies])
+            console.success("  Running " + action + " on " + str(sum(len(wave) for wave in waves)) + " resources in " + str(len(waves)) + " waves, " + str(concurrency) + " at a time", showTime=False)
+            results = [dict(orchestrator.get_skipped_result(resource, self.target_environment), status="failed", details={"error": "context resolution failed"})
+                       for resource in resources if resource not in graph.dependencies]
+            failed = set()
+            for number, wave in enumerate(waves, 1):
+                blocked = [resource for resource in wave if graph.dependencies[resource] & failed]
+                runnable = [resource for resource in wave if resource not in blocked]
+                console.warn("\n  Wave " + str(number) + "/" + str(len(waves)) + ": " + ", ".join(wave), showTime=False)
+                wave_results = orchestrator.run(orchestrator.get_jobs(runnable, action, self.target_environment, argv)) if runnable else []
+                for resource in blocked:
+                    console.error("  Skipped " + resource + ", a dependency failed", showTime=False)
+                    wave_results.append(orchestrator.get_skipped_result(resource, self.target_environment))
+                failed.update(result["resource"] for result in wave_results if result["returncode"] != 0)
+                results += wave_results
+        else:
+            console.success("  Running " + action + " on " + str(len(resources)) + " resources, " + str(concurrency) + " at a time", showTime=False)
+            results = orchestrator.run(orchestrator.get_jobs(resources, action, self.target_environment, argv))
+        self.report.resources = results
+        if orchestrator.summary(results):
+            sys.exit(1)
+
+    def drift(self):
+        """
+        Check the resource for drift with a refresh-only plan, or a
+        normal plan with --full. Exits with 2 when changes are present,
+        and records the changes in the run report.
+        """
+        from .plansummary import get_plan_changes
+        self.reinit()
+        mode = "full" if '--full' in sys.argv[2:] else "refresh-only"
+        args = [arg for arg in sys.argv[2:] if arg != '--full']
+        plan_file = os.path.join(self.data_dir, 'tfbuild-drift.tfplan')
+        console.success("  Running Terraform Drift Detection (" + mode + ")", showTime=False)
+        plan = ['terraform', 'plan', '-input=false', '-detailed-exitcode', '-out=' + plan_file]
+        if mode == "refresh-only":
+            plan.append('-refresh-only')
+        self.command(plan + self.var_file_args + args)
+        returncode = self.returncode
+
+        drift = {"mode": mode, "changes": None, "addresses": []}
+        if returncode in (0, 2):
+            drift["changes"] = 0
+        if returncode == 2:
+            kind = 'resource_drift' if mode == "refresh-only" else 'resource_changes'
+            try:
+                for change_kind, change in get_plan_changes(plan_file, self.my_env):
+                    if change_kind == kind:
+                        drift["addresses"].append(change['address'])
+            except subprocess.CalledProcessError:
+                console.error("  Unable to read the saved plan !\n", showTime=False)
+            drift["changes"] = len(drift["addresses"])
+        self.report.details["drift"] = drift
+        if os.path.exists(plan_file):
+            os.remove(plan_file)
+
+        if returncode == 0:
+            console.success("  No drift detected", showTime=False)
+        elif returncode == 2:
+            console.error("  Drift detected: " + str(drift["changes"]) + " changes", showTime=False)
+            for address in drift["addresses"]:
+                console.error("    " + address, showTime=False)
+        if returncode:
+            sys.exit(returncode)
+
+    def driftall(self):
+        """
+        Check every resource and site of the current environment for
+        drift in parallel, and write a JSON drift report.
+        """
+        from .cache import write_json
+        from .drift import DriftReport
+        from .orchestrator import Orchestrator, find_resources
+        concurrency, args = self.get_concurrency()
+        output = None
+        for arg in list(args):
+            if arg.startswith('--output='):
+                output = arg.split('=', 1)[1]
+                args.remove(arg)
+
+        targets = []
+        for target_environment in self.get_targets():
+            file_preffix = "{}_{}".format(self.environment, target_environment) if target_environment else self.environment
+            targets += [(resource, target_environment) for resource in find_resources(self.repo_root, file_preffix)]
+        if not targets:
+            console.error("  No resources found for the environment " + self.environment + " !\n", showTime=False)
+            sys.exit(2)
+
+        self.warm_mirror(sorted(set(resource for resource, target_environment in targets)), concurrency)
+        mode = "full" if '--full' in args else "refresh-only"
+        console.success("  Checking " + str(len(targets)) + " resources for drift (" + mode + "), " + str(concurrency) + " at a time", showTime=False)
+        orchestrator = Orchestrator(self.repo_root, self.get_cache_dir("logs", "drift", self.get_file_prefix()), concurrency)
+        results = orchestrator.run(orchestrator.get_matrix_jobs(targets, 'drift', [sys.argv[0], 'drift'] + args), success_codes=(0, 2))
+        self.report.resources = results
+
+        drift_report = DriftReport(self.environment, mode, results)
+        drift_report.table()
+        output = output or os.path.join(self.get_cache_dir("reports"), "drift_" + self.get_file_prefix() + ".json")
+        os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+        write_json(output, drift_report.to_dict())
+        console.success("  Drift report written to " + output, showTime=False)
+        if drift_report.returncode:
+            sys.exit(drift_report.returncode)
+
+    def warm_mirror(self, resources, concurrency):
+        """
+        Mirror the providers required by resources not mirrored yet,
+        so their parallel initializations install them from the local
+        disk, each into its own data directory. Providers that can't be
+        mirrored are left to terraform init.
+        """
+        from .providers import ProviderMirror, scan_required_providers
+        requirements = scan_required_providers([(resource, os.path.join(self.repo_root, resource)) for resource in resources])
+        if not requirements:
+            return
+        with self.span('warm_provider_mirror'):
+            results = ProviderMirror().warm(requirements.keys(), concurrency=concurrency)
+        for source in sorted(set(source for (source, constraint), (status, output) in results.items() if status == "failed")):
+            console.warn("  Unable to mirror " + source + ", installed by terraform init", showTime=False)
+
+    def warmcache(self):
+        """
+        Fill the shared provider mirror with the providers required by
+        every resource of the repository, so the following
+        initializations install them locally, with no network.
+        """
+        from .orchestrator import find_resources
+        from .providers import ProviderMirror, scan_required_providers
+        concurrency, args = self.get_concurrency()
+        platforms = [arg.split('=', 1)[1] for arg in args if arg.startswith(('-platform=', '--platform='))]
+        resources = set()
+        for target_environment in self.get_targets():
+            file_preffix = "{}_{}".format(self.environment, target_environment) if target_environment else self.environment
+            resources.update(find_resources(self.repo_root, file_preffix))
+        requirements = scan_required_providers([(resource, os.path.join(self.repo_root, resource)) for resource in sorted(resources)])
+        if not requirements:
+            console.success("  No required_providers found in " + str(len(resources)) + " resources", showTime=False)
+            return
+
+        mirror = ProviderMirror()
+        console.success("  Mirroring " + str(len(requirements)) + " provider requirements of " + str(len(resources)) + " resources into " + mirror.mirror_dir, showTime=False)
+        results = mirror.warm(requirements.keys(), platforms, concurrency, '--refresh' in args)
+        failures = 0
+        for (source, constraint), (status, output) in sorted(results.items(), key=lambda item: (item[0][0], item[0][1] or '')):
+            line = "  {:<45} {:<20} {:<9} {} resources".format(source, constraint or '*', status, len(requirements[(source, constraint)]))
+            if status == "failed":
+                failures += 1
+                console.error(line, showTime=False)
+                for output_line in output.strip().splitlines():
+                    console.error("    " + output_line, showTime=False)
+            else:
+                console.success(line, showTime=False)
+        if failures:
+            sys.exit(1)
+
+    def get_base_ref(self, args, option):
+        """
+        Extract the git base ref option (ie: --affected=<ref>) from the
+        arguments. With no value, the base ref is TFBUILD_BASE_REF, or
+        origin/HEAD. Returns the base ref, or None, and the remaining
+        arguments.
+        """
+        base_ref = None
+        remaining = []
+        for arg in args:
+            if arg == option or arg.startswith(option + '='):
+                base_ref = arg.split('=', 1)[1] if '=' in arg else os.environ.get('TFBUILD_BASE_REF', 'origin/HEAD')
+            else:
+                remaining.append(arg)
+        return base_ref, remaining
+
+    def get_affected_resources(self, resources, base_ref):
+        """
+        Return the resources, with the first changed file affecting
+        each of them, changed since the merge base of base_ref and HEAD.
+        """
+        from .affected import AffectedResources, GitDiffError, get_changed_files
+        try:
+            changed_files = get_changed_files(self.repo_root, base_ref)
+        except GitDiffError as e:
+            console.error("  Unable to list the changes since " + base_ref + ":\n  " + str(e) + "\n", showTime=False)
+            sys.exit(2)
+        file_prefix = self.get_file_prefix()
+        common_files = [
+            os.path.join(self.repo_root, "common", "environments", "env_{}.hcl".format(file_prefix)),
+            os.path.join(self.repo_root, "common", "environments", "env_{}_common.tfvars".format(file_prefix)),
+            self.secret_path,
+            ]
+        return AffectedResources(self.repo_root, resources, common_files, file_prefix).get(changed_files)
+
+    def affected(self):
+        """
+        List the resources affected by the changes since a git base ref.
+        """
+        from .orchestrator import find_resources
+        base_ref, args = self.get_base_ref(sys.argv[2:], '--base')
+        base_ref = base_ref or os.environ.get('TFBUILD_BASE_REF', 'origin/HEAD')
+        resources = find_resources(self.repo_root, self.get_file_prefix())
+        affected = self.get_affected_resources(resources, base_ref)
+        if '--json' in args:
+            print(json.dumps([{"resource": resource, "reason": reason} for resource, reason in affected], indent=2))
+            return
+        console.success("  " + str(len(affected)) + " of " + str(len(resources)) + " resources affected by the changes since " + base_ref, showTime=False)
+        for resource, reason in affected:
+            print("{:<40} {}".format(resource, reason))
+
+    def ls(self):
+        """
+        List the resource contexts of the repository from the inventory
+        index, for every environment and site, filtered by the options.
+        Inside a resource directory, only the resources under it are
+        listed.
+        """
+        from .inventory import Inventory
+        filters = {"site": self.target_environment}
+        options = {'--resource': 'resource', '--branch': 'branch', '--environment': 'environment', '--site': 'site',
+                   '--backend': 'backend', '--bucket': 'bucket', '--key': 'bucket_key'}
+        if self.location != self.repo_root:
+            filters["resource"] = os.path.relpath(self.location, self.repo_root)
+        args = sys.argv[2:]
+        for arg in args:
+            option, _, value = arg.partition('=')
+            if option in options and _:
+                filters[options[option]] = value
+            elif arg in ('--global', '--regional'):
+                filters["is_global"] = arg == '--global'
+            elif arg not in ('--json', '--errors', '--rebuild'):
+                console.error("  Unknown option: " + arg + "\n  Options: " + ", ".join(sorted(option + "=" for option in options)) + ", --global, --regional, --errors, --json, --rebuild\n", showTime=False)
+                sys.exit(2)
+        if filters["site"] == "default":
+            filters["site"] = ''
+
+        inventory = Inventory(self.resolver, os.path.join(self.get_cache_dir(), "inventory.db"))
+        try:
+            with self.span('inventory_refresh'):
+                resolved = inventory.refresh('--rebuild' in args)
+            contexts = inventory.query(errors='--errors' in args, **filters)
+        finally:
+            inventory.close()
+        if '--json' in args:
+            print(json.dumps(contexts, indent=2))
+            return
+        console.success("  " + str(len(contexts)) + " contexts of " + str(len(set(context["resource"] for context in contexts))) + " resources" + (", " + str(resolved) + " resources indexed" if resolved else ""), showTime=False)
+        for context in contexts:
+            if context["error"]:
+                print("{:<40} {:<12} {:<12}".format(context["resource"], context["branch"], context["site"] or '-'))
+                console.error("    " + context["error"].replace("\n", "\n    "), showTime=False)
+            else:
+                print("{:<40} {:<12} {:<12} {:<5} {} {}".format(context["resource"], context["environment"], context["site"] or '-', context["backend_type"], context["bucket"], context["bucket_key"]))
+
+    def matrix(self):
+        """
+        Resolve every resource and site of several branches straight
+        from the git object store, with no checkout, and report the
+        state keys written by more than one of them. The branches are
+        given with --branches=<ref>,<ref>, and default to every local
+        and remote branch following the branch naming convention.
+        """
+        from .branches import find_collisions, get_branch_refs, resolve_branches
+        from .resolver import RepositoryError
+        concurrency, args = self.get_concurrency()
+        refs = [ref for arg in args if arg.startswith('--branches=') for ref in arg.split('=', 1)[1].split(',') if ref]
+        explicit = bool(refs)
+        if not explicit:
+            refs = list(get_branch_refs(self.repo_root).values())
+
+        with self.span('resolve_branches'):
+            results = resolve_branches(self.repo_root, refs, self.resolver.config, self.repo_url, self.target_environment, concurrency)
+        contexts = []
+        errors = []
+        for ref, branch_contexts, branch_errors, branch_error in results:
+            if isinstance(branch_error, RepositoryError) and not explicit:
+                continue
+            contexts += [(ref, context) for context in branch_contexts]
+            errors += [(ref, resource, site, error) for resource, site, error in branch_errors]
+            if branch_error:
+                errors.append((ref, None, None, str(branch_error)))
+        collisions = find_collisions([context for ref, context in contexts])
+        refs_by_context = dict((id(context), ref) for ref, context in contexts)
+
+        if '--json' in args:
+            print(json.dumps({
+                "contexts": [dict(ref=ref, resource=context.resource, branch=context.branch_name, environment=context.environment, site=context.target_environment or '',
+                                  backend_type=context.backend_type, bucket=context.bucket, bucket_key=context.bucket_key, region=context.region) for ref, context in contexts],
+                "errors": [{"ref": ref, "resource": resource, "site": site or '', "error": error} for ref, resource, site, error in errors],
+                "collisions": [{"address": list(address), "contexts": [{"ref": refs_by_context[id(context)], "resource": context.resource, "site": context.target_environment or ''} for context in colliding]} for address, colliding in collisions],
+                }, indent=2))
+        else:
+            console.success("  " + str(len(contexts)) + " contexts of " + str(len(refs)) + " branches", showTime=False)
+            for ref, context in contexts:
+                print("{:<24} {:<40} {:<12} {:<5} {} {}".format(ref, context.resource, context.target_environment or '-', context.backend_type, context.bucket, context.bucket_key))
+            for ref, resource, site, error in errors:
+                console.error("  " + ref + (" " + resource + " (" + (site or '-') + ")" if resource else "") + ":\n    " + error.replace("\n", "\n    "), showTime=False)
+            for address, colliding in collisions:
+                console.error("  State collision: " + "/".join(part or "*" for part in address), showTime=False)
+                for context in colliding:
+                    console.error("    " + refs_by_context[id(context)] + " " + context.resource + " (" + (context.target_environment or '-') + ")", showTime=False)
+        if collisions:
+            sys.exit(2)
+
+    def fanout(self, action=None, sites=None):
+        """
+        Run an action for several sites of the current resource at the
+        same time, ie: tfbuild plan-dr,us-west-2, default standing for the
+        default context, unless a site has that name. Every site gets its
+        own TF_DATA_DIR, with the providers installed from the provider
+        mirror.
+        """
+        from .orchestrator import Orchestrator
+        if not action or not sites:
+            console.error("  Usage: " + self.app_name + " <command>-<site|default>,<site>[,<site>...]\n", showTime=False)
+            sys.exit(2)
+        if self.location == self.repo_root:
+            console.error("  You are executing " + self.app_name.upper() + " from the repository root !\n          Please ensure execution from a resurce directory !\n", showTime=False)
+            sys.exit(2)
+        sites = [None if site == "default" and site not in self.get_sites() else site for site in sites]
+        unknown = [site for site in sites if site is not None and site not in self.get_sites()]
+        if unknown:
+            console.error("  Unknown sites: " + ", ".join(unknown) + "\n  Available sites: " + ", ".join(self.get_sites()) + "\n", showTime=False)
+            sys.exit(2)
+
+        concurrency, args = self.get_concurrency()
+        resource = os.path.relpath(self.location, self.repo_root).replace('\\', '/')
+        self.warm_mirror([resource], concurrency)
+        console.success("  Running " + action + " on " + resource + " for " + str(len(sites)) + " sites, " + str(concurrency) + " at a time", showTime=False)
+        orchestrator = Orchestrator(self.repo_root, self.get_cache_dir("logs", self.environment, resource.replace('/', '_')), concurrency)
+        results = orchestrator.run(orchestrator.get_site_jobs(resource, sites, action, [sys.argv[0], action] + args))
+        self.report.resources = results
+        orchestrator.output(results)
+        if orchestrator.summary(results, "Site"):
+            sys.exit(1)
+
+    def select_state_resources(self, verb):
+        """
+        Select state resource addresses, from the address patterns
+        passed as arguments (globs, or regular expressions with --regex),
+        or interactively. Returns the addresses and the remaining
+        Terraform arguments.
+        """
+        from .taint import StateIndex
+        patterns = [arg for arg in sys.argv[2:] if not arg.startswith('-')]
+        regex = '--regex' in sys.argv[2:]
+        args = [arg for arg in sys.argv[2:] if arg.startswith('-') and arg != '--regex']
+
         console.success("  Running Terraform Resource Query", showTime=False)
-        modules = []
-        resources = []
-        show_cmd = subprocess.Popen(['terraform', 'show'],stdin=None,stdout=subprocess.PIPE,stderr=subprocess.PIPE)
-        (stdout, stderr) = show_cmd.communicate()
-        lines = stdout.strip().decode().replace(":","").splitlines()
-        for line in lines:
-            if "module" in line:
-                items = line.split(".")
-                if len(items) > 1:
-                    module = items[1]
-                    if module not in modules:
-                        modules.append(module)
-       
-        if len(modules) > 1:
-            i = 0
-            print("Please choose the module you would like to taint:")
-            for module in modules:
-                print('[', i, ']: ', module)
-                i += 1
-            selectedmoduleindex = input("Module Selection: ")
-            if int(selectedmoduleindex) > (len(modules) - 1):
-                print('You selected an invalid module index, please try again')
-                sys.exit(0)
-        
-            selected_module = modules[int(selectedmoduleindex)]
-            print(selected_module)
-        
-        for line in lines:
-            if selected_module in line:
-                items = line.split(".")
-                if len(items) > 1:
-                    resource = items[2]
-                    if resource not in resources:
-                        resources.append(resource)
-    
-        if len(resources) > 1:
-            i = 0
-            print("Please choose the resource you would like to taint:")
-            for resource in resources:
-                print('[', i, ']: ', resource)
-                i += 1
-            selectedresourceindex = input("Resource Selection: ")
-            if int(selectedresourceindex) > (len(resources) - 1):
+        index = StateIndex(self.my_env)
+        if index.load() != 0:
+            console.error("  Unable to read the Terraform state !\n", showTime=False)
+            sys.exit(2)
+        if not index.resources:
+            console.success("  No managed resources in the Terraform state", showTime=False)
+            sys.exit(0)
+
+        if patterns:
+            selected = index.select(patterns, regex)
+        else:
+            for i, address in enumerate(index.addresses):
+                print('[', i, ']: ', address)
+            selection = input("Please choose the resources you would like to " + verb + " (ie: 0,2,5-7): ")
+            selected = []
+            try:
+                for item in selection.replace(' ', '').split(','):
+                    if '-' in item:
+                        first, last = item.split('-', 1)
+                        selected += index.addresses[int(first):int(last) + 1]
+                    elif item:
+                        selected.append(index.addresses[int(item)])
+            except (ValueError, IndexError):
                 print('You selected an invalid resource index, please try again')
                 sys.exit(0)
-        
-            selected_resource = resources[int(selectedresourceindex)]
-            print(selected_resource)
-            return selected_module, selected_resource
+            selected = list(dict.fromkeys(selected))
+
+        if not selected:
+            console.error("  No resources matching: " + ", ".join(patterns) + "\n", showTime=False)
+            sys.exit(2)
+        return selected, args
+
+    def serve(self):
+        """
+        Run the tfbuild daemon in the foreground, serving resolved
+        contexts and commands over a local Unix socket, or stop it
+        with --stop, or check it with --status.
+        """
+        from . import daemon
+        import socket
+        if '--stop' in sys.argv[2:] or '--status' in sys.argv[2:]:
+            response = daemon.request({"type": "shutdown" if '--stop' in sys.argv[2:] else "ping"}, timeout=5)
+            if response is None:
+                console.error("  No tfbuild daemon is running on " + daemon.get_socket_path() + "\n", showTime=False)
+                sys.exit(1)
+            if '--stop' in sys.argv[2:]:
+                console.success("  Stopped the tfbuild daemon", showTime=False)
+            else:
+                console.success("  tfbuild daemon running, pid {pid}, {contexts} cached contexts".format(**response), showTime=False)
+            return
+
+        if not hasattr(socket, 'AF_UNIX'):
+            console.error("  Unix sockets are not supported on this platform !\n", showTime=False)
+            sys.exit(2)
+        server = daemon.Server()
+        console.success("  Serving on " + server.path, showTime=False)
+        try:
+            server.serve_forever()
+        except OSError as e:
+            console.error("  " + str(e) + "\n", showTime=False)
+            sys.exit(2)
+        except KeyboardInterrupt:
+            console.success("\n  Stopped the tfbuild daemon", showTime=False)
 
     def taint(self):
         """
-        Taint resources.
+        Taint the selected state resources, one prompt for the batch.
+        Every address is a terraform taint run, locking, reading and
+        writing the whole state, so replace is cheaper for many
+        resources. Stops at the first failed taint.
         """
         self.init()
-        modules_totaint = []
-        resources_totaint = []
         console.success("  Running Terraform Taint", showTime=False)
-        taintagain = 'y'
-
-        while taintagain == 'y':
-            taintresources = self.taintresources()
-            modules_totaint.append(taintresources[0])
-            resources_totaint.append(taintresources[1])
-            taintagain = input("Select another module to taint? [y/n] : ")
+        selected, args = self.select_state_resources('taint')
 
         print('Tainting the following resources:')
-        if len(modules_totaint) >= 1:
-            i = 0
-            for i in range(len(modules_totaint)):
-                print('[', i, ']: [', modules_totaint[i], '] ', resources_totaint[i])
-                i += 1
-
+        for i, address in enumerate(selected):
+            print('[', i, ']: ', address)
+        if len(selected) > 1:
+            console.warn("  Every resource is tainted by a separate terraform run, use 'replace' to replace them in a single apply", showTime=False)
         gotaint = input("Proceed with Taint? [y/n] : ")
-        
+
         if gotaint == 'y':
-            if len(modules_totaint) >= 1:
-                i = 0
-                for i in range(len(modules_totaint)):
-                    taint = ['terraform', 'taint'] + self.var_file_args + ['-module='+modules_totaint[i], resources_totaint[i]] + sys.argv[2:]
-                    self.command(taint) 
-                    i += 1
+            for i, address in enumerate(selected):
+                taint = ['terraform', 'taint'] + args + [address]
+                if self.command(taint) != 0:
+                    console.error("  Unable to taint " + address + ", stopping with " + str(len(selected) - i - 1) + " resources not tainted !\n", showTime=False)
+                    break
+
+    def replace(self):
+        """
+        Replace the selected state resources through a single
+        apply with -replace flags.
+        """
+        self.init()
+        console.success("  Running Terraform Apply with Replace", showTime=False)
+        selected, args = self.select_state_resources('replace')
+        replace = ['terraform', 'apply'] + ['-replace=' + address for address in selected] + self.var_file_args + args
+        self.command(replace)
 
     def test(self):
         """
         Test all class attributes through a single cli call. 
         """
+        import jsonpickle
         console.warn("  Terraform Prerequisites Check", showTime=False)
         console.warn("  =============================", showTime=False)
         self.version_git()
@@ -382,18 +1167,100 @@ class Action(Core):
         console.success("  Updating Modules", showTime=False)
         update = ['terraform', 'get', '-update=true'] + self.var_file_args + sys.argv[2:]
         self.command(update) 
+        self.save_modules(refresh=True)
 
     def validate(self):
+        """
+        Validate the configuration, initialized with no backend and
+        the shared module cache. With --no-init, the modules and
+        providers already installed in the data directory are used, ie:
+        a data directory shared by validateall.
+        """
+        args = [arg for arg in sys.argv[2:] if arg != '--no-init']
         console.success("  Running Terraform Validation", showTime=False)
-        self.command(['terraform', 'init', '-backend=false']) 
-        validate = ['terraform', 'validate'] + sys.argv[2:]
+        if '--no-init' not in sys.argv[2:]:
+            with self.init_lock():
+                self.link_modules()
+                self.command(['terraform', 'init', '-backend=false'])
+                self.save_modules()
+        validate = ['terraform', 'validate'] + args
         self.command(validate) 
 
+    def validateall(self):
+        """
+        Validate every resource of the current environment in parallel,
+        with no backend. The providers are installed from the tfbuild
+        provider mirror, filled first with --warm, and the resources with
+        the same requirements share one data directory, initialized by
+        the first of them. --fail-fast cancels the validations not
+        started yet at the first failure.
+        """
+        from .modules import get_requirements_key
+        from .orchestrator import Orchestrator, find_resources
+        concurrency, args = self.get_concurrency()
+        base_ref, args = self.get_base_ref(args, '--affected')
+        fail_fast = '--fail-fast' in args
+        warm = '--warm' in args
+        args = [arg for arg in args if arg not in ('--fail-fast', '--warm')]
+        resources = find_resources(self.repo_root, self.get_file_prefix())
+        if not resources:
+            console.error("  No resources found with an environments/env_" + self.get_file_prefix() + ".tfvars file !\n", showTime=False)
+            sys.exit(2)
+        if base_ref:
+            resources = [resource for resource, reason in self.get_affected_resources(resources, base_ref)]
+            if not resources:
+                console.success("  No resources affected by the changes since " + base_ref, showTime=False)
+                return
+
+        if warm:
+            self.warm_mirror(resources, concurrency)
+
+        groups = {}
+        for resource in resources:
+            groups.setdefault(get_requirements_key(os.path.join(self.repo_root, resource)), []).append(resource)
+        data_dirs = dict((key, self.get_cache_dir("validate", key[:16])) for key in groups)
+        console.success("  Validating " + str(len(resources)) + " resources with " + str(len(groups)) + " shared initializations, " + str(concurrency) + " at a time", showTime=False)
+
+        orchestrator = Orchestrator(self.repo_root, self.get_cache_dir("logs", "validate", self.get_file_prefix()), concurrency)
+        argv = [sys.argv[0], 'validate'] + args
+        jobs = orchestrator.get_jobs([members[0] for members in groups.values()], 'validate', self.target_environment, argv)
+        for job, key in zip(jobs, groups):
+            job["data_dir"] = data_dirs[key]
+        results = dict((result["resource"], result) for result in orchestrator.run(jobs, fail_fast=fail_fast))
+
+        jobs = []
+        failed = any(result["returncode"] != 0 for result in results.values())
+        for key, members in groups.items():
+            for resource in members[1:]:
+                if fail_fast and failed:
+                    results[resource] = orchestrator.get_skipped_result(resource, self.target_environment)
+                elif results[members[0]]["returncode"] != 0:
+                    jobs += orchestrator.get_jobs([resource], 'validate', self.target_environment, argv)
+                else:
+                    lock_file = os.path.join(self.repo_root, members[0], '.terraform.lock.hcl')
+                    if os.path.isfile(lock_file) and not os.path.isfile(os.path.join(self.repo_root, resource, '.terraform.lock.hcl')):
+                        shutil.copyfile(lock_file, os.path.join(self.repo_root, resource, '.terraform.lock.hcl'))
+                    job = orchestrator.get_jobs([resource], 'validate', self.target_environment, argv + ['--no-init'])[0]
+                    job["data_dir"] = data_dirs[key]
+                    jobs.append(job)
+        if jobs:
+            results.update((result["resource"], result) for result in orchestrator.run(jobs, fail_fast=fail_fast))
+
+        results = [results[resource] for resource in resources]
+        self.report.resources = results
+        if orchestrator.summary(results):
+            sys.exit(1)
+
     def version(self):
         """
         Get application version from VERSION with cli call.
         """
-        console.success("  " + self.app_config.upper() + " version: " + version("tfbuild"), showTime=False)
+        from importlib.metadata import version, PackageNotFoundError
+        try:
+            app_version = version("tfbuild")
+        except PackageNotFoundError:
+            app_version = "unknown (not installed)"
+        console.success("  " + self.app_config.upper() + " version: " + app_version, showTime=False)
 
     def version_git(self):
         """
@@ -0,0 +1,88 @@
+#!/usr/bin/python3 -u
+
+from .plancache import get_module_dirs
+import os
+import subprocess
+
+generated_dirs = ['.terraform', '.tfbuild']
+generated_files = ['.terraform.lock.hcl', 'terraform.tfstate', 'terraform.tfstate.backup']
+
+class GitDiffError(Exception):
+    pass
+
+def git(repo_root, *args):
+    process = subprocess.run(['git'] + list(args), cwd=repo_root, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if process.returncode != 0:
+        raise GitDiffError(process.stderr.decode(errors='replace').strip() or "git " + " ".join(args) + " failed")
+    return process.stdout.decode(errors='replace')
+
+def get_changed_files(repo_root, base_ref):
+    """
+    Return the files, relative to the repository root, changed since
+    the merge base of base_ref and HEAD: committed, uncommitted and
+    untracked changes. Renames count as a deletion and an addition.
+    Untracked Terraform data directories, TFBuild caches, lock files
+    and local states are generated by the runs, and ignored.
+    """
+    merge_base = git(repo_root, 'merge-base', base_ref, 'HEAD').strip()
+    changed = git(repo_root, 'diff', '--name-only', '--no-renames', '-z', merge_base).split('\0')
+    changed += [path for path in git(repo_root, 'ls-files', '--others', '--exclude-standard', '-z').split('\0') if not is_generated(path)]
+    return sorted(set(path for path in changed if path))
+
+def is_generated(path):
+    parts = path.split('/')
+    return parts[-1] in generated_files or any(part in generated_dirs for part in parts[:-1])
+
+def is_under(path, directory):
+    return path == directory or path.startswith(directory + '/')
+
+class AffectedResources(object):
+    """
+    Map changed files to the resource directories they affect:
+    the resource own files, the local modules it references, and the
+    common environment files and backend secret shared by every resource.
+    Environment files of other environments or sites are ignored.
+    """
+    def __init__(self, repo_root, resources, common_files, file_prefix):
+        self.repo_root = os.path.realpath(repo_root)
+        self.resources = resources
+        self.local_env_file = "env_{}.tfvars".format(file_prefix)
+        self.common_files = [self.relpath(path) for path in common_files]
+        self.modules = {}
+        for resource in resources:
+            location = os.path.join(self.repo_root, resource)
+            self.modules[resource] = [
+                self.relpath(directory) for directory in get_module_dirs(location)
+                if directory != os.path.realpath(location)
+                ]
+
+    def relpath(self, path):
+        return os.path.relpath(os.path.realpath(path), self.repo_root).replace('\\', '/')
+
+    def get_owner(self, path):
+        """
+        Return the deepest resource directory holding the file, if any.
+        """
+        owners = [resource for resource in self.resources if is_under(path, resource)]
+        return max(owners, key=len) if owners else None
+
+    def get(self, changed_files):
+        """
+        Return the affected resources, in resource order, and the
+        reason of each one.
+        """
+        reasons = {}
+        for path in changed_files:
+            if path in self.common_files:
+                for resource in self.resources:
+                    reasons.setdefault(resource, path)
+                continue
+            owner = self.get_owner(path)
+            if owner and is_under(path, owner + '/environments') and os.path.basename(path) != self.local_env_file:
+                owner = None
+            if owner:
+                reasons.setdefault(owner, path)
+            for resource, modules in self.modules.items():
+                if any(is_under(path, module) for module in modules):
+                    reasons.setdefault(resource, path)
+        return [(resource, reasons[resource]) for resource in self.resources if resource in reasons]
@@ -0,0 +1,197 @@
+#!/usr/bin/python3 -u
+
+from .affected import GitDiffError, git
+from .resolver import ResolutionError, Resolver
+from concurrent.futures import ThreadPoolExecutor
+import os
+import subprocess
+
+class GitTree(object):
+    """
+    Files of a git branch, tag or commit, listed and read straight
+    from the object store, with no checkout. Only the environment
+    files are read, every other file is only listed.
+    """
+    def __init__(self, repo_root, ref):
+        self.repo_root = repo_root
+        self.ref = ref
+        self.files = {}
+        self.dirs = {"": set()}
+        for entry in git(repo_root, 'ls-tree', '-r', '-z', '--full-tree', ref).split('\0'):
+            if not entry:
+                continue
+            meta, path = entry.split('\t', 1)
+            mode, kind, sha = meta.split()
+            if kind != "blob":
+                continue
+            self.files[path] = sha
+            parent, name = os.path.dirname(path), os.path.basename(path)
+            while True:
+                known = parent in self.dirs
+                self.dirs.setdefault(parent, set()).add(name)
+                if known:
+                    break
+                parent, name = os.path.dirname(parent), os.path.basename(parent)
+        self.blobs = self.read_blobs([sha for path, sha in self.files.items() if path.startswith("common/environments/") and path.endswith(".hcl")])
+
+    def read_blobs(self, shas):
+        """
+        Read blobs through a single git cat-file --batch process.
+        """
+        if not shas:
+            return {}
+        process = subprocess.run(['git', 'cat-file', '--batch'], cwd=self.repo_root, input="".join(sha + "\n" for sha in shas).encode(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if process.returncode != 0:
+            raise GitDiffError(process.stderr.decode(errors='replace').strip() or "git cat-file failed")
+        blobs = {}
+        output = process.stdout
+        offset = 0
+        while offset < len(output):
+            end = output.index(b"\n", offset)
+            sha, kind, size = output[offset:end].decode().split()
+            blobs[sha] = output[end + 1:end + 1 + int(size)]
+            offset = end + 2 + int(size)
+        return blobs
+
+    def get_path(self, path):
+        return os.path.relpath(path, self.repo_root).replace('\\', '/') if os.path.isabs(path) else path.replace('\\', '/')
+
+    def read(self, path):
+        return self.blobs[self.files[self.get_path(path)]]
+
+    def get_sites(self, environment):
+        """
+        Return the sites of an environment, from its
+        env_<environment>_<site>.hcl files.
+        """
+        file_preffix = "env_{}_".format(environment)
+        return sorted(name[len(file_preffix):-len(".hcl")] for name in self.dirs.get("common/environments", ())
+                      if name.startswith(file_preffix) and name.endswith(".hcl"))
+
+    def find_resources(self, file_prefix):
+        """
+        Return the resource directories of the tree, like
+        find_resources on a working tree.
+        """
+        resources = []
+        for directory in sorted(self.dirs):
+            parts = directory.split('/')
+            if not directory or parts[0] == 'common' or any(part.startswith('.') or part == 'environments' for part in parts):
+                continue
+            if directory + "/environments/env_{}.tfvars".format(file_prefix) in self.files and any(name.endswith(".tf") and directory + "/" + name in self.files for name in self.dirs[directory]):
+                resources.append(directory)
+        return resources
+
+class GitResolver(Resolver):
+    """
+    Resolver reading the environment files of a git tree instead of
+    the working tree.
+    """
+    def __init__(self, tree, branch, config=None, repo_url=None):
+        self.tree = tree
+        Resolver.__init__(self, tree.repo_root, branch, config, repo_url)
+
+    def isfile(self, path):
+        return self.tree.get_path(path) in self.tree.files
+
+    def isdir(self, path):
+        path = self.tree.get_path(path)
+        return (path if path != "." else "") in self.tree.dirs
+
+    def listdir(self, path):
+        path = self.tree.get_path(path)
+        return sorted(self.tree.dirs[path if path != "." else ""])
+
+    def load_hcl(self, path):
+        if path not in self.hcl_files:
+            import hcl
+            self.hcl_files[path] = hcl.loads(self.tree.read(path).decode())
+        return self.hcl_files[path]
+
+def get_branch_refs(repo_root):
+    """
+    Return the local and remote branches of a repository, as branch
+    name and short ref, local branches first.
+    """
+    refs = {}
+    for ref in sorted(git(repo_root, 'for-each-ref', '--format=%(refname)', 'refs/heads', 'refs/remotes').split(), key=lambda ref: not ref.startswith("refs/heads/")):
+        if ref.startswith("refs/heads/"):
+            name = short_name = ref[len("refs/heads/"):]
+        elif ref.count("/") >= 3:
+            name, short_name = ref.split("/", 3)[3], ref[len("refs/remotes/"):]
+        else:
+            continue
+        if name != "HEAD":
+            refs.setdefault(name, short_name)
+    return refs
+
+def get_branch_name(repo_root, ref):
+    """
+    Return the branch name of a ref, without the remote name.
+    """
+    try:
+        full_name = git(repo_root, 'rev-parse', '--symbolic-full-name', ref).strip()
+    except GitDiffError:
+        full_name = ""
+    if full_name.startswith("refs/heads/"):
+        return full_name[len("refs/heads/"):]
+    if full_name.startswith("refs/remotes/") and full_name.count("/") >= 3:
+        return full_name.split("/", 3)[3]
+    return ref
+
+def resolve_branch(repo_root, ref, config=None, repo_url=None, target_environment=None):
+    """
+    Resolve the contexts of every resource and site of a branch from
+    its git tree. Returns the contexts, and the (resource, site, error)
+    of the resources failing the resolution. Raises ResolutionError
+    when the branch itself can't be resolved.
+    """
+    try:
+        tree = GitTree(repo_root, ref)
+    except GitDiffError as e:
+        raise ResolutionError(str(e))
+    resolver = GitResolver(tree, get_branch_name(repo_root, ref), config, repo_url)
+    environment = resolver.repository["environment"]
+    sites = tree.get_sites(environment)
+    if target_environment:
+        sites = [site for site in sites if site == target_environment]
+    else:
+        sites = [None] + sites
+    contexts = []
+    errors = []
+    for site in sites:
+        for resource in tree.find_resources("{}_{}".format(environment, site) if site else environment):
+            try:
+                contexts.append(resolver.resolve(resource, site))
+            except ResolutionError as e:
+                errors.append((resource, site, str(e)))
+    contexts.sort(key=lambda context: (context.resource, context.target_environment or ''))
+    return contexts, errors
+
+def resolve_branches(repo_root, refs, config=None, repo_url=None, target_environment=None, concurrency=4):
+    """
+    Resolve several branches in parallel. Returns a list of (ref,
+    contexts, errors, ResolutionError of the branch or None), in the
+    order of the refs.
+    """
+    def run(ref):
+        try:
+            return (ref,) + resolve_branch(repo_root, ref, config, repo_url, target_environment) + (None,)
+        except ResolutionError as e:
+            return (ref, [], [], e)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(concurrency, len(refs) or 1))) as executor:
+        return list(executor.map(run, refs))
+
+def find_collisions(contexts):
+    """
+    Return the state addresses written by more than one context, with
+    the contexts writing them.
+    """
+    from .graph import get_state_address
+    addresses = {}
+    for context in contexts:
+        address = get_state_address(context)
+        if address:
+            addresses.setdefault(address, []).append(context)
+    return [(address, contexts) for address, contexts in sorted(addresses.items(), key=lambda item: tuple(part or '' for part in item[0])) if len(contexts) > 1]
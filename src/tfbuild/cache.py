@@ -0,0 +1,182 @@
+#!/usr/bin/python3 -u
+
+from contextlib import contextmanager
+import hashlib
+import json
+import os
+import sys
+import time
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+def get_user_cache_dir(*subdirs):
+    """
+    Return the requested directory under the per-user tfbuild cache,
+    creating it if needed. TFBUILD_CACHE_DIR overrides the platform
+    default location.
+    """
+    if os.environ.get('TFBUILD_CACHE_DIR'):
+        cache_root = os.environ['TFBUILD_CACHE_DIR']
+    elif sys.platform.startswith("win"):
+        cache_root = os.path.join(os.environ.get('LOCALAPPDATA', os.path.join(os.path.expanduser("~"), "AppData", "Local")), "tfbuild", "Cache")
+    elif sys.platform == "darwin":
+        cache_root = os.path.join(os.path.expanduser("~"), "Library", "Caches", "tfbuild")
+    else:
+        cache_root = os.path.join(os.environ.get('XDG_CACHE_HOME', os.path.join(os.path.expanduser("~"), ".cache")), "tfbuild")
+    cache_dir = os.path.join(cache_root, *subdirs)
+    os.makedirs(cache_dir, exist_ok=True)
+    return cache_dir
+
+def write_json(path, data):
+    """
+    Atomically write a JSON document, so concurrent tfbuild
+    processes never read a partially written file.
+    """
+    tmp_path = "{}.{}.tmp".format(path, os.getpid())
+    with open(tmp_path, 'w') as fp:
+        json.dump(data, fp)
+    os.replace(tmp_path, path)
+
+@contextmanager
+def file_lock(path, shared=False):
+    """
+    Hold a lock on a lock file, shared by every tfbuild process, for
+    the duration of the block. Shared locks only exclude exclusive
+    ones, and are exclusive where flock is not available.
+    """
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    with open(path, 'a+') as fp:
+        if fcntl is not None:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+        else:
+            import msvcrt
+            fp.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(fp.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+            else:
+                fp.seek(0)
+                msvcrt.locking(fp.fileno(), msvcrt.LK_UNLCK, 1)
+
+def load_hcl(path, cache_dir):
+    """
+    Parse an HCL file through a parse cache shared by every tfbuild
+    process of the repository. Entries are keyed by the file path and
+    validated on its size and mtime, or on its content hash when the
+    file was modified too recently for the mtime to be trusted. A miss
+    is parsed under a lock, so concurrent processes parse a file once.
+    """
+    entry_path = os.path.join(cache_dir, hashlib.sha1(os.path.realpath(path).encode()).hexdigest() + ".json")
+
+    def get_entry():
+        try:
+            with open(entry_path, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return None
+
+    st = os.stat(path)
+    entry = get_entry()
+    if entry and entry.get("stamp") == [st.st_size, st.st_mtime_ns] and time.time() - st.st_mtime > 2:
+        return entry["data"]
+
+    with file_lock(entry_path + ".lock"):
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        digest = hashlib.sha256(content).hexdigest()
+        entry = get_entry()
+        if entry and entry.get("sha256") == digest:
+            data = entry["data"]
+        else:
+            import hcl
+            data = hcl.loads(content.decode())
+        try:
+            write_json(entry_path, {"path": path, "stamp": [st.st_size, st.st_mtime_ns], "sha256": digest, "data": data})
+        except (OSError, TypeError, ValueError):
+            pass
+    return data
+
+class ContextCache(object):
+    """
+    On-disk cache of a resolved deployment context, keyed by resource
+    location and target environment. An entry is only valid while the
+    git HEAD, the watched files and the config environment variables
+    it was resolved from are unchanged. Entries are kept in the store
+    dictionary instead of files when one is given, ie: by the daemon.
+    """
+    version = 1
+    environment_variables = ['BUCKET_PREFIX', 'CONCURRENCY', 'TF_CLOUD_ORG']
+
+    def __init__(self, location, target_environment, store=None):
+        key = hashlib.sha1("{}\0{}".format(location, target_environment or '').encode()).hexdigest()
+        self.enabled = os.environ.get('TFBUILD_CONTEXT_CACHE', 'true').lower() != 'false'
+        self.key = key
+        self.store = store
+        self.path = os.path.join(get_user_cache_dir("contexts"), key + ".json") if self.enabled and store is None else None
+
+    def get_stamp(self, files, head_file):
+        files_stamp = []
+        for path in files:
+            try:
+                st = os.stat(path)
+                files_stamp.append([path, st.st_mtime_ns, st.st_size])
+            except OSError:
+                files_stamp.append([path, None, None])
+        try:
+            with open(head_file, 'r') as fp:
+                head = fp.read().strip()
+        except OSError:
+            head = None
+        return {
+            "head": head,
+            "files": files_stamp,
+            "environment": [os.environ.get(var) for var in self.environment_variables],
+        }
+
+    def load(self):
+        """
+        Return the cached context, or None if missing or stale.
+        """
+        if not self.enabled:
+            return None
+        try:
+            if self.store is not None:
+                entry = self.store[self.key]
+            else:
+                with open(self.path, 'r') as fp:
+                    entry = json.load(fp)
+            if entry["version"] != self.version:
+                return None
+            if entry["stamp"] != self.get_stamp([item[0] for item in entry["stamp"]["files"]], entry["head_file"]):
+                return None
+            return entry["context"]
+        except (OSError, ValueError, KeyError, TypeError, IndexError):
+            return None
+
+    def save(self, context, files, head_file):
+        if not self.enabled:
+            return
+        entry = {
+            "version": self.version,
+            "head_file": head_file,
+            "stamp": self.get_stamp(files + [head_file], head_file),
+            "context": context,
+        }
+        if self.store is not None:
+            self.store[self.key] = entry
+            return
+        try:
+            write_json(self.path, entry)
+        except OSError:
+            pass
@@ -1,7 +1,11 @@
 #!/usr/bin/python3 -u
 
+import os
 import sys
+from . import daemon
 from .actions import Action
+from .profiler import Profiler
+from .report import RunReport
 from py_console import console
 
 def get_action_methods():
@@ -15,23 +19,58 @@ def main():
     argument is not mapped, we release the call to terraform.
     """
 
-    get_action_methods()
+    for option in [arg for arg in sys.argv[2:] if arg.startswith(('--report=', '--profile='))]:
+        os.environ['TFBUILD_' + option[2:].split('=', 1)[0].upper()] = option.split('=', 1)[1]
+        sys.argv.remove(option)
+
+    func_args = ()
     if len(sys.argv) == 1 or not filter(sys.argv[1].startswith, get_action_methods()):
         arg = "help"
         target_environment = None
     elif "-" in sys.argv[1]:
-        arg = sys.argv[1].split('-')[0]
-        target_environment = sys.argv[1].split('-')[1].lower()
+        arg, target_environment = sys.argv[1].split('-', 1)
+        target_environment = target_environment.lower()
+        if target_environment == "all":
+            arg = arg + "all"
+            target_environment = None
+        elif "," in target_environment:
+            func_args = (arg, list(dict.fromkeys(site for site in target_environment.split(',') if site)))
+            arg = "fanout"
+            target_environment = None
     else:
         arg = sys.argv[1]
         target_environment = None
 
+    if arg in daemon.served_actions and not os.environ.get('TFBUILD_PROFILE'):
+        response = daemon.request(daemon.get_request("command", arg, target_environment))
+        if response is not None:
+            sys.stdout.write(response["output"])
+            if response["returncode"]:
+                sys.exit(response["returncode"])
+            return
+
+    report = RunReport(arg, target_environment)
+    profiler = Profiler(os.environ['TFBUILD_PROFILE']) if os.environ.get('TFBUILD_PROFILE') else None
+    if profiler:
+        profiler.start()
     try:
-        current_action = Action(arg, target_environment)
+        with report.phase("context"):
+            current_action = Action(arg, target_environment, report=report)
         func = getattr(current_action, arg)
-        func()
+        func(*func_args)
     except KeyboardInterrupt:
         console.success("\n Execution terminated", showTime=False)
+        report.exit_code = 130
         sys.exit(130)
+    except SystemExit as e:
+        report.exit_code = e.code if isinstance(e.code, int) else 1
+        raise
     except(ValueError):
-        pass   
+        pass
+    finally:
+        if profiler:
+            profiler.stop(report)
+        report.finish()
+    if report.returncode:
+        sys.exit(report.returncode)
+
@@ -0,0 +1,191 @@
+#!/usr/bin/python3 -u
+
+from contextlib import contextmanager, redirect_stderr, redirect_stdout
+import io
+import json
+import os
+import socket
+import sys
+import time
+
+served_actions = ['test']
+
+def get_socket_path():
+    """
+    Return the tfbuild daemon socket path: TFBUILD_SOCKET, or
+    tfbuild.sock in the user cache directory.
+    """
+    if os.environ.get('TFBUILD_SOCKET'):
+        return os.environ['TFBUILD_SOCKET']
+    from .cache import get_user_cache_dir
+    return os.path.join(get_user_cache_dir(), "tfbuild.sock")
+
+def is_enabled():
+    return hasattr(socket, 'AF_UNIX') and os.environ.get('TFBUILD_DAEMON', 'true').lower() != 'false'
+
+def request(payload, timeout=60):
+    """
+    Send a request to the daemon and return its response, or None
+    when no daemon is listening.
+    """
+    if not is_enabled():
+        return None
+    path = get_socket_path()
+    if not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(timeout)
+    try:
+        client.connect(path)
+        client.sendall(json.dumps(payload).encode() + b"\n")
+        client.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            chunk = client.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        return json.loads(b"".join(chunks).decode())
+    except (OSError, ValueError):
+        return None
+    finally:
+        client.close()
+
+def get_request(request_type, action=None, target_environment=None):
+    return {
+        "type": request_type,
+        "action": action,
+        "target_environment": target_environment,
+        "cwd": os.getcwd(),
+        "argv": sys.argv,
+        "env": dict(os.environ),
+    }
+
+@contextmanager
+def client_state(request):
+    """
+    Run a request with the client working directory, arguments and
+    environment. Requests are served one at a time, so the process
+    state can be swapped safely.
+    """
+    saved_env = dict(os.environ)
+    saved_argv = sys.argv
+    saved_cwd = os.getcwd()
+    os.environ.clear()
+    os.environ.update(request["env"])
+    os.environ["TFBUILD_DAEMON"] = "false"
+    sys.argv = request["argv"]
+    try:
+        os.chdir(request["cwd"])
+        yield
+    finally:
+        os.chdir(saved_cwd)
+        sys.argv = saved_argv
+        os.environ.clear()
+        os.environ.update(saved_env)
+
+class Server(object):
+    """
+    Long-lived tfbuild process answering resolution and command
+    requests over a local Unix socket. Resolved contexts are kept in
+    memory, and validated on every request against the git HEAD and
+    the mtime of the files they were resolved from.
+    """
+    def __init__(self, path=None):
+        self.path = path or get_socket_path()
+        self.contexts = {}
+        self.running = False
+
+    def bind(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+                raise OSError("A tfbuild daemon is already listening on " + self.path)
+            except ConnectionError:
+                os.remove(self.path)
+            finally:
+                probe.close()
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(0o077)
+        try:
+            self.socket.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.socket.listen(16)
+
+    def serve_forever(self):
+        from .core import Core
+        Core.context_store = self.contexts
+        self.bind()
+        self.running = True
+        try:
+            while self.running:
+                connection = self.socket.accept()[0]
+                with connection:
+                    self.handle(connection)
+        finally:
+            self.socket.close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def handle(self, connection):
+        chunks = []
+        while not chunks or not chunks[-1].endswith(b"\n"):
+            chunk = connection.recv(65536)
+            if not chunk:
+                break
+            chunks.append(chunk)
+        try:
+            payload = json.loads(b"".join(chunks).decode())
+            response = getattr(self, "handle_" + payload["type"])(payload)
+        except (AttributeError, KeyError, TypeError, ValueError) as e:
+            response = {"output": "Invalid request: {}\n".format(e), "returncode": 2}
+        try:
+            connection.sendall(json.dumps(response).encode())
+        except OSError:
+            pass
+
+    def handle_ping(self, payload):
+        return {"pid": os.getpid(), "contexts": len(self.contexts), "returncode": 0}
+
+    def handle_shutdown(self, payload):
+        self.running = False
+        return {"returncode": 0}
+
+    def handle_resolve(self, payload):
+        """
+        Resolve the context of the client resource directory.
+        """
+        from .core import Core
+        return self.run(payload, lambda: {"context": Core(payload["action"], payload["target_environment"]).get_context()})
+
+    def handle_command(self, payload):
+        """
+        Run a served command, returning its output.
+        """
+        from .actions import Action
+        if payload["action"] not in served_actions:
+            return {"output": "Command not served by the daemon: {}\n".format(payload["action"]), "returncode": 2}
+
+        def command():
+            current_action = Action(payload["action"], payload["target_environment"])
+            getattr(current_action, payload["action"])()
+            return {}
+        return self.run(payload, command)
+
+    def run(self, payload, function):
+        start = time.perf_counter()
+        output = io.StringIO()
+        response = {"returncode": 0}
+        with client_state(payload), redirect_stdout(output), redirect_stderr(output):
+            try:
+                response.update(function())
+            except SystemExit as e:
+                response["returncode"] = e.code if isinstance(e.code, int) else int(e.code is not None)
+            except Exception as e:
+                print("  {}: {}".format(type(e).__name__, e))
+                response["returncode"] = 1
+        response["output"] = output.getvalue()
+        response["wall"] = round(time.perf_counter() - start, 6)
+        return response
@@ -0,0 +1,88 @@
+#!/usr/bin/python3 -u
+
+from py_console import console
+import time
+
+class DriftReport(object):
+    """
+    Repository wide drift report, built from the results of the
+    drift action of every resource and site. The drift action exits
+    with 2 when changes are present, like plan -detailed-exitcode.
+    """
+    def __init__(self, environment, mode, results):
+        self.environment = environment
+        self.mode = mode
+        self.results = results
+
+    def get_status(self, result):
+        if result["returncode"] == 0:
+            return "ok"
+        if result["returncode"] == 2:
+            return "drift"
+        return "failed"
+
+    @property
+    def drifted(self):
+        return [result for result in self.results if self.get_status(result) == "drift"]
+
+    @property
+    def failed(self):
+        return [result for result in self.results if self.get_status(result) == "failed"]
+
+    @property
+    def returncode(self):
+        """
+        1 if any resource failed, 2 if any drifted, 0 otherwise.
+        """
+        if self.failed:
+            return 1
+        return 2 if self.drifted else 0
+
+    def to_dict(self):
+        resources = []
+        for result in self.results:
+            drift = result.get("details", {}).get("drift", {})
+            resources.append({
+                "name": result["name"],
+                "resource": result["resource"],
+                "site": result.get("site"),
+                "status": self.get_status(result),
+                "returncode": result["returncode"],
+                "changes": drift.get("changes"),
+                "addresses": drift.get("addresses", []),
+                "duration": round(result["duration"], 2),
+                "log": result["log"],
+            })
+        return {
+            "environment": self.environment,
+            "mode": self.mode,
+            "created": time.time(),
+            "returncode": self.returncode,
+            "total": len(self.results),
+            "drifted": len(self.drifted),
+            "failed": len(self.failed),
+            "resources": resources,
+        }
+
+    def table(self):
+        """
+        Display the drift report as a table.
+        """
+        resources = self.to_dict()["resources"]
+        width = max([len(resource["name"]) for resource in resources] + [len("Resource")])
+        console.warn("\n  Drift Report ({} {})".format(self.environment, self.mode), showTime=False)
+        console.warn("  ============", showTime=False)
+        console.warn("  {:<{width}}  {:<7}  {:>7}  {:>9}".format("Resource", "Status", "Changes", "Duration", width=width), showTime=False)
+        for resource in resources:
+            line = "  {:<{width}}  {:<7}  {:>7}  {:>8.1f}s".format(
+                resource["name"],
+                resource["status"],
+                "-" if resource["changes"] is None else resource["changes"],
+                resource["duration"],
+                width=width
+            )
+            if resource["status"] == "ok":
+                console.success(line, showTime=False)
+            else:
+                console.error(line, showTime=False)
+        console.warn("\n  {} resources, {} drifted, {} failed\n".format(len(resources), len(self.drifted), len(self.failed)), showTime=False)
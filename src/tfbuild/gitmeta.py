@@ -0,0 +1,243 @@
+#!/usr/bin/python3 -u
+
+import os
+import re
+
+class GitMetadataError(Exception):
+    pass
+
+class GitMetadata(object):
+    """
+    Lightweight reader for the git metadata tfbuild needs: repository
+    root, HEAD, active branch and first remote URL. Reads straight from
+    the .git directory, following '.git' files (worktrees, submodules),
+    commondir links and packed refs. Falls back to GitPython for
+    layouts it does not handle (GIT_DIR/GIT_WORK_TREE overrides,
+    core.worktree, config includes, bare repositories).
+    """
+    section_re = re.compile(r'^\[\s*([A-Za-z0-9.-]+)(?:\s+"((?:[^"\\]|\\.)*)")?\s*\]\s*(.*)$')
+
+    def __init__(self, path=None):
+        self.repo = None
+        start = os.path.realpath(path or os.getcwd())
+        if os.environ.get('GIT_DIR') or os.environ.get('GIT_WORK_TREE'):
+            self.init_gitpython(start)
+            return
+
+        self.root, self.git_dir = self.find_git_dir(start)
+        commondir_file = os.path.join(self.git_dir, "commondir")
+        if os.path.isfile(commondir_file):
+            with open(commondir_file, 'r') as fp:
+                self.common_dir = os.path.realpath(os.path.join(self.git_dir, fp.read().strip()))
+        else:
+            self.common_dir = self.git_dir
+
+        self.config = self.read_config(os.path.join(self.common_dir, "config"))
+        if self.config is None or self.get_config_value("core", None, "bare") == "true" \
+                or self.get_config_value("core", None, "worktree") is not None:
+            self.init_gitpython(start)
+
+    def init_gitpython(self, start):
+        try:
+            from git import Repo
+            self.repo = Repo(start, search_parent_directories=True)
+            self.root = os.path.realpath(self.repo.git.rev_parse("--show-toplevel"))
+            self.git_dir = self.repo.git_dir
+            self.common_dir = getattr(self.repo, "common_dir", self.git_dir)
+        except Exception as e:
+            raise GitMetadataError(str(e))
+
+    def find_git_dir(self, start):
+        """
+        Walk up from start to the first directory holding a '.git'
+        directory or a '.git' file with a 'gitdir:' pointer.
+        """
+        current = start
+        while True:
+            dot_git = os.path.join(current, ".git")
+            if os.path.isdir(dot_git):
+                return current, dot_git
+            if os.path.isfile(dot_git):
+                with open(dot_git, 'r') as fp:
+                    content = fp.read().strip()
+                if not content.startswith("gitdir:"):
+                    raise GitMetadataError("Invalid .git file: " + dot_git)
+                return current, os.path.realpath(os.path.join(current, content[len("gitdir:"):].strip()))
+            parent = os.path.dirname(current)
+            if parent == current:
+                raise GitMetadataError("Not a git repository: " + start)
+            current = parent
+
+    def read_config(self, path):
+        """
+        Parse a git config file into a list of (section, subsection,
+        key, value) entries. Returns None for files using features
+        handled only by git itself (includes, line continuations).
+        """
+        entries = []
+        section = subsection = None
+        try:
+            with open(path, 'r') as fp:
+                lines = fp.read().splitlines()
+        except OSError:
+            return []
+        for line in lines:
+            line = line.strip()
+            if not line or line[0] in "#;":
+                continue
+            if line.startswith("["):
+                match = self.section_re.match(line)
+                if not match:
+                    return None
+                section, subsection, line = match.group(1), match.group(2), match.group(3).strip()
+                if subsection is None and "." in section:
+                    section, subsection = section.split(".", 1)
+                section = section.lower()
+                if section in ("include", "includeif"):
+                    return None
+                if subsection is not None:
+                    subsection = re.sub(r'\\(.)', r'\1', subsection)
+                if not line or line[0] in "#;":
+                    continue
+            key, _, value = line.partition("=")
+            value = self.parse_value(value) if _ else "true"
+            if value is None:
+                return None
+            entries.append((section, subsection, key.strip().lower(), value))
+        return entries
+
+    def parse_value(self, raw):
+        value = []
+        quoted = False
+        i = 0
+        raw = raw.strip()
+        while i < len(raw):
+            char = raw[i]
+            if char == '\\':
+                if i + 1 >= len(raw):
+                    return None
+                value.append({'n': '\n', 't': '\t', 'b': '\b'}.get(raw[i + 1], raw[i + 1]))
+                i += 2
+                continue
+            if char == '"':
+                quoted = not quoted
+            elif char in "#;" and not quoted:
+                break
+            else:
+                value.append(char)
+            i += 1
+        return "".join(value).strip() if not quoted else None
+
+    def get_config_value(self, section, subsection, key):
+        value = None
+        for entry in self.config or []:
+            if entry[0] == section and entry[1] == subsection and entry[2] == key:
+                value = entry[3]
+        return value
+
+    def get_head(self):
+        """
+        Return the raw content of HEAD: 'ref: <ref>' or a commit id.
+        """
+        if self.repo is not None:
+            return "ref: " + self.repo.head.reference.path if not self.repo.head.is_detached else self.repo.head.commit.hexsha
+        with open(os.path.join(self.git_dir, "HEAD"), 'r') as fp:
+            return fp.read().strip()
+
+    def get_head_file(self):
+        return os.path.join(self.git_dir, "HEAD")
+
+    def get_config_file(self):
+        return os.path.join(self.common_dir, "config")
+
+    def get_branch(self):
+        """
+        Return the active branch name, or None on a detached HEAD.
+        """
+        if self.repo is not None:
+            return None if self.repo.head.is_detached else self.repo.active_branch.name
+        head = self.get_head()
+        if head.startswith("ref:"):
+            ref = head[len("ref:"):].strip()
+            if ref.startswith("refs/heads/"):
+                return ref[len("refs/heads/"):]
+            return ref
+        return None
+
+    def get_commit(self):
+        """
+        Return the commit id HEAD points to, following loose and
+        packed refs, or None for an unborn branch.
+        """
+        if self.repo is not None:
+            try:
+                return self.repo.head.commit.hexsha
+            except ValueError:
+                return None
+        value = self.get_head()
+        for _ in range(10):
+            if not value.startswith("ref:"):
+                return value
+            value = self.read_ref(value[len("ref:"):].strip())
+            if value is None:
+                return None
+        return None
+
+    def read_ref(self, ref):
+        for base in (self.git_dir, self.common_dir):
+            ref_file = os.path.join(base, *ref.split("/"))
+            if os.path.isfile(ref_file):
+                with open(ref_file, 'r') as fp:
+                    return fp.read().strip()
+        packed_refs = os.path.join(self.common_dir, "packed-refs")
+        if os.path.isfile(packed_refs):
+            with open(packed_refs, 'r') as fp:
+                for line in fp:
+                    if line.startswith(("#", "^")):
+                        continue
+                    parts = line.split()
+                    if len(parts) == 2 and parts[1] == ref:
+                        return parts[0]
+        return None
+
+    def get_branches(self):
+        """
+        Return the names of the local and remote tracking branches,
+        without the remote name, from loose and packed refs.
+        """
+        if self.repo is not None:
+            refs = [ref.path for ref in self.repo.refs]
+        else:
+            refs = []
+            for base in ("refs/heads", "refs/remotes"):
+                for root, dirs, files in os.walk(os.path.join(self.common_dir, *base.split("/"))):
+                    refs += [os.path.relpath(os.path.join(root, name), self.common_dir).replace('\\', '/') for name in files]
+            packed_refs = os.path.join(self.common_dir, "packed-refs")
+            if os.path.isfile(packed_refs):
+                with open(packed_refs, 'r') as fp:
+                    for line in fp:
+                        parts = line.split()
+                        if not line.startswith(("#", "^")) and len(parts) == 2:
+                            refs.append(parts[1])
+        branches = set()
+        for ref in refs:
+            if ref.startswith("refs/heads/"):
+                branches.add(ref[len("refs/heads/"):])
+            elif ref.startswith("refs/remotes/") and "/" in ref[len("refs/remotes/"):]:
+                branches.add(ref[len("refs/remotes/"):].split("/", 1)[1])
+        branches.discard("HEAD")
+        return sorted(branches)
+
+    def get_remote_url(self):
+        """
+        Return the URL of the first configured remote, or None.
+        """
+        if self.repo is not None:
+            try:
+                return self.repo.remotes[0].config_reader.get("url")
+            except IndexError:
+                return None
+        for section, subsection, key, value in self.config:
+            if section == "remote" and key == "url":
+                return value
+        return None
@@ -0,0 +1,254 @@
+#!/usr/bin/python3 -u
+
+from .providers import get_blocks, strip_comments
+from py_console import console
+import os
+import re
+
+remote_state_re = re.compile(r'^\s*data\s+"(terraform_remote_state|tfe_outputs)"\s+"([^"]+)"\s*\{', re.M)
+variable_re = re.compile(r'^\s*variable\s+"([^"]+)"\s*\{', re.M)
+interpolation_re = re.compile(r'\$\{\s*var\.([A-Za-z_][\w-]*)\s*\}')
+expression_re = r'(?<![\w.-])"?{}"?\s*[=:]\s*("(?:[^"\\]|\\.)*"|[A-Za-z_][\w.-]*)'
+backend_types = {"aws": "s3", "azr": "azurerm"}
+
+def get_expression(body, name):
+    match = re.search(expression_re.format(name), body)
+    return match.group(1) if match else None
+
+def evaluate(expression, variables):
+    """
+    Evaluate a string literal, with ${var.<name>} interpolations, or a
+    var.<name> reference. Returns None for anything else, or when a
+    variable is not known.
+    """
+    if expression is None:
+        return None
+    if expression.startswith('"'):
+        names = interpolation_re.findall(expression)
+        if any(variables.get(name) is None for name in names):
+            return None
+        value = interpolation_re.sub(lambda match: str(variables[match.group(1)]), expression[1:-1])
+        return None if '${' in value else value
+    if expression.startswith('var.'):
+        value = variables.get(expression[len('var.'):])
+        return None if value is None else str(value)
+    return None
+
+def get_variables(location, var_files, env):
+    """
+    Return the string values of the input variables of a resource:
+    the variable defaults, overridden by the TF_VAR_<name> environment
+    variables, overridden by the var files, in order.
+    """
+    import hcl
+    variables = {}
+    for file_name in sorted(os.listdir(location)):
+        if file_name.endswith('.tf'):
+            with open(os.path.join(location, file_name), 'r', errors='replace') as fp:
+                content = strip_comments(fp.read())
+            for match, body in get_blocks(content, variable_re):
+                default = evaluate(get_expression(body, 'default'), {})
+                if default is not None:
+                    variables[match.group(1)] = default
+    for name, value in env.items():
+        if name.startswith('TF_VAR_') and value is not None:
+            variables[name[len('TF_VAR_'):]] = value
+    for var_file in var_files:
+        try:
+            with open(var_file, 'r') as fp:
+                values = hcl.load(fp)
+        except (OSError, ValueError):
+            continue
+        variables.update((name, str(value)) for name, value in values.items() if isinstance(value, (str, int, float)) and not isinstance(value, bool))
+    return variables
+
+def get_state_address(context):
+    """
+    Return the (backend, container, key) address of the state of a
+    resource: S3 bucket and key, storage account and key, or TFC
+    organization and workspace. None for local state.
+    """
+    if context.backend_type in backend_types:
+        return (backend_types[context.backend_type], context.bucket, context.bucket_key)
+    if context.backend_type == "tfc" or context.tf_cloud_backend == "true":
+        return ("tfc", context.tf_cloud_backend_org, context.bucket_key)
+    return None
+
+def get_remote_states(location, variables):
+    """
+    Return the remote state references of a resource, from its
+    terraform_remote_state and tfe_outputs data sources, as (data
+    source address, (backend, container, key) address). The address
+    is None when it can't be evaluated statically. Backends other than
+    s3, azurerm and remote are skipped.
+    """
+    references = []
+    for file_name in sorted(os.listdir(location)):
+        if not file_name.endswith('.tf'):
+            continue
+        with open(os.path.join(location, file_name), 'r', errors='replace') as fp:
+            content = strip_comments(fp.read())
+        for match, body in get_blocks(content, remote_state_re):
+            data_source = "data.{}.{}".format(match.group(1), match.group(2))
+            if match.group(1) == "tfe_outputs":
+                fields = ("tfc", 'organization', 'workspace')
+            else:
+                backend = evaluate(get_expression(body, 'backend'), variables)
+                if backend == "s3":
+                    fields = ("s3", 'bucket', 'key')
+                elif backend == "azurerm":
+                    fields = ("azurerm", 'storage_account_name', 'key')
+                elif backend == "remote":
+                    fields = ("tfc", 'organization', 'name')
+                else:
+                    continue
+            key = evaluate(get_expression(body, fields[2]), variables)
+            container = evaluate(get_expression(body, fields[1]), variables)
+            references.append((data_source, (fields[0], container, key) if key else None))
+    return references
+
+class DependencyGraph(object):
+    """
+    Dependencies between the resources of a repository, from the
+    remote state data sources of every resource matched against the
+    state address of the other resources. References to no resource
+    of the repository are dangling, and references that can't be
+    evaluated statically are unresolved.
+    """
+    def __init__(self, contexts):
+        from .resolver import get_terraform_environment
+        self.resources = [context.resource for context in contexts]
+        self.dependencies = dict((resource, set()) for resource in self.resources)
+        self.references = []
+        addresses = {}
+        for context in contexts:
+            address = get_state_address(context)
+            if address:
+                addresses.setdefault((address[0], address[2]), []).append((address[1], context.resource))
+
+        for context in contexts:
+            variables = get_variables(context.location, context.var_file_args_list, get_terraform_environment(context))
+            for data_source, address in get_remote_states(context.location, variables):
+                reference = {"resource": context.resource, "data_source": data_source, "address": list(address) if address else None, "target": None}
+                if address is None:
+                    reference["status"] = "unresolved"
+                else:
+                    targets = [resource for container, resource in addresses.get((address[0], address[2]), []) if address[1] in (None, container)]
+                    if not targets:
+                        reference["status"] = "dangling"
+                    else:
+                        reference["status"] = "resolved"
+                        reference["target"] = targets[0]
+                        if targets[0] != context.resource:
+                            self.dependencies[context.resource].add(targets[0])
+                self.references.append(reference)
+
+    def get_references(self, status):
+        return [reference for reference in self.references if reference["status"] == status]
+
+    def get_cycles(self):
+        """
+        Return the dependency cycles, as the sorted resources of every
+        strongly connected component with more than one resource.
+        """
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        cycles = []
+        counter = [0]
+
+        def connect(resource):
+            work = [(resource, iter(sorted(self.dependencies[resource])))]
+            index[resource] = lowlink[resource] = counter[0]
+            counter[0] += 1
+            stack.append(resource)
+            on_stack.add(resource)
+            while work:
+                node, dependencies = work[-1]
+                for dependency in dependencies:
+                    if dependency not in index:
+                        index[dependency] = lowlink[dependency] = counter[0]
+                        counter[0] += 1
+                        stack.append(dependency)
+                        on_stack.add(dependency)
+                        work.append((dependency, iter(sorted(self.dependencies[dependency]))))
+                        break
+                    if dependency in on_stack:
+                        lowlink[node] = min(lowlink[node], index[dependency])
+                else:
+                    work.pop()
+                    if work:
+                        lowlink[work[-1][0]] = min(lowlink[work[-1][0]], lowlink[node])
+                    if lowlink[node] == index[node]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == node:
+                                break
+                        if len(component) > 1:
+                            cycles.append(sorted(component))
+
+        for resource in self.resources:
+            if resource not in index:
+                connect(resource)
+        return cycles
+
+    def get_waves(self, resources=None):
+        """
+        Group the resources in waves, every resource after the ones
+        it depends on, so the resources of a wave can run in parallel.
+        Dependencies on resources not selected are ignored. Resources
+        in a cycle are left out.
+        """
+        selected = set(self.resources if resources is None else resources)
+        pending = dict((resource, self.dependencies[resource] & selected) for resource in self.resources if resource in selected)
+        waves = []
+        while pending:
+            wave = sorted(resource for resource, dependencies in pending.items() if not dependencies)
+            if not wave:
+                break
+            waves.append(wave)
+            for resource in wave:
+                del pending[resource]
+            for dependencies in pending.values():
+                dependencies.difference_update(wave)
+        return waves
+
+    def to_dict(self):
+        return {
+            "resources": dict((resource, sorted(dependencies)) for resource, dependencies in self.dependencies.items()),
+            "waves": self.get_waves(),
+            "cycles": self.get_cycles(),
+            "references": self.references,
+        }
+
+    def display_problems(self, dangling=True):
+        """
+        Display the cycles, dangling and unresolved references. Returns
+        True when there is a cycle. Dangling references are not shown
+        with dangling=False, ie: for a graph of some of the resources.
+        """
+        cycles = self.get_cycles()
+        for cycle in cycles:
+            console.error("  Dependency cycle between: " + ", ".join(cycle), showTime=False)
+        for reference in self.get_references("dangling") if dangling else []:
+            console.warn("  Dangling reference: {} {} -> {}".format(reference["resource"], reference["data_source"], "/".join(part or "*" for part in reference["address"])), showTime=False)
+        for reference in self.get_references("unresolved"):
+            console.warn("  Unresolved reference: {} {} (not statically known)".format(reference["resource"], reference["data_source"]), showTime=False)
+        return bool(cycles)
+
+    def display(self):
+        """
+        Display the waves and the dependencies of every resource.
+        Returns True when there is a cycle.
+        """
+        for number, wave in enumerate(self.get_waves(), 1):
+            console.warn("\n  Wave {}".format(number), showTime=False)
+            for resource in wave:
+                dependencies = sorted(self.dependencies[resource])
+                console.success("  {}{}".format(resource, " <- " + ", ".join(dependencies) if dependencies else ""), showTime=False)
+        print("")
+        return self.display_problems()
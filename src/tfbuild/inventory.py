@@ -0,0 +1,248 @@
+#!/usr/bin/python3 -u
+
+from .resolver import ResolutionError, Resolver, clouds_list, global_resources
+import hashlib
+import json
+import os
+import sqlite3
+import time
+
+schema = [
+    "CREATE TABLE meta (name TEXT PRIMARY KEY, value TEXT)",
+    "CREATE TABLE directories (path TEXT PRIMARY KEY, mtime INTEGER, children TEXT, terraform INTEGER, env_mtime INTEGER, env_files TEXT)",
+    "CREATE TABLE resources (resource TEXT PRIMARY KEY, stamp TEXT)",
+    "CREATE TABLE contexts (resource TEXT, branch TEXT, environment TEXT, site TEXT, common_shell_file TEXT, common_env_file TEXT, local_env_file TEXT,"
+    " region TEXT, prefix TEXT, module TEXT, backend_type TEXT, bucket TEXT, bucket_key TEXT, global_resource INTEGER, error TEXT,"
+    " PRIMARY KEY (resource, branch, site))",
+    "CREATE INDEX contexts_bucket ON contexts (bucket, bucket_key)",
+    "CREATE INDEX contexts_environment ON contexts (environment, site)",
+    ]
+context_columns = ['resource', 'branch', 'environment', 'site', 'common_shell_file', 'common_env_file', 'local_env_file',
+                   'region', 'prefix', 'module', 'backend_type', 'bucket', 'bucket_key', 'global_resource', 'error']
+
+class Inventory(object):
+    """
+    On-disk SQLite index of the resources of a repository: the env
+    files selected for every environment and site, and the computed
+    prefix, module, bucket and state key. The index is refreshed
+    incrementally: directories are only listed again when their mtime
+    changed, and resources are only resolved again when their
+    directory or environments directory changed. Everything is
+    resolved again when the common environment files, the config or
+    the branches change.
+
+    Every environment with a common/environments/env_<environment>.hcl
+    file is indexed, for every branch of that environment known to
+    git, from the files of the working tree.
+    """
+    version = 1
+
+    def __init__(self, resolver, path):
+        self.resolver = resolver
+        self.repo_root = resolver.repo_root
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        if self.db.execute("PRAGMA user_version").fetchone()[0] != self.version:
+            self.db.execute("BEGIN IMMEDIATE")
+            for name, kind in self.db.execute("SELECT name, type FROM sqlite_master WHERE type = 'table'").fetchall():
+                self.db.execute("DROP TABLE {}".format(name))
+            for statement in schema:
+                self.db.execute(statement)
+            self.db.execute("PRAGMA user_version = {}".format(self.version))
+            self.db.execute("COMMIT")
+
+    def close(self):
+        self.db.close()
+
+    def get_environments(self):
+        """
+        Return the environments and their sites, from the
+        env_<environment>[_<site>].hcl files of common/environments.
+        """
+        env_dir = os.path.join(self.repo_root, "common", "environments")
+        environments = {}
+        names = sorted(file_name[len("env_"):-len(".hcl")] for file_name in os.listdir(env_dir)
+                       if file_name.startswith("env_") and file_name.endswith(".hcl")) if os.path.isdir(env_dir) else []
+        for name in names:
+            if "_" not in name:
+                environments.setdefault(name, [])
+        for name in names:
+            environment, _, site = name.partition("_")
+            if site and environment in environments:
+                environments[environment].append(site)
+        return environments
+
+    def get_branches(self, environments):
+        """
+        Return the branches of every environment: the current branch,
+        and the local and remote branches named after the environment.
+        """
+        from .gitmeta import GitMetadata, GitMetadataError
+        repository = self.resolver.repository
+        try:
+            names = GitMetadata(self.repo_root).get_branches()
+        except GitMetadataError:
+            names = []
+        branches = {}
+        for name in sorted(set([repository["branch_name"]] + [name.lower() for name in names])):
+            parts = name.split("-")
+            if len(parts) == 2:
+                environment = parts[1]
+            elif repository["cloud"] not in clouds_list:
+                environment = name
+            else:
+                continue
+            if environment in environments:
+                branches.setdefault(environment, []).append(name)
+        return branches
+
+    def get_stamp(self, branches):
+        """
+        Fingerprint of everything but the resource directories the
+        contexts depend on.
+        """
+        repository = self.resolver.repository
+        digest = hashlib.sha256(json.dumps([repository["repo_url"], self.resolver.config, branches, os.path.isfile(repository["secret_path"])]).encode())
+        env_dir = os.path.join(self.repo_root, "common", "environments")
+        if os.path.isdir(env_dir):
+            for file_name in sorted(os.listdir(env_dir)):
+                digest.update(b"\0" + file_name.encode())
+                if file_name.endswith(".hcl"):
+                    with open(os.path.join(env_dir, file_name), 'rb') as fp:
+                        digest.update(hashlib.sha256(fp.read()).digest())
+        return digest.hexdigest()
+
+    def scan(self):
+        """
+        Walk the repository like find_resources, listing only the
+        directories changed since the previous scan. Returns the
+        resource directories with their stamp and env files.
+        """
+        stored = dict((row["path"], row) for row in self.db.execute("SELECT * FROM directories"))
+        racy = time.time_ns() - 2 * 10 ** 9
+        visited = set()
+        resources = {}
+        pending = [""]
+        while pending:
+            path = pending.pop()
+            location = os.path.join(self.repo_root, path)
+            try:
+                mtime = os.stat(location).st_mtime_ns
+            except OSError:
+                continue
+            try:
+                env_mtime = os.stat(os.path.join(location, "environments")).st_mtime_ns
+            except OSError:
+                env_mtime = None
+            row = stored.get(path)
+            if row is not None and row["mtime"] == mtime:
+                children, terraform = json.loads(row["children"]), row["terraform"]
+            else:
+                children, terraform = [], 0
+                with os.scandir(location) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if not entry.name.startswith('.') and entry.name != 'environments' and not (path == "" and entry.name == 'common'):
+                                children.append(entry.name)
+                        elif entry.name.endswith(".tf"):
+                            terraform = 1
+                children.sort()
+            if row is not None and row["mtime"] == mtime and row["env_mtime"] == env_mtime:
+                env_files = json.loads(row["env_files"])
+            elif env_mtime is not None:
+                env_files = sorted(file_name for file_name in os.listdir(os.path.join(location, "environments")) if file_name.endswith(".tfvars"))
+            else:
+                env_files = []
+            if row is None or row["mtime"] != mtime or row["env_mtime"] != env_mtime:
+                self.db.execute("INSERT OR REPLACE INTO directories VALUES (?, ?, ?, ?, ?, ?)", (
+                    path, mtime if mtime < racy else None, json.dumps(children), terraform,
+                    env_mtime if env_mtime is None or env_mtime < racy else -1, json.dumps(env_files)))
+            visited.add(path)
+            if path and terraform and env_files:
+                stamp = [mtime, env_mtime] if mtime < racy and (env_mtime or 0) < racy else None
+                resources[path.replace('\\', '/')] = (stamp, env_files)
+            pending.extend(os.path.join(path, child) for child in reversed(children))
+        for path in set(stored) - visited:
+            self.db.execute("DELETE FROM directories WHERE path = ?", (path,))
+        return resources
+
+    def refresh(self, rebuild=False):
+        """
+        Bring the index up to date with the working tree. Returns the
+        number of resources resolved again.
+        """
+        environments = self.get_environments()
+        branches = self.get_branches(environments)
+        stamp = self.get_stamp(branches)
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute("SELECT value FROM meta WHERE name = 'stamp'").fetchone()
+            if rebuild or row is None or row["value"] != stamp:
+                self.db.execute("DELETE FROM resources")
+                self.db.execute("DELETE FROM contexts")
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('stamp', ?)", (stamp,))
+            if rebuild:
+                self.db.execute("DELETE FROM directories")
+            resources = self.scan()
+            stored = dict((row["resource"], row["stamp"]) for row in self.db.execute("SELECT * FROM resources"))
+            for resource in set(stored) - set(resources):
+                self.db.execute("DELETE FROM resources WHERE resource = ?", (resource,))
+                self.db.execute("DELETE FROM contexts WHERE resource = ?", (resource,))
+
+            changed = [resource for resource, (resource_stamp, env_files) in sorted(resources.items())
+                       if resource_stamp is None or stored.get(resource) != json.dumps(resource_stamp)]
+            resolvers = dict((branch, Resolver(self.repo_root, branch, self.resolver.config, self.resolver.repository["repo_url"], self.resolver.hcl_cache_dir))
+                             for environment in branches for branch in branches[environment])
+            for resource in changed:
+                resource_stamp, env_files = resources[resource]
+                self.db.execute("DELETE FROM contexts WHERE resource = ?", (resource,))
+                for environment in sorted(branches):
+                    for site in [None] + environments[environment]:
+                        file_preffix = "{}_{}".format(environment, site) if site else environment
+                        if "env_{}.tfvars".format(file_preffix) not in env_files:
+                            continue
+                        for branch in branches[environment]:
+                            self.db.execute("INSERT INTO contexts VALUES ({})".format(", ".join("?" * len(context_columns))),
+                                            self.get_row(resolvers[branch], resource, branch, environment, site))
+                self.db.execute("INSERT OR REPLACE INTO resources VALUES (?, ?)", (resource, json.dumps(resource_stamp) if resource_stamp else None))
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            raise
+        return len(changed)
+
+    def get_row(self, resolver, resource, branch, environment, site):
+        def relative(path):
+            return os.path.relpath(path, self.repo_root).replace('\\', '/')
+
+        try:
+            context = resolver.resolve(resource, site)
+        except ResolutionError as e:
+            return (resource, branch, environment, site or '', None, None, None, None, None, None, None, None, None, None, str(e))
+        is_global = context.global_resource == "true" or any(word in context.resource for word in global_resources)
+        return (resource, branch, environment, site or '', relative(context.common_shell_file), relative(context.common_env_file),
+                relative(context.local_env_file), context.region, context.prefix, context.module, context.backend_type,
+                context.bucket, context.bucket_key, int(is_global), None)
+
+    def query(self, resource=None, branch=None, environment=None, site=None, backend=None, bucket=None, bucket_key=None, is_global=None, errors=False):
+        """
+        Return the indexed contexts matching every given filter, as
+        dictionaries. resource matches the resource directory and the
+        directories under it, and site '' the default target.
+        """
+        clauses = ["error IS NOT NULL" if errors else "error IS NULL"]
+        params = []
+        if resource:
+            resource = resource.strip('/').replace('\\', '/')
+            clauses.append("(resource = ? OR substr(resource, 1, ?) = ?)")
+            params += [resource, len(resource) + 1, resource + "/"]
+        for column, value in (("branch", branch), ("environment", environment), ("site", site), ("backend_type", backend), ("bucket", bucket), ("bucket_key", bucket_key)):
+            if value is not None:
+                clauses.append("{} = ?".format(column))
+                params.append(value)
+        if is_global is not None:
+            clauses.append("global_resource = ?")
+            params.append(int(is_global))
+        rows = self.db.execute("SELECT * FROM contexts WHERE {} ORDER BY resource, environment, branch, site".format(" AND ".join(clauses)), params)
+        return [dict((column, bool(row[column]) if column == 'global_resource' and row[column] is not None else row[column]) for column in context_columns) for row in rows]
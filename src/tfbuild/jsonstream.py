@@ -0,0 +1,143 @@
+#!/usr/bin/python3 -u
+
+import codecs
+import json
+import re
+
+class JSONStream(object):
+    """
+    Incremental JSON reader, yielding the values found at selected
+    paths of a document without loading the whole document in memory.
+
+    Paths are tuples of object keys, with 'item' standing for any array
+    element, ie: ('values', 'root_module', 'resources', 'item').
+    Selected values are decoded whole, everything else is only scanned.
+    """
+    string_re = re.compile(r'(?:[^"\\]|\\.)*"', re.S)
+    scalar_re = re.compile(r'[^\s,\]}]*')
+    whitespace_re = re.compile(r'\s*')
+
+    def __init__(self, fp, chunk_size=65536):
+        self.fp = fp
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+        self.bytes_decoder = codecs.getincrementaldecoder('utf-8')()
+
+    def read(self):
+        """
+        Append the next chunk to the buffer, dropping consumed data.
+        Returns False at the end of the stream.
+        """
+        if self.eof:
+            return False
+        while True:
+            chunk = self.fp.read(self.chunk_size)
+            data = self.bytes_decoder.decode(chunk, final=not chunk) if isinstance(chunk, bytes) else chunk
+            if data or not chunk:
+                break
+        if not data:
+            self.eof = True
+            return False
+        self.buffer = self.buffer[self.pos:] + data
+        self.pos = 0
+        return True
+
+    def peek(self):
+        while True:
+            self.pos = self.whitespace_re.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self.read():
+                return ''
+
+    def read_string(self):
+        """
+        Read the string starting at the current quote and return it
+        decoded.
+        """
+        while True:
+            match = self.string_re.match(self.buffer, self.pos + 1)
+            if match and match.end() <= len(self.buffer):
+                raw = self.buffer[self.pos:match.end()]
+                self.pos = match.end()
+                return json.loads(raw)
+            if not self.read():
+                raise ValueError("Unterminated JSON string")
+
+    def skip_scalar(self):
+        while True:
+            match = self.scalar_re.match(self.buffer, self.pos)
+            if match.end() < len(self.buffer) or not self.read():
+                self.pos = match.end()
+                return
+
+    def decode_value(self):
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+                if end < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            if not self.read():
+                value, self.pos = self.decoder.raw_decode(self.buffer, self.pos)
+                return value
+
+    def items(self, match):
+        """
+        Yield (path, value) for every value whose path satisfies the
+        match callable.
+        """
+        stack = []
+        path = []
+        expect_value = True
+        while True:
+            char = self.peek()
+            if char == '':
+                return
+            if expect_value:
+                if match(tuple(path)):
+                    yield tuple(path), self.decode_value()
+                    expect_value = False
+                elif char == '{':
+                    self.pos += 1
+                    stack.append('object')
+                    path.append(None)
+                    expect_value = False
+                    continue
+                elif char == '[':
+                    self.pos += 1
+                    stack.append('array')
+                    path.append('item')
+                    expect_value = self.peek() != ']'
+                    continue
+                elif char == '"':
+                    self.read_string()
+                    expect_value = False
+                else:
+                    self.skip_scalar()
+                    expect_value = False
+                continue
+
+            if char == ',':
+                self.pos += 1
+                expect_value = stack[-1] == 'array'
+            elif char == '"' and stack and stack[-1] == 'object':
+                path[-1] = self.read_string()
+                if self.peek() != ':':
+                    raise ValueError("Invalid JSON object at position {}".format(self.pos))
+                self.pos += 1
+                expect_value = True
+            elif char in '}]':
+                self.pos += 1
+                stack.pop()
+                path.pop()
+                if not stack:
+                    return
+            else:
+                raise ValueError("Unexpected character {!r} in JSON stream".format(char))
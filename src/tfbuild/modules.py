@@ -0,0 +1,294 @@
+#!/usr/bin/python3 -u
+
+from .cache import file_lock, get_user_cache_dir, write_json
+from .providers import get_blocks, strip_comments
+import hashlib
+import json
+import os
+import re
+import shutil
+import stat
+import time
+
+module_re = re.compile(r'^\s*module\s+"([^"]+)"\s*\{', re.M)
+exact_version_re = re.compile(r'^\s*=?\s*v?\d+\.\d+\.\d+[^\s,]*\s*$')
+max_depth = 32
+
+def get_attribute(body, name):
+    match = re.search(r'^\s*{}\s*=\s*"([^"]*)"'.format(name), body, re.M)
+    return match.group(1) if match else None
+
+def is_local_source(source):
+    return source.startswith(('./', '../', '.\\', '..\\'))
+
+def get_module_calls(directory):
+    """
+    Return the (name, source, version) module calls of a Terraform
+    module directory, in HCL or JSON syntax.
+    """
+    calls = []
+    for file_name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, file_name)
+        if not os.path.isfile(path):
+            continue
+        if file_name.endswith('.tf'):
+            with open(path, 'r', errors='replace') as fp:
+                content = strip_comments(fp.read())
+            for match, body in get_blocks(content, module_re):
+                source = get_attribute(body, 'source')
+                if source:
+                    calls.append((match.group(1), source, get_attribute(body, 'version')))
+        elif file_name.endswith('.tf.json'):
+            try:
+                with open(path, 'r', errors='replace') as fp:
+                    modules = json.load(fp).get('module', {})
+            except (ValueError, AttributeError):
+                continue
+            for block in modules if isinstance(modules, list) else [modules]:
+                for name, module in block.items():
+                    if isinstance(module, dict) and module.get('source'):
+                        calls.append((name, module['source'], module.get('version')))
+    return calls
+
+def set_writable(path, writable=True):
+    """
+    Add or remove the write permissions of a directory tree, files and
+    directories, leaving symbolic links alone.
+    """
+    for root, dirs, files in os.walk(path):
+        for name in [root] + [os.path.join(root, file_name) for file_name in files]:
+            if os.path.islink(name):
+                continue
+            mode = os.stat(name).st_mode
+            os.chmod(name, mode | stat.S_IWUSR if writable else mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+def remove_tree(path):
+    if os.path.islink(path) or os.path.isfile(path):
+        os.remove(path)
+    elif os.path.isdir(path):
+        set_writable(path)
+        shutil.rmtree(path)
+
+def link_tree(source, target):
+    """
+    Replicate a read-only cached module directory with a symbolic
+    link, so no file is shared with the resource, or with a writable
+    copy where symbolic links are not supported, ie: on Windows with
+    no developer mode.
+    """
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    try:
+        os.symlink(source, target, target_is_directory=True)
+    except OSError:
+        shutil.copytree(source, target, symlinks=True)
+        set_writable(target)
+
+def get_requirements_key(location):
+    """
+    Key of what a backend-less terraform init installs for a resource
+    directory: the module calls and provider requirements of the
+    resource and of its local modules, at the same relative paths, and
+    its dependency lock file. Resources with the same key can share one
+    initialized data directory.
+    """
+    from .plancache import get_module_dirs
+    from .providers import parse_required_providers
+    location = os.path.realpath(location)
+    digest = hashlib.sha256()
+    for directory in get_module_dirs(location):
+        requirements = []
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith(('.tf', '.tf.json')) and os.path.isfile(os.path.join(directory, file_name)):
+                requirements += parse_required_providers(os.path.join(directory, file_name))
+        relative_path = os.path.relpath(directory, location).replace('\\', '/')
+        digest.update(json.dumps([relative_path, get_module_calls(directory), sorted(requirements, key=lambda item: (item[0], item[1] or ''))]).encode())
+    lock_file = os.path.join(location, '.terraform.lock.hcl')
+    if os.path.isfile(lock_file):
+        with open(lock_file, 'rb') as fp:
+            digest.update(b"\0lock\0" + fp.read())
+    return digest.hexdigest()
+
+class ModuleCache(object):
+    """
+    Content-addressed cache of the remote modules downloaded by
+    terraform init and get, shared by every resource. A module is
+    stored once per source address and version or ref, and linked into
+    the modules directory of the resources calling it, with a matching
+    modules.json manifest, so terraform init finds it installed.
+
+    Modules not cached yet are downloaded by Terraform as usual, and
+    added to the cache after a successful init. Cached packages are
+    read-only, and linked with symbolic links, so a module edited in a
+    resource never changes the cache. A module call with a version
+    range is downloaded again once its entry is older than
+    TFBUILD_MODULE_CACHE_TTL seconds, so Terraform resolves the range
+    again, ie: ~> 3.0 picks up 3.1. TFBUILD_MODULE_CACHE=false disables
+    the cache.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir or get_user_cache_dir("modules")
+        self.enabled = os.environ.get('TFBUILD_MODULE_CACHE', 'true').lower() != 'false'
+        self.ttl = int(os.environ.get('TFBUILD_MODULE_CACHE_TTL', '86400'))
+        self.index_file = os.path.join(self.cache_dir, "index.json")
+        self.lock_file = os.path.join(self.cache_dir, ".lock")
+
+    def get_call_key(self, source, version):
+        """
+        Key a module call by its source and version constraint, as
+        written in the configuration.
+        """
+        return hashlib.sha256("{}\0{}".format(source, version or '').encode()).hexdigest()
+
+    def is_expired(self, entry, version):
+        """
+        Check if the version a module call range resolved to must be
+        resolved again. Exact versions and Git refs never expire.
+        """
+        if not version or exact_version_re.match(version):
+            return False
+        return time.time() - entry.get("updated", 0) > self.ttl
+
+    def get_content_key(self, record):
+        """
+        Key a module package by the source address and the version
+        Terraform resolved and recorded in its manifest. Git refs are
+        part of the source address.
+        """
+        return hashlib.sha256("{}\0{}".format(record["Source"], record.get("Version") or '').encode()).hexdigest()
+
+    def load_index(self):
+        try:
+            with open(self.index_file, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def load_manifest(self, modules_dir):
+        try:
+            with open(os.path.join(modules_dir, "modules.json"), 'r') as fp:
+                return dict((record["Key"], record) for record in json.load(fp).get("Modules", []))
+        except (OSError, ValueError, KeyError, TypeError, AttributeError):
+            return {}
+
+    def walk(self, location, resolve):
+        """
+        Follow the module calls of a resource, local modules included,
+        and return the manifest records. resolve(key, source, version)
+        returns the record of a remote module call, or None when it is
+        not installed.
+        """
+        records = [{"Key": "", "Source": "", "Dir": "."}]
+        pending = [("", ".")]
+        while pending:
+            prefix, record_dir = pending.pop(0)
+            directory = os.path.join(location, record_dir)
+            if not os.path.isdir(directory) or prefix.count('.') > max_depth:
+                continue
+            for name, source, version in get_module_calls(directory):
+                key = prefix + name
+                if is_local_source(source):
+                    record = {"Key": key, "Source": source, "Dir": os.path.normpath(os.path.join(record_dir, source))}
+                else:
+                    record = resolve(key, source, version)
+                if record:
+                    records.append(record)
+                    pending.append((key + ".", record["Dir"]))
+        return records
+
+    def get_record_dir(self, location, path):
+        relative_path = os.path.relpath(path, location)
+        return path if relative_path.startswith('..') else relative_path
+
+    def link(self, location, data_dir):
+        """
+        Link the cached modules called by a resource into its modules
+        directory, and record them in its manifest. Modules already
+        installed are kept. Returns the keys of the linked modules and
+        of the modules left for Terraform to download.
+        """
+        modules_dir = os.path.join(data_dir, "modules")
+        manifest = self.load_manifest(modules_dir)
+        linked = []
+        missing = []
+        with file_lock(self.lock_file, shared=True):
+            index = self.load_index()
+
+            def resolve(key, source, version):
+                record = manifest.get(key)
+                if record and record.get("Dir") and os.path.isdir(os.path.join(location, record["Dir"])):
+                    return record
+                entry = index.get(self.get_call_key(source, version))
+                content = entry and os.path.join(self.cache_dir, entry["content"])
+                if not entry or not os.path.isdir(content) or self.is_expired(entry, version):
+                    missing.append(key)
+                    return None
+                target = os.path.join(modules_dir, key)
+                remove_tree(target)
+                link_tree(content, target)
+                linked.append(key)
+                record = {
+                    "Key": key,
+                    "Source": entry["source"],
+                    "Dir": self.get_record_dir(location, os.path.normpath(os.path.join(target, entry["subdir"])))
+                }
+                if entry.get("version"):
+                    record["Version"] = entry["version"]
+                return record
+
+            records = self.walk(location, resolve)
+        if linked:
+            write_json(os.path.join(modules_dir, "modules.json"), {"Modules": records})
+        return linked, missing
+
+    def save(self, location, data_dir, refresh=False):
+        """
+        Add the remote modules installed by Terraform for a resource to
+        the cache. refresh replaces the cached packages, ie: after a
+        terraform get -update. Returns the number of packages stored.
+        """
+        modules_dir = os.path.join(data_dir, "modules")
+        manifest = self.load_manifest(modules_dir)
+        packages = {}
+
+        def resolve(key, source, version):
+            record = manifest.get(key)
+            if not record or not record.get("Dir"):
+                return None
+            package = os.path.join(modules_dir, key)
+            subdir = os.path.relpath(os.path.normpath(os.path.join(location, record["Dir"])), package)
+            if os.path.isdir(package) and not subdir.startswith('..'):
+                packages[self.get_call_key(source, version)] = (record, package, subdir)
+            return record
+
+        self.walk(location, resolve)
+        if not packages:
+            return 0
+        stored = 0
+        with file_lock(self.lock_file):
+            index = self.load_index()
+            for call_key, (record, package, subdir) in packages.items():
+                content = self.get_content_key(record)
+                path = os.path.join(self.cache_dir, content)
+                linked = os.path.islink(package)
+                if not os.path.isdir(path) or (refresh and not linked):
+                    temp_path = "{}.{}.tmp".format(path, os.getpid())
+                    remove_tree(temp_path)
+                    shutil.copytree(package, temp_path, symlinks=True, ignore=shutil.ignore_patterns('.git'))
+                    set_writable(temp_path, False)
+                    if os.path.isdir(path):
+                        old_path = "{}.{}.old".format(path, os.getpid())
+                        os.rename(path, old_path)
+                        os.rename(temp_path, path)
+                        try:
+                            remove_tree(old_path)
+                        except OSError:
+                            pass
+                    else:
+                        os.rename(temp_path, path)
+                    stored += 1
+                previous = index.get(call_key) or {}
+                # A linked package was not resolved again by Terraform.
+                updated = previous.get("updated", 0) if linked and previous.get("content") == content else time.time()
+                index[call_key] = {"source": record["Source"], "version": record.get("Version"), "content": content, "subdir": subdir, "updated": updated}
+            write_json(self.index_file, index)
+        return stored
@@ -0,0 +1,242 @@
+#!/usr/bin/python3 -u
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from py_console import console
+import os
+import sys
+import time
+
+def find_resources(repo_root, file_prefix):
+    """
+    Walk the repository and return every resource directory, relative
+    to the repository root, holding Terraform files and a matching
+    environments/env_<file_prefix>.tfvars file.
+    """
+    resources = []
+    for root, dirs, files in os.walk(repo_root):
+        dirs[:] = sorted(d for d in dirs if not d.startswith('.') and d != 'environments' and not (root == repo_root and d == 'common'))
+        if root == repo_root:
+            continue
+        local_env_file = os.path.join(root, "environments", "env_{}.tfvars".format(file_prefix))
+        if os.path.isfile(local_env_file) and any(File.endswith(".tf") for File in files):
+            resources.append(os.path.relpath(root, repo_root).replace('\\', '/'))
+    return resources
+
+def run_resource(job):
+    """
+    Run a single tfbuild action inside a resource directory.
+    Executed in a pool worker process, so the working directory,
+    sys.argv and the standard descriptors can be swapped freely.
+    """
+    from .actions import Action
+    from .profiler import Profiler
+    from .report import RunReport
+
+    start = time.time()
+    result = {"name": job["name"], "resource": job["resource"], "site": job["target_environment"], "log": job["log"], "returncode": 0}
+    report = RunReport(job["action"], job["target_environment"], path=os.path.splitext(job["log"])[0] + ".json")
+    profiler = Profiler(os.path.splitext(job["log"])[0] + ".prof") if os.environ.get("TFBUILD_PROFILE") else None
+    os.makedirs(os.path.dirname(job["log"]), exist_ok=True)
+    with open(job["log"], 'w') as log, open(os.devnull, 'r') as devnull:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_fds = [os.dup(fd) for fd in (0, 1, 2)]
+        os.dup2(devnull.fileno(), 0)
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        if profiler:
+            profiler.start()
+        try:
+            os.chdir(job["location"])
+            os.environ.update(job.get("env", {}))
+            os.environ["TF_DATA_DIR"] = job["data_dir"]
+            sys.argv = job["argv"]
+            with report.phase("context"):
+                current_action = Action(job["action"], job["target_environment"], report=report)
+            getattr(current_action, job["action"])()
+        except SystemExit as e:
+            if e.code is None or isinstance(e.code, int):
+                report.exit_code = e.code or 0
+            else:
+                print(e.code)
+                report.exit_code = 1
+        except Exception as e:
+            print("  {}: {}".format(type(e).__name__, e))
+            report.exit_code = 1
+        finally:
+            if profiler:
+                profiler.stop(report)
+            result["returncode"] = report.returncode
+            result["phases"] = report.phases
+            result["details"] = report.details
+            report.finish()
+            sys.stdout.flush()
+            sys.stderr.flush()
+            for fd, saved_fd in zip((0, 1, 2), saved_fds):
+                os.dup2(saved_fd, fd)
+                os.close(saved_fd)
+    result["duration"] = time.time() - start
+    return result
+
+class Orchestrator(object):
+    """
+    Run the same tfbuild action across many resource directories, or
+    many sites of a resource, in a bounded pool of worker processes. Every worker gets its own
+    working directory, TF_DATA_DIR and log file.
+    """
+    def __init__(self, repo_root, log_dir, concurrency):
+        self.repo_root = repo_root
+        self.log_dir = log_dir
+        self.concurrency = max(1, int(concurrency))
+
+    def get_jobs(self, resources, action, target_environment, argv):
+        jobs = []
+        for resource in resources:
+            location = os.path.join(self.repo_root, resource)
+            jobs.append({
+                "name": resource,
+                "resource": resource,
+                "location": location,
+                "data_dir": os.path.join(location, ".terraform"),
+                "log": os.path.join(self.log_dir, resource.replace('/', '_') + ".log"),
+                "action": action,
+                "target_environment": target_environment,
+                "argv": argv,
+            })
+        return jobs
+
+    def get_site_data_dir(self, resource, site):
+        """
+        TF_DATA_DIR of a resource and site (None for the default
+        context) run next to other sites of the resource, under the
+        repository tfbuild cache, so cleaning the resource .terraform
+        leaves it alone.
+        """
+        return os.path.join(self.repo_root, ".tfbuild", "sites", resource.replace('/', '_'), site or "default")
+
+    def get_site_jobs(self, resource, sites, action, argv, env=None):
+        """
+        Jobs running the action for several sites of the same resource,
+        None being the default context, each with its own TF_DATA_DIR.
+        """
+        location = os.path.join(self.repo_root, resource)
+        jobs = []
+        for site in sites:
+            jobs.append({
+                "name": site or "default",
+                "resource": resource,
+                "location": location,
+                "data_dir": self.get_site_data_dir(resource, site),
+                "log": os.path.join(self.log_dir, (site or "default") + ".log"),
+                "action": action,
+                "target_environment": site,
+                "argv": argv,
+                "env": env or {},
+            })
+        return jobs
+
+    def get_matrix_jobs(self, targets, action, argv, env=None):
+        """
+        Jobs running the action for (resource, site) pairs, possibly
+        several sites of the same resource at the same time, so every
+        pair gets its own TF_DATA_DIR.
+        """
+        jobs = []
+        for resource, site in targets:
+            location = os.path.join(self.repo_root, resource)
+            name = "{}:{}".format(resource, site) if site else resource
+            jobs.append({
+                "name": name,
+                "resource": resource,
+                "location": location,
+                "data_dir": self.get_site_data_dir(resource, site),
+                "log": os.path.join(self.log_dir, name.replace('/', '_').replace(':', '-') + ".log"),
+                "action": action,
+                "target_environment": site,
+                "argv": argv,
+                "env": env or {},
+            })
+        return jobs
+
+    def get_skipped_result(self, resource, target_environment):
+        """
+        Result of a resource not run, as a dependency or, with
+        fail_fast, another job failed.
+        """
+        return {"name": resource, "resource": resource, "site": target_environment, "log": "-", "returncode": 1, "status": "skipped", "duration": 0.0, "phases": [], "details": {}}
+
+    def run(self, jobs, success_codes=(0,), fail_fast=False):
+        """
+        Execute the jobs and return the results in job order. Jobs
+        exiting with one of the success codes are reported as finished.
+        Jobs are started as workers free up, so with fail_fast the jobs
+        not started yet when a job fails are reported as skipped.
+        """
+        results = {}
+        pending = list(jobs)
+        failed = False
+        with ProcessPoolExecutor(max_workers=min(self.concurrency, len(jobs) or 1)) as executor:
+            futures = {}
+            while pending or futures:
+                while pending and len(futures) < self.concurrency and not (fail_fast and failed):
+                    job = pending.pop(0)
+                    futures[executor.submit(run_resource, job)] = job
+                if not futures:
+                    break
+                done, not_done = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = futures.pop(future)
+                    try:
+                        result = future.result()
+                    except Exception as e:
+                        result = {"name": job["name"], "resource": job["resource"], "site": job["target_environment"], "log": job["log"], "returncode": 1, "duration": 0.0, "phases": [], "details": {}}
+                        console.error("  {}: {}".format(job["name"], e), showTime=False)
+                    results[job["name"]] = result
+                    if result["returncode"] in success_codes:
+                        console.success("  Finished {name} in {duration:.1f}s".format(**result), showTime=False)
+                    else:
+                        failed = True
+                        console.error("  Failed {name} in {duration:.1f}s (exit code {returncode})".format(**result), showTime=False)
+        for job in pending:
+            results[job["name"]] = dict(self.get_skipped_result(job["resource"], job["target_environment"]), name=job["name"])
+            console.error("  Skipped {}".format(job["name"]), showTime=False)
+        return [results[job["name"]] for job in jobs]
+
+    def output(self, results):
+        """
+        Display the output of every job, grouped and prefixed by job name.
+        """
+        for result in results:
+            console.warn("\n  ==> " + result["name"], showTime=False)
+            try:
+                with open(result["log"], 'r', errors='replace') as fp:
+                    for line in fp:
+                        sys.stdout.write("[{}] {}\n".format(result["name"], line.rstrip('\n')))
+            except OSError:
+                pass
+            sys.stdout.flush()
+
+    def summary(self, results, title="Resource"):
+        """
+        Display a per-job summary and return the number of failures.
+        """
+        failures = [result for result in results if result["returncode"] != 0]
+        width = max([len(result["name"]) for result in results] + [len(title)])
+        console.warn("\n  Summary", showTime=False)
+        console.warn("  =======", showTime=False)
+        console.warn("  {:<{width}}  {:<7}  {:>9}  {}".format(title, "Status", "Duration", "Log", width=width), showTime=False)
+        for result in results:
+            line = "  {:<{width}}  {:<7}  {:>8.1f}s  {}".format(
+                result["name"],
+                result.get("status") or ("ok" if result["returncode"] == 0 else "failed"),
+                result["duration"],
+                result["log"],
+                width=width
+            )
+            if result["returncode"] == 0:
+                console.success(line, showTime=False)
+            else:
+                console.error(line, showTime=False)
+        skipped = len([result for result in failures if result.get("status") == "skipped"])
+        console.warn("\n  {} {}s, {} failed{}\n".format(len(results), title.lower(), len(failures) - skipped, ", {} skipped".format(skipped) if skipped else ""), showTime=False)
+        return len(failures)
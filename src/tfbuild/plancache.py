@@ -0,0 +1,189 @@
+#!/usr/bin/python3 -u
+
+from .cache import write_json
+import hashlib
+import json
+import os
+import re
+import shlex
+import time
+
+source_re = re.compile(r'(?:^|[{,])\s*"?source"?\s*[=:]\s*"(\.{1,2}/[^"]*)"', re.M)
+runtime_options = ['-no-color', '-compact-warnings', '-detailed-exitcode', '-input', '-lock', '-lock-timeout', '-parallelism', '-json', '-auto-approve']
+variable_options = ['-var', '-var-file']
+
+def get_option_name(arg):
+    return arg.split('=', 1)[0]
+
+def split_args(args):
+    """
+    Split Terraform plan/apply arguments into the ones shaping the
+    plan, and the runtime ones, only changing how it is run or shown.
+    """
+    plan_args = [arg for arg in args if get_option_name(arg) not in runtime_options]
+    return plan_args, [arg for arg in args if get_option_name(arg) in runtime_options]
+
+def split_cli_args(tf_cli_args):
+    """
+    Split TF_CLI_ARGS into its variable options, not accepted when
+    applying a saved plan, and the other options.
+    """
+    variables = []
+    others = []
+    items = shlex.split(tf_cli_args or '')
+    while items:
+        item = items.pop(0)
+        if get_option_name(item) in variable_options:
+            variables.append(item if '=' in item or not items else item + '=' + items.pop(0))
+        else:
+            others.append(item)
+    return variables, others
+
+def get_module_dirs(location):
+    """
+    Return a resource directory and the local module directories it
+    references (source = "./..." or "../...", in HCL or JSON syntax),
+    following nested local modules.
+    """
+    directories = []
+    pending = [os.path.realpath(location)]
+    while pending:
+        directory = pending.pop()
+        if directory in directories or not os.path.isdir(directory):
+            continue
+        directories.append(directory)
+        for file_name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, file_name)
+            if file_name.endswith((".tf", ".tf.json")) and os.path.isfile(path):
+                with open(path, 'r', errors='replace') as fp:
+                    for source in source_re.findall(fp.read()):
+                        pending.append(os.path.realpath(os.path.join(directory, source)))
+    return directories
+
+def get_config_files(location):
+    """
+    Return the Terraform files of a resource directory and of the
+    local modules it references.
+    """
+    files = []
+    for directory in get_module_dirs(location):
+        for file_name in os.listdir(directory):
+            path = os.path.join(directory, file_name)
+            if file_name.endswith((".tf", ".tf.json", ".tftpl")) and os.path.isfile(path):
+                files.append(path)
+    return sorted(files)
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    try:
+        with open(path, 'rb') as fp:
+            for chunk in iter(lambda: fp.read(65536), b''):
+                digest.update(chunk)
+    except OSError:
+        return None
+    return digest.hexdigest()
+
+class PlanStore(object):
+    """
+    Content-addressed store of saved Terraform plans, under the
+    repository cache. A plan is keyed by everything it was computed
+    from: configuration files, var files, TF_VAR_* and TF_CLI_ARGS*
+    environment variables, backend and plan arguments, so a later
+    apply can reuse it only when nothing changed.
+
+    Entries expire after TFBUILD_PLAN_CACHE_TTL seconds, and the
+    oldest ones are evicted above TFBUILD_PLAN_CACHE_SIZE megabytes.
+    """
+    version = 1
+
+    def __init__(self, store_dir, ttl=None, max_size=None):
+        self.store_dir = store_dir
+        self.enabled = os.environ.get('TFBUILD_PLAN_CACHE', 'true').lower() != 'false'
+        self.ttl = int(ttl if ttl is not None else os.environ.get('TFBUILD_PLAN_CACHE_TTL', 3600))
+        self.max_size = int(max_size if max_size is not None else os.environ.get('TFBUILD_PLAN_CACHE_SIZE', 512)) * 1024 * 1024
+
+    def get_key(self, location, var_files, env, backend, args):
+        """
+        Hash the inputs of a plan into the store key.
+        """
+        key = {
+            "version": self.version,
+            "location": os.path.realpath(location),
+            "config": [[os.path.relpath(path, location), file_hash(path)] for path in get_config_files(location)],
+            "lock": file_hash(os.path.join(location, '.terraform.lock.hcl')),
+            "var_files": [[path, file_hash(path)] for path in var_files],
+            "env": sorted([name, value] for name, value in env.items() if name.startswith(('TF_VAR_', 'TF_CLI_ARGS', 'TF_WORKSPACE'))),
+            "backend": backend,
+            "args": list(args),
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()
+
+    def get_plan_file(self, key):
+        return os.path.join(self.store_dir, key + ".tfplan")
+
+    def get_temp_file(self, key):
+        return os.path.join(self.store_dir, "{}.{}.tmp".format(key, os.getpid()))
+
+    def lookup(self, key):
+        """
+        Return the saved plan file matching the key, or None if
+        missing or expired.
+        """
+        if not self.enabled:
+            return None
+        plan_file = self.get_plan_file(key)
+        try:
+            if time.time() - os.stat(plan_file).st_mtime > self.ttl:
+                self.discard(key)
+                return None
+        except OSError:
+            return None
+        return plan_file
+
+    def save(self, key, temp_file, metadata):
+        """
+        Move a plan written by terraform plan -out into the store.
+        """
+        os.replace(temp_file, self.get_plan_file(key))
+        write_json(os.path.join(self.store_dir, key + ".json"), dict(metadata, created=time.time()))
+        self.evict()
+
+    def discard(self, key):
+        for path in (self.get_plan_file(key), os.path.join(self.store_dir, key + ".json"), self.get_temp_file(key)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def evict(self):
+        """
+        Remove the expired plans, then the oldest ones until the store
+        fits its size limit. Entries removed by a concurrent process
+        are ignored.
+        """
+        entries = []
+        now = time.time()
+        for file_name in os.listdir(self.store_dir):
+            path = os.path.join(self.store_dir, file_name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            key = file_name.split('.', 1)[0]
+            if file_name.endswith(".tmp"):
+                if now - st.st_mtime > self.ttl:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+            elif file_name.endswith(".tfplan"):
+                if now - st.st_mtime > self.ttl:
+                    self.discard(key)
+                else:
+                    entries.append((st.st_mtime, st.st_size, key))
+        total = sum(entry[1] for entry in entries)
+        for mtime, size, key in sorted(entries):
+            if total <= self.max_size:
+                break
+            self.discard(key)
+            total -= size
@@ -0,0 +1,113 @@
+#!/usr/bin/python3 -u
+
+from .jsonstream import JSONStream
+from py_console import console
+import subprocess
+
+def is_change_path(path):
+    """
+    Match the resource changes and the resource drift of the
+    'terraform show -json <planfile>' output.
+    """
+    return path in (('resource_changes', 'item'), ('resource_drift', 'item'))
+
+def get_plan_changes(plan_file, env=None, cwd=None):
+    """
+    Stream the changes of a saved plan, yielding (kind, change) where
+    kind is 'resource_changes' or 'resource_drift'. No-op changes are
+    skipped. Raises CalledProcessError when the plan can't be shown.
+    """
+    process = subprocess.Popen(
+        ['terraform', 'show', '-json', plan_file],
+        stdin=subprocess.DEVNULL,
+        stdout=subprocess.PIPE,
+        env=env,
+        cwd=cwd
+        )
+    try:
+        for path, change in JSONStream(process.stdout).items(is_change_path):
+            actions = change.get('change', {}).get('actions', [])
+            if actions and actions != ['no-op']:
+                yield path[0], change
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, ['terraform', 'show', '-json', plan_file])
+
+def get_action(actions):
+    """
+    Name the action of a resource change: create, update, delete,
+    replace (delete and create in any order) or read.
+    """
+    if 'delete' in actions and 'create' in actions:
+        return 'replace'
+    return actions[0] if len(actions) == 1 else '-'.join(actions)
+
+class PlanSummary(object):
+    """
+    Summary of the resource changes of a saved plan, built while
+    streaming 'terraform show -json', so memory only grows with the
+    number of resource types, modules and destroyed resources.
+    """
+    actions = ['create', 'update', 'replace', 'delete', 'read']
+
+    def __init__(self):
+        self.total = 0
+        self.by_action = dict((action, 0) for action in self.actions)
+        self.by_type = {}
+        self.by_module = {}
+        self.destroys = []
+
+    def add(self, change):
+        action = get_action(change['change']['actions'])
+        module = change.get('module_address') or 'root'
+        self.total += 1
+        self.by_action[action] = self.by_action.get(action, 0) + 1
+        for counters, name in ((self.by_type, change.get('type')), (self.by_module, module)):
+            counter = counters.setdefault(name, {})
+            counter[action] = counter.get(action, 0) + 1
+        if action in ('delete', 'replace'):
+            self.destroys.append({'address': change['address'], 'action': action})
+
+    def load(self, plan_file, env=None, cwd=None):
+        for kind, change in get_plan_changes(plan_file, env, cwd):
+            if kind == 'resource_changes':
+                self.add(change)
+        return self
+
+    def to_dict(self):
+        return {
+            'total': self.total,
+            'by_action': self.by_action,
+            'by_type': self.by_type,
+            'by_module': self.by_module,
+            'destroys': self.destroys,
+        }
+
+    def format_counter(self, counter):
+        order = [action for action in self.actions if action in counter] + sorted(action for action in counter if action not in self.actions)
+        return ", ".join("{} {}".format(counter[action], action) for action in order if counter[action])
+
+    def display(self, limit=20):
+        """
+        Display the summary, with the largest resource types and
+        modules first.
+        """
+        console.warn("\n  Plan Summary", showTime=False)
+        console.warn("  ============", showTime=False)
+        console.success("  {} changes: {}".format(self.total, self.format_counter(self.by_action) or "none"), showTime=False)
+        for title, counters in (("Resource Type", self.by_type), ("Module", self.by_module)):
+            if not counters:
+                continue
+            console.warn("\n  {}".format(title), showTime=False)
+            ordered = sorted(counters.items(), key=lambda item: (-sum(item[1].values()), str(item[0])))
+            width = max(len(str(name)) for name, counter in ordered[:limit])
+            for name, counter in ordered[:limit]:
+                console.success("  {:<{width}}  {}".format(str(name), self.format_counter(counter), width=width), showTime=False)
+            if len(ordered) > limit:
+                console.success("  ... {} more".format(len(ordered) - limit), showTime=False)
+        if self.destroys:
+            console.warn("\n  Destroys", showTime=False)
+            for destroy in self.destroys:
+                console.error("  {:<8} {}".format(destroy['action'], destroy['address']), showTime=False)
@@ -0,0 +1,60 @@
+#!/usr/bin/python3 -u
+
+import os
+import sys
+
+class Profiler(object):
+    """
+    Opt-in profiler of the tfbuild process itself, enabled through the
+    TFBUILD_PROFILE=<path> environment variable or the --profile=<path>
+    option. Uses cProfile by default, or the pyinstrument sampling
+    profiler when TFBUILD_PROFILER=pyinstrument and it is installed.
+
+    Writes <path> (pstats dump, or pyinstrument html) and <path>.txt,
+    a text summary starting with the run report spans.
+    """
+    def __init__(self, path, engine=None):
+        self.path = path
+        self.engine = (engine or os.environ.get('TFBUILD_PROFILER', 'cprofile')).lower()
+        self.profiler = None
+        if self.engine == 'pyinstrument':
+            try:
+                import pyinstrument
+                self.profiler = pyinstrument.Profiler()
+            except ImportError:
+                sys.stderr.write("pyinstrument is not installed, profiling with cProfile\n")
+                self.engine = 'cprofile'
+        if self.profiler is None:
+            import cProfile
+            self.profiler = cProfile.Profile()
+
+    def start(self):
+        if self.engine == 'pyinstrument':
+            self.profiler.start()
+        else:
+            self.profiler.enable()
+
+    def stop(self, report=None):
+        """
+        Stop profiling and write the stats files.
+        """
+        profile_dir = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(profile_dir, exist_ok=True)
+        with open(self.path + ".txt", 'w') as fp:
+            if report is not None:
+                fp.write("Spans (ms from start / duration ms):\n")
+                for span in report.spans:
+                    fp.write("  {:<32} {:>10.2f} {:>10.2f}\n".format(span['name'], span['start'] * 1000, span['wall'] * 1000))
+                fp.write("\n")
+            if self.engine == 'pyinstrument':
+                self.profiler.stop()
+                fp.write(self.profiler.output_text())
+                with open(self.path, 'w') as html:
+                    html.write(self.profiler.output_html())
+            else:
+                import pstats
+                self.profiler.disable()
+                self.profiler.dump_stats(self.path)
+                stats = pstats.Stats(self.profiler, stream=fp)
+                stats.sort_stats('cumulative').print_stats(60)
+        sys.stderr.write("Profile written to " + self.path + "\n")
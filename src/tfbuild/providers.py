@@ -0,0 +1,361 @@
+#!/usr/bin/python3 -u
+
+from .cache import file_lock, get_user_cache_dir, write_json
+from .plancache import get_module_dirs
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+
+token_re = re.compile(r'"(?:[^"\\]|\\.)*"|#[^\n]*|//[^\n]*|/\*.*?\*/', re.S)
+block_re = re.compile(r'\brequired_providers\s*\{')
+object_entry_re = re.compile(r'([A-Za-z_][\w-]*)\s*=\s*\{([^{}]*)\}')
+string_entry_re = re.compile(r'([A-Za-z_][\w-]*)\s*=\s*"([^"]*)"')
+attribute_re = r'\b{}\s*=\s*"([^"]*)"'
+identifier_re = re.compile(r'^[A-Za-z_][\w-]*$')
+labeled_blocks = ['credentials', 'credentials_helper', 'host']
+lock_provider_re = re.compile(r'\bprovider\s+"([^"]+)"\s*\{[^{}]*?\bversion\s*=\s*"([^"]*)"', re.S)
+
+def strip_comments(text):
+    return token_re.sub(lambda match: match.group(0) if match.group(0).startswith('"') else '', text)
+
+def get_blocks(text, pattern=block_re):
+    """
+    Return the (match, body) of the blocks of an HCL document whose
+    header matches the pattern, up to the opening brace, matching
+    braces outside of strings.
+    """
+    blocks = []
+    for match in pattern.finditer(text):
+        depth = 1
+        position = match.end()
+        while depth and position < len(text):
+            char = text[position]
+            string = token_re.match(text, position) if char == '"' else None
+            if string:
+                position = string.end()
+                continue
+            depth += {'{': 1, '}': -1}.get(char, 0)
+            position += 1
+        blocks.append((match, text[match.end():position - 1]))
+    return blocks
+
+def normalize_source(name, source=None):
+    """
+    Return the fully qualified provider source address.
+    """
+    source = (source or "hashicorp/" + name).lower()
+    parts = source.split('/')
+    if len(parts) == 1:
+        parts = ['hashicorp'] + parts
+    if len(parts) == 2:
+        parts = ['registry.terraform.io'] + parts
+    return '/'.join(parts)
+
+def parse_required_providers(path):
+    """
+    Return the (source, version constraint) pairs required by a
+    Terraform file, in HCL or JSON syntax.
+    """
+    requirements = []
+    with open(path, 'r', errors='replace') as fp:
+        content = fp.read()
+    if path.endswith('.json'):
+        try:
+            terraform = json.loads(content).get('terraform', [])
+        except (ValueError, AttributeError):
+            return requirements
+        for block in terraform if isinstance(terraform, list) else [terraform]:
+            for providers in block.get('required_providers', []) if isinstance(block.get('required_providers'), list) else [block.get('required_providers', {})]:
+                for name, requirement in providers.items():
+                    if isinstance(requirement, dict):
+                        requirements.append((normalize_source(name, requirement.get('source')), requirement.get('version')))
+                    else:
+                        requirements.append((normalize_source(name), requirement))
+        return requirements
+
+    for match, body in get_blocks(strip_comments(content)):
+        for name, attributes in object_entry_re.findall(body):
+            source = re.search(attribute_re.format('source'), attributes)
+            version = re.search(attribute_re.format('version'), attributes)
+            requirements.append((normalize_source(name, source and source.group(1)), version and version.group(1)))
+        for name, version in string_entry_re.findall(object_entry_re.sub('', body)):
+            requirements.append((normalize_source(name), version))
+    return requirements
+
+def scan_required_providers(locations):
+    """
+    Return the provider requirements of resource directories and of
+    their local modules, as {(source, constraint): [resources]}.
+    """
+    requirements = {}
+    for resource, location in locations:
+        for directory in get_module_dirs(location):
+            for file_name in sorted(os.listdir(directory)):
+                if file_name.endswith(('.tf', '.tf.json')):
+                    for requirement in parse_required_providers(os.path.join(directory, file_name)):
+                        resources = requirements.setdefault(requirement, [])
+                        if resource not in resources:
+                            resources.append(resource)
+    return requirements
+
+def get_locked_versions(location):
+    """
+    Return the provider versions selected by the dependency lock file
+    of a resource directory, as {source: version}.
+    """
+    try:
+        with open(os.path.join(location, '.terraform.lock.hcl'), 'r', errors='replace') as fp:
+            content = strip_comments(fp.read())
+    except OSError:
+        return {}
+    return dict((source.lower(), version) for source, version in lock_provider_re.findall(content))
+
+def get_current_platform():
+    import platform
+    system = "windows" if sys.platform.startswith("win") else sys.platform
+    machine = platform.machine().lower()
+    return "{}_{}".format(system, {"x86_64": "amd64", "aarch64": "arm64", "i386": "386", "i686": "386"}.get(machine, machine))
+
+def get_default_mirror_dir():
+    """
+    Return the provider mirror directory owned by tfbuild, under the
+    user cache. TFBUILD_PROVIDER_MIRROR overrides it.
+    """
+    if os.environ.get('TFBUILD_PROVIDER_MIRROR'):
+        return os.environ['TFBUILD_PROVIDER_MIRROR']
+    return get_user_cache_dir("providers", "mirror")
+
+def get_cli_config_path(env):
+    """
+    Return the Terraform CLI configuration file in use: the
+    TF_CLI_CONFIG_FILE variable, or the default per-user file.
+    """
+    if env.get('TF_CLI_CONFIG_FILE'):
+        return env['TF_CLI_CONFIG_FILE']
+    if sys.platform.startswith("win"):
+        return os.path.join(env.get('APPDATA', os.path.join(os.path.expanduser("~"), "AppData", "Roaming")), "terraform.rc")
+    return os.path.join(os.path.expanduser("~"), ".terraformrc")
+
+def get_plugin_cache_dir(env):
+    """
+    Return the Terraform plugin cache directory in use: the
+    TF_PLUGIN_CACHE_DIR variable, or the CLI configuration
+    plugin_cache_dir setting, if any.
+    """
+    if env.get('TF_PLUGIN_CACHE_DIR'):
+        return env['TF_PLUGIN_CACHE_DIR']
+    try:
+        with open(get_cli_config_path(env), 'r', errors='replace') as fp:
+            match = re.search(r'"?plugin_cache_dir"?\s*[=:]\s*"((?:[^"\\]|\\.)*)"', fp.read())
+    except OSError:
+        return None
+    return match.group(1).replace('\\\\', '\\') if match else None
+
+def load_cli_config(path):
+    """
+    Parse a Terraform CLI configuration file, in HCL or JSON syntax.
+    Returns an empty configuration when the file is missing or empty,
+    and None when it can't be parsed.
+    """
+    import hcl
+    try:
+        with open(path, 'r', errors='replace') as fp:
+            content = fp.read()
+    except OSError:
+        return {}
+    if not content.strip():
+        return {}
+    try:
+        config = hcl.loads(content)
+    except ValueError:
+        return None
+    return config if isinstance(config, dict) else None
+
+def render_hcl_value(value):
+    if isinstance(value, dict):
+        return "{ " + ", ".join("{} = {}".format(json.dumps(str(key)), render_hcl_value(item)) for key, item in value.items()) + " }"
+    if isinstance(value, list):
+        return "[" + ", ".join(render_hcl_value(item) for item in value) + "]"
+    return json.dumps(value)
+
+def render_hcl(config, indent=""):
+    """
+    Render a parsed Terraform CLI configuration in HCL syntax. Objects
+    are rendered as blocks, labeled for the credentials,
+    credentials_helper and host blocks, whose object attributes are
+    maps.
+    """
+    lines = []
+    for name, value in config.items():
+        key = name if identifier_re.match(name) else json.dumps(name)
+        if name in labeled_blocks and isinstance(value, dict):
+            for label, body in value.items():
+                lines.append("{}{} {} {{".format(indent, key, json.dumps(label)))
+                lines += ["{}  {} = {}".format(indent, item if identifier_re.match(item) else json.dumps(item), render_hcl_value(body[item])) for item in body]
+                lines.append(indent + "}")
+        elif isinstance(value, dict) or isinstance(value, list) and value and all(isinstance(item, dict) for item in value):
+            for body in value if isinstance(value, list) else [value]:
+                lines.append("{}{} {{".format(indent, key))
+                if body:
+                    lines.append(render_hcl(body, indent + "  "))
+                lines.append(indent + "}")
+        else:
+            lines.append("{}{} = {}".format(indent, key, render_hcl_value(value)))
+    return "\n".join(lines)
+
+def get_mirror_environment(env, mirror_dir=None, locations=()):
+    """
+    Return the environment variables pointing the terraform commands
+    run by tfbuild to a generated CLI configuration: the configuration
+    in use, with a provider_installation block installing from the
+    tfbuild provider mirror, or from the registries for the providers
+    and versions not mirrored. The providers the resource directories
+    (locations) can install from the mirror alone are excluded from
+    the registries, so their initialization needs no network, and
+    does not pick a newer registry version over the mirrored one.
+    Terraform runs outside tfbuild are not affected. The configuration is parsed, HCL or JSON, and the
+    generated file is always HCL. It is only readable by the user, as
+    it holds the credentials of the configuration in use. Empty when
+    that configuration has its own provider_installation block, or
+    can't be parsed, so Terraform reads it as is.
+    """
+    mirror_dir = mirror_dir or get_default_mirror_dir()
+    config = load_cli_config(get_cli_config_path(env))
+    if config is None or 'provider_installation' in config:
+        return {}
+    excluded = ProviderMirror(mirror_dir).get_mirrored_sources(locations) if locations else []
+    config['provider_installation'] = {'filesystem_mirror': {'path': os.path.abspath(mirror_dir)}, 'direct': {'exclude': excluded} if excluded else {}}
+    content = render_hcl(config) + "\n"
+    config_file = os.path.join(get_user_cache_dir("providers"), hashlib.sha1(content.encode()).hexdigest() + ".tfrc")
+    if not os.path.isfile(config_file):
+        os.makedirs(mirror_dir, exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(config_file, os.getpid())
+        with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as fp:
+            fp.write(content)
+        os.replace(tmp_path, config_file)
+    return {"TF_CLI_CONFIG_FILE": config_file}
+
+class ProviderMirror(object):
+    """
+    Filesystem mirror of Terraform providers owned by tfbuild, filled
+    through terraform providers mirror, and used by the terraform
+    commands of tfbuild only, through get_mirror_environment. Writes
+    hold an exclusive lock on the mirror, and initializations a shared
+    one, so an init never reads a provider package being written.
+    """
+    def __init__(self, mirror_dir=None):
+        self.mirror_dir = mirror_dir or get_default_mirror_dir()
+        state_dir = os.path.join(get_user_cache_dir("providers"), hashlib.sha1(os.path.abspath(self.mirror_dir).encode()).hexdigest())
+        self.lock_file = state_dir + ".lock"
+        self.index_file = state_dir + ".json"
+
+    def lock(self, shared=False):
+        return file_lock(self.lock_file, shared)
+
+    def load_index(self):
+        try:
+            with open(self.index_file, 'r') as fp:
+                return json.load(fp)
+        except (OSError, ValueError):
+            return {}
+
+    def get_versions(self, source):
+        """
+        Return the mirrored versions of a provider, from the index.json
+        file written by terraform providers mirror.
+        """
+        try:
+            with open(os.path.join(self.mirror_dir, *source.split('/'), "index.json"), 'r') as fp:
+                return set(json.load(fp).get("versions") or {})
+        except (OSError, ValueError, AttributeError):
+            return set()
+
+    def get_mirrored_sources(self, locations):
+        """
+        Return the provider sources the resource directories can
+        install from the mirror alone: every constraint they require is
+        mirrored for the current platform, and the version selected by
+        their lock file, if any, is in the mirror.
+        """
+        index = self.load_index()
+        if not index:
+            return []
+        current = get_current_platform()
+        mirrored = set()
+        for key in index:
+            requirement, platforms = key.rsplit(" ", 1)
+            if platforms == "current" or current in platforms.split(","):
+                mirrored.add(requirement)
+        sources = {}
+        for source, constraint in scan_required_providers([(location, location) for location in locations]):
+            sources[source] = sources.get(source, True) and "{} {}".format(source, constraint or '*') in mirrored
+        for location in locations:
+            for source, version in get_locked_versions(location).items():
+                if sources.get(source) and version not in self.get_versions(source):
+                    sources[source] = False
+        return sorted(source for source, mirror_only in sources.items() if mirror_only)
+
+    def get_index_key(self, source, constraint, platforms):
+        return "{} {} {}".format(source, constraint or '*', ",".join(sorted(platforms)) or "current")
+
+    def mirror(self, source, constraint, platforms, env=None):
+        """
+        Mirror the provider versions matching a constraint, through a
+        temporary configuration requiring only that provider.
+        """
+        work_dir = tempfile.mkdtemp(prefix="tfbuild-mirror-")
+        try:
+            requirement = {"source": source}
+            if constraint:
+                requirement["version"] = constraint
+            with open(os.path.join(work_dir, "main.tf.json"), 'w') as fp:
+                json.dump({"terraform": {"required_providers": {source.split('/')[-1]: requirement}}}, fp)
+            process = subprocess.run(
+                ['terraform', 'providers', 'mirror'] + ['-platform=' + platform for platform in platforms] + [self.mirror_dir],
+                cwd=work_dir,
+                env=env,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT
+                )
+            return "mirrored" if process.returncode == 0 else "failed", process.stdout.decode(errors='replace')
+        finally:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    def warm(self, requirements, platforms=None, concurrency=4, refresh=False, env=None):
+        """
+        Mirror every (source, constraint) requirement not mirrored yet,
+        the constraints of a provider one after the other, different
+        providers in parallel. Returns {(source, constraint): (status,
+        output)}, the status being cached, mirrored or failed.
+        """
+        platforms = platforms or []
+        results = {}
+        os.makedirs(self.mirror_dir, exist_ok=True)
+        with self.lock():
+            index = self.load_index()
+            by_source = {}
+            for source, constraint in sorted(requirements, key=lambda item: (item[0], item[1] or '')):
+                if not refresh and self.get_index_key(source, constraint, platforms) in index:
+                    results[(source, constraint)] = ("cached", "")
+                else:
+                    by_source.setdefault(source, []).append(constraint)
+
+            def warm_source(source):
+                for constraint in by_source[source]:
+                    results[(source, constraint)] = self.mirror(source, constraint, platforms, env)
+
+            with ThreadPoolExecutor(max_workers=max(1, concurrency)) as executor:
+                list(executor.map(warm_source, by_source))
+
+            for (source, constraint), (status, output) in results.items():
+                if status == "mirrored":
+                    index[self.get_index_key(source, constraint, platforms)] = True
+            write_json(self.index_file, index)
+        return results
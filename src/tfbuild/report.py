@@ -0,0 +1,188 @@
+#!/usr/bin/python3 -u
+
+from contextlib import contextmanager
+import os
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+def get_children_cpu():
+    """
+    Return the CPU time (user, system) consumed so far by the waited
+    for child processes, or None where rusage is not available.
+    """
+    if resource is None:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime, usage.ru_stime
+
+def tee(source, target, counter, index):
+    """
+    Copy a child process stream to our own stream, counting bytes.
+    """
+    while True:
+        chunk = source.read1(65536) if hasattr(source, 'read1') else source.read(65536)
+        if not chunk:
+            break
+        counter[index] += len(chunk)
+        target.write(chunk)
+        target.flush()
+    source.close()
+
+class RunReport(object):
+    """
+    Timing, CPU, exit code and output size of every phase of a
+    tfbuild run. Written as JSON to the TFBUILD_REPORT path (or the
+    --report=<path> option), and summarized on a single stderr line.
+    """
+    def __init__(self, action, target_environment=None, path=None):
+        self.action = action
+        self.target_environment = target_environment
+        self.path = path if path is not None else os.environ.get('TFBUILD_REPORT')
+        self.started = time.time()
+        self.clock = time.perf_counter()
+        self.phases = []
+        self.spans = []
+        self.resources = None
+        self.details = {}
+        self.exit_code = None
+
+    @property
+    def returncode(self):
+        """
+        Exit code of the run: the explicit exit code, or the first
+        failed phase exit code. Phases recorded as not fatal, such as
+        an attempt followed by a fallback, don't decide the outcome.
+        """
+        if self.exit_code:
+            return self.exit_code
+        for phase in self.phases:
+            if phase['returncode'] and phase.get('fatal', True):
+                return phase['returncode']
+        return 0
+
+    def record(self, name, wall, cpu=None, returncode=0, command=None, stdout_bytes=None, stderr_bytes=None, fatal=True):
+        self.phases.append({
+            'name': name,
+            'command': command,
+            'wall': round(wall, 4),
+            'cpu_user': round(cpu[0], 4) if cpu else None,
+            'cpu_system': round(cpu[1], 4) if cpu else None,
+            'returncode': returncode,
+            'stdout_bytes': stdout_bytes,
+            'stderr_bytes': stderr_bytes,
+            'fatal': fatal,
+        })
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Time an in-process phase, such as the context resolution.
+        """
+        start = time.perf_counter()
+        cpu_start = os.times()
+        returncode = 0
+        try:
+            yield
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else 1
+            raise
+        except BaseException:
+            returncode = 1
+            raise
+        finally:
+            cpu_end = os.times()
+            self.record(name, time.perf_counter() - start, (cpu_end[0] - cpu_start[0], cpu_end[1] - cpu_start[1]), returncode)
+
+    @contextmanager
+    def span(self, name):
+        """
+        Mark a named in-process step, ie: a context resolution step.
+        Spans are cheaper than phases and not part of the summary line.
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.spans.append({
+                'name': name,
+                'start': round(start - self.clock, 6),
+                'wall': round(time.perf_counter() - start, 6),
+            })
+
+    def run(self, command, env=None, fatal=True):
+        """
+        Run a command, recording it as a phase named after the
+        terraform sub-command. Output is passed through untouched to
+        a terminal, and counted through a pipe otherwise. The exit code
+        of a command run with fatal=False is recorded, but is not the
+        exit code of the run.
+        """
+        name = command[1] if os.path.basename(command[0]).startswith('terraform') and len(command) > 1 else os.path.basename(command[0])
+        counter = [None, None]
+        cpu_start = get_children_cpu()
+        start = time.perf_counter()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        if sys.stdout.isatty() or not hasattr(sys.stdout, 'buffer'):
+            process = subprocess.Popen(command, env=env)
+            process.communicate()
+        else:
+            counter = [0, 0]
+            process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+            threads = [
+                threading.Thread(target=tee, args=(process.stdout, sys.stdout.buffer, counter, 0)),
+                threading.Thread(target=tee, args=(process.stderr, sys.stderr.buffer, counter, 1)),
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            process.wait()
+        wall = time.perf_counter() - start
+        cpu_end = get_children_cpu()
+        cpu = (cpu_end[0] - cpu_start[0], cpu_end[1] - cpu_start[1]) if cpu_start else None
+        self.record(name, wall, cpu, process.returncode, command[:2], counter[0], counter[1], fatal)
+        return process.returncode
+
+    def to_dict(self):
+        return {
+            'action': self.action,
+            'target_environment': self.target_environment,
+            'started': self.started,
+            'wall': round(time.time() - self.started, 4),
+            'returncode': self.returncode,
+            'phases': self.phases,
+            'spans': self.spans,
+            'resources': self.resources,
+            'details': self.details,
+        }
+
+    def summary(self):
+        parts = ["{} {:.2f}s".format(phase['name'], phase['wall']) for phase in self.phases]
+        return "{}: {} | total {:.2f}s | exit {}".format(
+            self.action,
+            " | ".join(parts),
+            time.time() - self.started,
+            self.returncode
+        )
+
+    def finish(self):
+        """
+        Write the JSON report, and the summary line when at least
+        one command ran.
+        """
+        if any(phase['command'] for phase in self.phases) or self.resources is not None:
+            sys.stderr.write(self.summary() + "\n")
+            sys.stderr.flush()
+        if self.path:
+            from .cache import write_json
+            report_dir = os.path.dirname(os.path.abspath(self.path))
+            os.makedirs(report_dir, exist_ok=True)
+            write_json(self.path, self.to_dict())
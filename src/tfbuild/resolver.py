@@ -0,0 +1,446 @@
+#!/usr/bin/python3 -u
+
+from .gitmeta import GitMetadata, GitMetadataError
+from contextlib import nullcontext
+from types import SimpleNamespace
+import os
+import sys
+
+clouds_list = ['aws', 'azr', 'vmw', 'gcp']
+global_resources = ["53", "global"]
+default_config = {
+    "bucket_prefix": "inf.tfstate",
+    "concurrency": "4",
+    "tf_cloud_org": None
+    }
+
+class ResolutionError(Exception):
+    """
+    Base class of the context resolution errors.
+    """
+
+class RepositoryError(ResolutionError):
+    """
+    The repository remote or branch does not follow the naming
+    conventions, or can't be read.
+    """
+
+class EnvironmentFileError(ResolutionError):
+    """
+    A required environment file is missing, or the resource path is
+    not a resource directory.
+    """
+
+class ConfigurationError(ResolutionError):
+    """
+    The deployment attributes of the environment files are invalid.
+    """
+
+class Context(object):
+    """
+    Immutable deployment context of a resource, branch and target
+    environment: naming convention variables, environment files,
+    deployment attributes, site and backend configuration.
+    """
+    __slots__ = (
+        'location', 'target_environment', 'platform', 'repo_root', 'repo_url',
+        'repo_name', 'branch_name', 'repo_name_parts', 'repo_prefix', 'cloud',
+        'project', 'account', 'environment', 'bucket_prefix', 'concurrency',
+        'tf_cloud_org1', 'secret_path', 'resource', 'common_shell_file',
+        'common_env_file', 'local_env_file', 'china_deployment', 'dr',
+        'global_resource', 'target_environment_type', 'mode', 'region', 'backend',
+        'tf_cloud_backend', 'tf_cloud_org2', 'tf_cli_args', 'var_file_args_list',
+        'var_file_args', 'site', 'prefix', 'module', 'backend_type', 'backend_region',
+        'tf_cloud_backend_org', 'bucket', 'bucket_key', 'warnings'
+        )
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            value = values.get(name)
+            object.__setattr__(self, name, tuple(value) if isinstance(value, list) else value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Context is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("Context is immutable")
+
+    def __repr__(self):
+        return "Context(resource={!r}, branch_name={!r}, target_environment={!r})".format(self.resource, self.branch_name, self.target_environment)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def get_environment(self, base=None):
+        return get_terraform_environment(self, base)
+
+def get_terraform_environment(context, base=None):
+    """
+    Return the environment variables exported to Terraform for a
+    context, over the base environment.
+    """
+    return dict(base or {},
+        **{"TF_VAR_deployment_region": context.region},
+        **{"TF_VAR_backend_region": context.backend_region},
+        **{"TF_VAR_project": context.project},
+        **{"TF_VAR_account": context.account},
+        **{"TF_VAR_mode": context.mode},
+        **{"TF_VAR_env": context.environment},
+        **{"TF_VAR_site": context.site},
+        **{"TF_VAR_azrsa": context.bucket},
+        **{"TF_VAR_bucket": context.bucket},
+        **{"TF_VAR_prefix": context.prefix},
+        **{"TF_VAR_china_deployment": context.china_deployment},
+        **{"TF_CLI_ARGS": context.tf_cli_args},
+        **{"AWS_REGION": context.region},
+        **{"AZR_REGION": context.region},
+        **{"REPO_PATH": context.repo_root},
+        **{"REPO_PREFIX": context.repo_prefix},
+        )
+
+class Resolver(object):
+    """
+    Resolve the deployment contexts of the resources of a repository
+    branch, with no output, no exit and no dependency on the process
+    arguments or working directory. The repository context is resolved
+    once, and the environment files are parsed once per resolver, so
+    resolving many resources and target environments stays cheap.
+
+    config holds the global config variables (bucket_prefix,
+    concurrency, tf_cloud_org). The remote URL is read from the
+    repository when not given. Parsed HCL files are also shared
+    through the on-disk parse cache when hcl_cache_dir is given.
+    """
+    def __init__(self, repo_root, branch, config=None, repo_url=None, hcl_cache_dir=None):
+        self.hcl_cache_dir = hcl_cache_dir
+        self.hcl_files = {}
+        config = dict(default_config, **(config or {}))
+        self.config = config
+        if repo_url is None:
+            try:
+                repo_url = GitMetadata(repo_root).get_remote_url()
+            except GitMetadataError as e:
+                raise RepositoryError(str(e))
+        if repo_url is None:
+            raise RepositoryError(str(os.path.splitext(os.path.basename(repo_root))[0]).upper() + " is a local repository with no remotes. !")
+        if branch is None:
+            raise RepositoryError("The repository HEAD is detached !\n  Please check out the environment branch !")
+
+        repository = SimpleNamespace(
+            platform="windows" if sys.platform.startswith("win") else "linux",
+            repo_root=repo_root,
+            repo_url=repo_url,
+            repo_name=str(os.path.splitext(os.path.basename(repo_url))[0]).lower(),
+            branch_name=branch.lower(),
+            bucket_prefix=config["bucket_prefix"],
+            concurrency=config["concurrency"],
+            tf_cloud_org1=config["tf_cloud_org"],
+            secret_path=None
+            )
+        self.get_default_variables(repository)
+        repository.secret_path = os.path.join("{}".format(repo_root), "secret_{}_backend.tfvars".format(repository.cloud))
+        self.repository = vars(repository)
+
+    def get_default_variables(self, context):
+        """
+        Get Repository Prefix, Cloud Dependent Project, Account, Environment variables.
+        """
+        context.repo_name_parts = context.repo_name.split("-")
+
+        if len(context.repo_name_parts) > 2:
+            context.repo_prefix = "-".join(context.repo_name_parts[:-2])
+        else:
+            context.repo_prefix = ""
+
+        if len(context.repo_name_parts) <= 1:
+            raise RepositoryError(
+                "Error: Invalid repository name structure.\n"
+                "The repository name structure needs to be:\n"
+                "  [Repository Prefix]-[Hosting Platform]-[Project name]\n"
+                "  Note: Project Prefix is optional.\n"
+                "  Example:\n"
+                "    - myrepo-aws-myproject\n"
+                "    - aws-myproject\n"
+                "Default supported Hosting Platform values are:\n  " + ", ".join(clouds_list)
+            )
+        context.cloud = context.repo_name_parts[-2]
+
+        if context.cloud in clouds_list:
+            context.project = context.repo_name_parts[-1]
+            context.account = context.branch_name.split("-")[0]
+            if len(context.branch_name.split("-")) == 2:
+                context.environment = context.branch_name.split("-")[1]
+            else:
+                raise RepositoryError("Error: Invalid repository branch name structure.\n"
+                                      "  For Cloud Hosting Platforms, he branch name structure needs to be:\n"
+                                      "  [Account Number]-[Environment Name]\n"
+                                      "  Example:\n    - 31234565435-uat")
+        else:
+            context.project = context.repo_name.split("-")[-1]
+            if len(context.branch_name.split("-")) == 2:
+                context.account = context.branch_name.split("-")[0]
+                context.environment = context.branch_name.split("-")[1]
+            else:
+                context.account = 'none'
+                context.environment = context.branch_name
+
+    def resolve(self, resource_path, target_environment=None, span=None):
+        """
+        Resolve the context of a resource directory, absolute or
+        relative to the repository root, and optional target
+        environment (site). Raises a ResolutionError subclass when the
+        resource can't be deployed. span is an optional callable
+        returning a context manager for each named resolution step,
+        ie: the run report spans.
+        """
+        span = span or (lambda name: nullcontext())
+        context = SimpleNamespace(**self.repository)
+        context.location = os.path.join(self.repo_root, resource_path)
+        context.target_environment = target_environment
+        context.resource = os.path.relpath(context.location, self.repo_root).replace('\\', '/')
+        context.warnings = []
+        with span('get_env_files'):
+            self.get_env_files(context)
+        with span('get_deployment_attributes'):
+            self.get_deployment_attributes(context)
+        with span('sanity_check'):
+            self.sanity_check(context)
+        with span('set_site_configuration'):
+            self.set_site_configuration(context)
+        with span('set_backend_configuration'):
+            self.set_backend_configuration(context, context.backend.lower())
+        return Context(**vars(context))
+
+    @property
+    def repo_root(self):
+        return self.repository["repo_root"]
+
+    def get_env_files(self, context):
+        """
+        Return Appropriate Env File Based on whether there is
+        a target deployment defined in the init attributes.
+        """
+        if context.target_environment:
+            file_preffix = "{}_{}".format(context.environment, context.target_environment)
+        else:
+            file_preffix = "{}".format(context.environment)
+
+        context.common_shell_file = os.path.join(
+            self.repo_root, "common", "environments","env_{}.hcl".format(file_preffix))
+        context.common_env_file = os.path.join(
+            self.repo_root, "common", "environments","env_{}_common.tfvars".format(file_preffix))
+        context.local_env_file = os.path.join(
+            context.location, "environments", "env_{}.tfvars".format(file_preffix))
+
+    def isfile(self, path):
+        return os.path.isfile(path)
+
+    def isdir(self, path):
+        return os.path.isdir(path)
+
+    def listdir(self, path):
+        return os.listdir(path)
+
+    def load_hcl(self, path):
+        """
+        Parse an HCL file once per resolver, through the on-disk parse
+        cache when there is one.
+        """
+        if path not in self.hcl_files:
+            if self.hcl_cache_dir:
+                from .cache import load_hcl
+                self.hcl_files[path] = load_hcl(path, self.hcl_cache_dir)
+            else:
+                import hcl
+                with open(path, 'r') as fp:
+                    self.hcl_files[path] = hcl.load(fp)
+        return self.hcl_files[path]
+
+    def get_deployment_attributes(self, context):
+        """
+        Extract deployment attributes from shell env file.
+        This is done to maintain backward compatibility with
+        current deployments, but should be migrated to a declarative
+        language in the future, ie: json,yaml.
+        """
+        if not self.isfile(context.common_shell_file):
+            raise EnvironmentFileError("No Common Wrapper Shell File available ! Please create:\n  " + context.common_shell_file + "\n  and add configuration content if necessary !")
+
+        try:
+            obj = self.load_hcl(context.common_shell_file)
+            context.china_deployment = obj.get('china_deployment', '').lower()
+            context.dr = obj.get('dr', '').lower()
+            context.global_resource = obj.get('global_resource', '').lower()
+            context.target_environment_type = obj.get('target_environment_type', 'region').lower()
+            context.mode = obj.get('mode', '').lower()
+            context.region = obj.get('region', '').lower()
+            context.backend = obj.get('backend', '').lower()
+            context.tf_cloud_backend = obj.get('tf_cloud_backend', 'simple').lower()
+            context.tf_cloud_org2 = obj.get('tf_cloud_org', '').lower()
+            if context.platform == "windows":
+                context.tf_cli_args = obj.get('tf_cli_args', '').replace('"','').replace('${REPO_PATH}',self.repo_root).replace('$REPO_PATH',self.repo_root).replace('\\', '\\\\').replace('/', '\\\\')
+            else:
+                context.tf_cli_args = obj.get('tf_cli_args', '').replace('"','').replace('${REPO_PATH}',self.repo_root).replace('$REPO_PATH',self.repo_root)
+        except KeyError:
+            raise EnvironmentFileError("Missing Common Shell Env File: \n          {}".format(context.common_shell_file))
+        except (AttributeError, ValueError) as e:
+            raise ConfigurationError("Invalid Common Shell Env File: \n          {}\n  {}".format(context.common_shell_file, e))
+
+    def sanity_check(self, context):
+        """
+        Series of sanity Checks performed to ensure what we
+        are working with.
+        """
+        context.var_file_args_list = []
+
+        if self.isfile(context.secret_path):
+            context.var_file_args_list.append(context.secret_path)
+
+        if os.path.realpath(context.location) == os.path.realpath(self.repo_root):
+            raise EnvironmentFileError("The resource directory is the repository root !\n          Please ensure execution from a resurce directory !")
+
+        if not self.isfile(context.local_env_file):
+            if not self.isdir(context.location) or not any(File.endswith(".tf") for File in self.listdir(context.location)):
+                raise EnvironmentFileError("No Local Environment Files at this location !\n  " + context.location + " is not a resource directory,\n          Please ensure execution from a resurce directory !")
+            raise EnvironmentFileError("No Local Environment Files at this location !\n\n  Please create:\n          " + context.local_env_file + "\n          and add configuration content if necessary !")
+        context.var_file_args_list.append(context.local_env_file)
+
+        if not self.isfile(context.common_env_file):
+            context.warnings.append("No Common Environment File available ! Please create:\n            " + context.common_env_file + "\n            and add configuration content if necessary !")
+        else:
+            context.var_file_args_list.append(context.common_env_file)
+
+        if not context.region:
+            if context.cloud in ['aws', 'azr']:
+                raise ConfigurationError("Specify 'region' in the file: \n          " + context.common_shell_file)
+
+        if context.target_environment_type not in ["region", "site"]:
+            raise ConfigurationError("Specify a valid Target Environment Type (region/site) in the file: \n  " + context.common_shell_file)
+
+        arg_prefix = '-var-file='
+        context.var_file_args = [arg_prefix + item for item in context.var_file_args_list]
+
+    def set_site_configuration(self, context):
+        """
+        Parse Data returned by get_deployment_attributes and
+        return prefix and module for blue/green, site or
+        the default region based deployment.
+        """
+        if context.target_environment and context.target_environment_type != 'region':
+            context.site = context.target_environment
+            if context.mode != '':
+                context.prefix = "{}-{}-{}".format(context.project, context.target_environment, context.mode)
+                context.module = "{}-{}".format(context.resource, context.mode)
+            else:
+                context.prefix = "{}-{}".format(context.project, context.target_environment)
+                context.module = context.resource
+        else:
+            context.site = ''
+            if context.mode != '':
+                context.prefix = "{}-{}".format(context.project, context.mode)
+                context.module = "{}-{}".format(context.resource, context.mode)
+            else:
+                context.prefix = context.project
+                context.module = context.resource
+
+    def set_backend_configuration(self, context, backend_type=None):
+        """
+        Parse Data returned by get_deployment_attributes and
+        return bucket, backend_region for deployment.
+        """
+        context.backend_type = backend_type or context.cloud
+        context.backend_region = None
+        context.tf_cloud_backend_org = None
+        is_global = context.global_resource == "true" or any(word in context.resource for word in global_resources)
+
+        if context.backend_type == "aws":
+            if is_global:
+                context.bucket_key = "{prefix}/{module}/terraform.tfstate".format(
+                    prefix=context.prefix,
+                    module=context.module
+                )
+            else:
+                context.bucket_key = "{prefix}/{region}/{module}/terraform.tfstate".format(
+                    prefix=context.prefix,
+                    region=context.region,
+                    module=context.module
+                )
+
+            if context.dr == "true":
+                context.bucket = "{}.{}.{}.dr".format(context.bucket_prefix, context.account, context.environment)
+                if context.china_deployment == "true":
+                    context.backend_region = "cn-northwest-1"
+                else:
+                    context.backend_region = "us-west-2"
+            else:
+                context.bucket = "{}.{}.{}".format(context.bucket_prefix, context.account, context.environment)
+                if context.china_deployment == "true":
+                    context.backend_region = "cn-north-1"
+                else:
+                    context.backend_region = "us-east-1"
+        elif context.backend_type == "azr":
+            if is_global:
+                context.bucket_key = "{env}/{prefix}/{module}/terraform.tfstate".format(
+                    env=context.environment,
+                    prefix=context.prefix,
+                    module=context.module
+                )
+            else:
+                context.bucket_key = "{env}/{prefix}/{region}/{module}/terraform.tfstate".format(
+                    env=context.environment,
+                    prefix=context.prefix,
+                    region=context.region,
+                    module=context.module
+                )
+
+            context.bucket_prefix = ''.join(char.lower() for char in context.bucket_prefix if char.isalnum())
+            if context.dr == "true":
+                context.bucket = "{}{}{}dr".format(context.bucket_prefix, context.account, context.environment)
+            else:
+                context.bucket = "{}{}{}".format(context.bucket_prefix, context.account, context.environment)
+
+            if len(context.bucket) > 24:
+                raise ConfigurationError("Storage Account Name exceeds 24 characters.\n  Storage Account: " + context.bucket + "\n  Please provide a shorter name.")
+
+        elif context.backend_type == "tfc" or context.tf_cloud_backend == "true":
+            if context.tf_cloud_backend == "simple":
+                context.bucket_key = "{env}-{prefix}-{module}".format(
+                    env=context.environment,
+                    prefix=context.prefix.replace("/","-"),
+                    module=context.module.replace("/","-")
+                )
+            elif context.tf_cloud_backend == "extended":
+                if is_global:
+                    context.bucket_key = "{cloud}-{env}-{prefix}-{module}".format(
+                        cloud=context.cloud,
+                        env=context.environment,
+                        prefix=context.prefix.replace("/","-"),
+                        module=context.module.replace("/","-")
+                    )
+                else:
+                    context.bucket_key = "{cloud}-{env}-{prefix}-{region}-{module}".format(
+                        cloud=context.cloud,
+                        env=context.environment,
+                        prefix=context.prefix.replace("/","-"),
+                        region=context.region.replace("-",""),
+                        module=context.module.replace("/","-")
+                    )
+            else:
+                raise ConfigurationError("Invalid tf_cloud_backend value.\n  Please provide a valid value: simple/extended")
+            if context.tf_cloud_org1:
+                context.tf_cloud_backend_org = context.tf_cloud_org1
+            else:
+                context.tf_cloud_backend_org = context.tf_cloud_org2
+            context.backend_region = "none"
+            context.bucket = "none"
+        else:
+            context.bucket_key = "none"
+            context.backend_region = "none"
+            context.bucket = "none"
+
+def resolve(repo_root, resource_path, branch, target_environment=None, config=None):
+    """
+    Resolve the deployment context of a resource of a repository
+    branch. Use a Resolver to resolve many resources of a branch.
+    """
+    return Resolver(repo_root, branch, config).resolve(resource_path, target_environment)
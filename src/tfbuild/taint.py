@@ -0,0 +1,70 @@
+#!/usr/bin/python3 -u
+
+from .jsonstream import JSONStream
+import re
+import subprocess
+
+module_re = re.compile(r'^((?:module\.[^.\[]+(?:\[(?:"(?:[^"\\]|\\.)*"|\d+)\])?\.)*)')
+
+def is_resource_path(path):
+    """
+    Match the resources of the root module and of any nested child
+    module in the 'terraform show -json' output.
+    """
+    return len(path) > 3 and path[0] == 'values' and path[1] == 'root_module' and path[-2:] == ('resources', 'item')
+
+def compile_pattern(pattern, regex=False):
+    """
+    Compile an address selection pattern. Glob patterns only expand
+    '*' and '?', so the '[...]' of indexed addresses match literally.
+    """
+    if regex:
+        return re.compile(pattern)
+    return re.compile(re.escape(pattern).replace(r'\*', '.*').replace(r'\?', '.') + '$')
+
+class StateIndex(object):
+    """
+    Index of the managed resource addresses of a Terraform state,
+    stream-parsed from 'terraform show -json'.
+    """
+    def __init__(self, env=None, cwd=None):
+        self.env = env
+        self.cwd = cwd
+        self.resources = []
+        self.returncode = None
+
+    def load(self, show_args=None):
+        process = subprocess.Popen(
+            ['terraform', 'show', '-json'] + (show_args or []),
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            env=self.env,
+            cwd=self.cwd
+            )
+        try:
+            for path, resource in JSONStream(process.stdout).items(is_resource_path):
+                if resource.get('mode', 'managed') == 'managed':
+                    self.resources.append({
+                        'address': resource['address'],
+                        'module': module_re.match(resource['address']).group(1).rstrip('.'),
+                        'type': resource.get('type'),
+                        'name': resource.get('name'),
+                        'index': resource.get('index'),
+                        })
+        finally:
+            process.stdout.close()
+            self.returncode = process.wait()
+        return self.returncode
+
+    @property
+    def addresses(self):
+        return [resource['address'] for resource in self.resources]
+
+    def select(self, patterns, regex=False):
+        """
+        Return the addresses matching any of the patterns, in state order.
+        """
+        compiled = [compile_pattern(pattern, regex) for pattern in patterns]
+        if regex:
+            return [address for address in self.addresses if any(pattern.search(address) for pattern in compiled)]
+        return [address for address in self.addresses if any(pattern.match(address) for pattern in compiled)]
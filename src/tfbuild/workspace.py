@@ -1,103 +1,266 @@
-#!/usr/bin/python3 -u
-
-from py_console import console
-import hcl
-import json
-import os
-import requests
-import sys
-
-class Workspace(object):
-    def __init__(self, tf_workspace_name, platform, tf_version, org):
-        self.platform = platform
-        self.base_url = 'https://app.terraform.io'
-        self.org = org
-        self.get_org()
-        self.get_terraformrc_path()
-        self.org_url = self.base_url + '/api/v2/organizations/' + self.org
-        self.workspaces_url = self.org_url + '/workspaces'
-        self.token_environment_variable_name = "TF_TOKEN"
-        self.tfc_config_template = {
-            "credentials": {
-                "app.terraform.io": {
-                    "token": "temp_value"
-                }
-            },
-            "disable_checkpoint": "true",
-            "plugin_cache_dir": self.cache_dir
-        }
-        self.tf_headers = {
-            "Content-Type": "application/vnd.api+json",
-            "Authorization": "Bearer {}".format(self.get_token()),
-        }
-        self.create_workspace(tf_workspace_name, tf_version)
-
-    def get_org(self):
-        if not self.org:
-            console.error("  Please add 'tf_cloud_org' to the local config file !\n", showTime=False)
-            sys.exit(2)
-
-    def get_terraformrc_path(self):
-        if self.platform == 'windows':
-            self.config_file = os.path.join(os.path.expanduser("~"), "AppData", "Roaming", "terraform.rc")
-            self.cache_dir = os.path.join(os.path.expanduser("~"), "AppData", "Roaming", "terraform.d", "plugin-cache")
-        else:
-            self.config_file = os.path.join(os.path.expanduser("~"), ".terraformrc")
-            self.cache_dir = os.path.join(os.path.expanduser("~"), "terraform.d", "plugin-cache")
-
-    def get_token(self):
-        if os.environ.get(self.token_environment_variable_name) is not None:
-            token = os.environ[self.token_environment_variable_name]
-            if (os.path.exists(self.config_file)) and (os.stat(self.config_file).st_size != 0):
-                with open(self.config_file, 'r') as cf:
-                    cf_obj = json.load(cf)
-                    cf_obj['credentials']['app.terraform.io']['token'] = token
-                with open(self.config_file, 'w') as cf:
-                    json.dump(cf_obj, cf, indent = 4, sort_keys=True)
-            else:
-                console.warn("\n  Config file: " + self.config_file + " is being configured from env variable !", showTime=False)
-                with open(self.config_file, 'w') as cf:
-                    json_cf = json.loads(json.dumps(self.tfc_config_template))
-                    json_cf['credentials']['app.terraform.io']['token'] = token
-                    json.dump(json_cf, cf, indent = 4, sort_keys=True)
-        elif os.path.exists(self.config_file):
-            if os.stat(self.config_file).st_size == 0:
-                console.error("  The TFC config file: " + self.config_file + " is empty !", showTime=False)
-                sys.exit(2)
-            else:
-                with open(self.config_file, 'r') as fp:
-                    obj = hcl.load(fp)
-                    token = obj['credentials']['app.terraform.io']['token']
-        else:
-            console.error("  Please configure the 'TF_TOKEN' env variable or \n  the '" + self.config_file + "' file \n  to contain the deployment token !\n", showTime=False)
-            sys.exit(2)
-        return token
-
-    def get_workspaces(self):
-        workspace_list = []
-        read_workspaces = requests.get(self.workspaces_url, headers = self.tf_headers)
-        r_json = read_workspaces.json()
-        if read_workspaces.ok:
-            for item in r_json['data']:
-                workspace_name = item['attributes']['name']
-                workspace_list.append(workspace_name)
-        else:
-            console.error("\n  Your 'tf_cloud_org' variable or your credentials are invalid !", showTime=False)
-            console.error("  - Error Code: " + str(read_workspaces.status_code) + "\n  - Error Message: " + r_json['errors'][0]['title'], showTime=False)
-            sys.exit(2)
-        return workspace_list
-
-    def create_workspace(self, name, tf_version):
-        workspace_data = dict(
-            attributes={
-                'name':name,
-                'terraform-version':tf_version,
-                'execution-mode':'local'
-            }
-        )
-        workspace_data = dict(
-            data=workspace_data
-        )
-        
-        if name not in self.get_workspaces():
-            requests.post(self.workspaces_url, headers=self.tf_headers, data=json.dumps(workspace_data))
+#!/usr/bin/python3 -u
+
+from .cache import get_user_cache_dir, write_json
+from py_console import console
+from requests.adapters import HTTPAdapter
+from urllib.parse import quote, urlparse
+import hashlib
+import hcl
+import json
+import os
+import requests
+import sys
+import time
+
+session = None
+
+def get_session():
+    """
+    Return the process wide HTTP session, so every TFC call reuses
+    the same keep-alive connection pool.
+    """
+    global session
+    if session is None:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+    return session
+
+class Workspace(object):
+    def __init__(self, tf_workspace_name, platform, tf_version, org):
+        self.platform = platform
+        self.base_url = os.environ.get('TFBUILD_TFC_URL', 'https://app.terraform.io').rstrip('/')
+        self.hostname = urlparse(self.base_url).netloc
+        self.org = org
+        self.get_org()
+        self.get_terraformrc_path()
+        self.org_url = self.base_url + '/api/v2/organizations/' + quote(self.org, safe='')
+        self.workspaces_url = self.org_url + '/workspaces'
+        self.token_environment_variable_name = "TF_TOKEN"
+        self.cache_ttl = int(os.environ.get('TFBUILD_TFC_CACHE_TTL', '300'))
+        self.cache_file = os.path.join(
+            get_user_cache_dir("tfc"),
+            hashlib.sha1("{}\0{}".format(self.base_url, self.org).encode()).hexdigest() + ".json"
+            )
+        self.session = get_session()
+        self.tfc_config_template = {
+            "credentials": {
+                self.hostname: {
+                    "token": "temp_value"
+                }
+            },
+            "disable_checkpoint": "true",
+            "plugin_cache_dir": self.cache_dir
+        }
+        self.tf_headers = {
+            "Content-Type": "application/vnd.api+json",
+            "Authorization": "Bearer {}".format(self.get_token()),
+        }
+        if tf_workspace_name:
+            self.create_workspace(tf_workspace_name, tf_version)
+
+    def get_org(self):
+        if not self.org:
+            console.error("  Please add 'tf_cloud_org' to the local config file !\n", showTime=False)
+            sys.exit(2)
+
+    def get_terraformrc_path(self):
+        if self.platform == 'windows':
+            self.config_file = os.path.join(os.path.expanduser("~"), "AppData", "Roaming", "terraform.rc")
+            self.cache_dir = os.path.join(os.path.expanduser("~"), "AppData", "Roaming", "terraform.d", "plugin-cache")
+        else:
+            self.config_file = os.path.join(os.path.expanduser("~"), ".terraformrc")
+            self.cache_dir = os.path.join(os.path.expanduser("~"), "terraform.d", "plugin-cache")
+
+    def get_token(self):
+        if os.environ.get(self.token_environment_variable_name) is not None:
+            token = os.environ[self.token_environment_variable_name]
+            if (os.path.exists(self.config_file)) and (os.stat(self.config_file).st_size != 0):
+                with open(self.config_file, 'r') as cf:
+                    cf_obj = json.load(cf)
+                    cf_obj.setdefault('credentials', {}).setdefault(self.hostname, {})['token'] = token
+                with open(self.config_file, 'w') as cf:
+                    json.dump(cf_obj, cf, indent = 4, sort_keys=True)
+            else:
+                console.warn("\n  Config file: " + self.config_file + " is being configured from env variable !", showTime=False)
+                with open(self.config_file, 'w') as cf:
+                    json_cf = json.loads(json.dumps(self.tfc_config_template))
+                    json_cf['credentials'][self.hostname]['token'] = token
+                    json.dump(json_cf, cf, indent = 4, sort_keys=True)
+        elif os.path.exists(self.config_file):
+            if os.stat(self.config_file).st_size == 0:
+                console.error("  The TFC config file: " + self.config_file + " is empty !", showTime=False)
+                sys.exit(2)
+            else:
+                with open(self.config_file, 'r') as fp:
+                    obj = hcl.load(fp)
+                    token = obj['credentials'][self.hostname]['token']
+        else:
+            console.error("  Please configure the 'TF_TOKEN' env variable or \n  the '" + self.config_file + "' file \n  to contain the deployment token !\n", showTime=False)
+            sys.exit(2)
+        return token
+
+    def api_error(self, response):
+        try:
+            message = response.json()['errors'][0]['title']
+        except (ValueError, KeyError, IndexError, TypeError):
+            message = response.reason
+        console.error("\n  Your 'tf_cloud_org' variable or your credentials are invalid !", showTime=False)
+        console.error("  - Error Code: " + str(response.status_code) + "\n  - Error Message: " + str(message), showTime=False)
+        sys.exit(2)
+
+    def load_cache(self):
+        """
+        Return the locally cached workspace names, if fresher than
+        the cache TTL.
+        """
+        try:
+            with open(self.cache_file, 'r') as fp:
+                cache = json.load(fp)
+            if time.time() - cache['updated'] < self.cache_ttl:
+                return set(cache['workspaces'])
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return set()
+
+    def save_cache(self, workspaces, replace=False):
+        if not replace:
+            workspaces = self.load_cache() | set(workspaces)
+        try:
+            write_json(self.cache_file, {'updated': time.time(), 'workspaces': sorted(workspaces)})
+        except OSError:
+            pass
+
+    def get_workspace(self, name):
+        """
+        Look a workspace up by name. Returns True if it exists.
+        """
+        response = self.session.get(self.workspaces_url + '/' + quote(name, safe=''), headers=self.tf_headers)
+        if response.ok:
+            return True
+        if response.status_code == 404:
+            return False
+        self.api_error(response)
+
+    def get_workspaces(self):
+        """
+        List all workspace names of the organization, following
+        the API pagination.
+        """
+        workspace_list = []
+        url = self.workspaces_url
+        params = {'page[size]': 100, 'page[number]': 1}
+        while url:
+            read_workspaces = self.session.get(url, headers=self.tf_headers, params=params)
+            if not read_workspaces.ok:
+                self.api_error(read_workspaces)
+            r_json = read_workspaces.json()
+            for item in r_json['data']:
+                workspace_list.append(item['attributes']['name'])
+            url = (r_json.get('links') or {}).get('next')
+            params = None
+        self.save_cache(workspace_list, replace=True)
+        return workspace_list
+
+    def get_workspace_data(self, name, tf_version):
+        workspace_data = dict(
+            attributes={
+                'name':name,
+                'terraform-version':tf_version() if callable(tf_version) else tf_version,
+                'execution-mode':'local'
+            }
+        )
+        return dict(
+            data=workspace_data
+        )
+
+    def create_workspace(self, name, tf_version):
+        """
+        Create the workspace unless it is known locally, or found
+        through a lookup by name.
+        """
+        if name in self.load_cache():
+            return
+        if self.get_workspace(name):
+            self.save_cache([name])
+            return
+
+        console.success("  Creating Terraform Cloud workspace " + name, showTime=False)
+        response = self.session.post(self.workspaces_url, headers=self.tf_headers, data=json.dumps(self.get_workspace_data(name, tf_version)))
+        if response.ok or response.status_code == 422 and self.get_workspace(name):
+            self.save_cache([name])
+        else:
+            self.api_error(response)
+
+class WorkspaceProvisioner(object):
+    """
+    Create many workspaces of an organization concurrently. Requests
+    run on the shared session from a bounded asyncio pool, and are
+    retried with backoff on rate limiting (429, honoring Retry-After)
+    and server errors.
+    """
+    def __init__(self, workspace, concurrency, retries=6):
+        self.workspace = workspace
+        self.concurrency = max(1, int(concurrency))
+        self.retries = retries
+
+    def provision(self, names, tf_version):
+        """
+        Ensure every workspace name exists. Returns a dict of
+        name -> 'exists', 'created' or 'failed: <reason>'.
+        """
+        import asyncio
+        existing = set(self.workspace.get_workspaces())
+        results = {name: 'exists' for name in names if name in existing}
+        missing = sorted(set(names) - existing)
+        if missing:
+            results.update(asyncio.run(self.create_all(missing, tf_version() if callable(tf_version) else tf_version)))
+        self.workspace.save_cache([name for name, status in results.items() if status in ('exists', 'created')])
+        return results
+
+    async def create_all(self, names, tf_version):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        semaphore = asyncio.Semaphore(self.concurrency)
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            statuses = await asyncio.gather(*[self.create(name, tf_version, semaphore, executor) for name in names])
+        return dict(zip(names, statuses))
+
+    async def create(self, name, tf_version, semaphore, executor):
+        import asyncio
+        loop = asyncio.get_running_loop()
+        data = json.dumps(self.workspace.get_workspace_data(name, tf_version))
+        delay = 1.0
+        async with semaphore:
+            for attempt in range(self.retries + 1):
+                try:
+                    response = await loop.run_in_executor(
+                        executor,
+                        lambda: self.workspace.session.post(self.workspace.workspaces_url, headers=self.workspace.tf_headers, data=data, timeout=60)
+                        )
+                except requests.RequestException as e:
+                    if attempt == self.retries:
+                        return 'failed: ' + str(e)
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 30)
+                    continue
+                if response.ok:
+                    return 'created'
+                if response.status_code == 422:
+                    # Also returned for an invalid name or version: the
+                    # workspace only exists if a lookup finds it.
+                    try:
+                        exists = await loop.run_in_executor(executor, self.workspace.get_workspace, name)
+                    except (requests.RequestException, SystemExit):
+                        exists = False
+                    return 'exists' if exists else 'failed: 422 ' + response.reason
+                if response.status_code != 429 and response.status_code < 500 or attempt == self.retries:
+                    return 'failed: ' + str(response.status_code) + ' ' + response.reason
+                retry_after = response.headers.get('Retry-After')
+                try:
+                    wait = float(retry_after) if retry_after else delay
+                except ValueError:
+                    wait = delay
+                await asyncio.sleep(wait)
+                delay = min(delay * 2, 30)
@@ -0,0 +1,46 @@
+import json
+import os
+import pytest
+import stat
+
+from tfbuild.modules import ModuleCache
+
+MODULE_CALL = 'module "vpc" {\n  source  = "terraform-aws-modules/vpc/aws"\n  version = "~> 3.0"\n}\n'
+
+def make_resource(path, installed=False):
+    path.mkdir(parents=True)
+    (path / "main.tf").write_text(MODULE_CALL)
+    data_dir = path / ".terraform"
+    if installed:
+        # As left by terraform init
+        (data_dir / "modules" / "vpc").mkdir(parents=True)
+        (data_dir / "modules" / "vpc" / "main.tf").write_text('variable "name" {}\n')
+        (data_dir / "modules" / "modules.json").write_text(json.dumps({"Modules": [
+            {"Key": "", "Source": "", "Dir": "."},
+            {"Key": "vpc", "Source": "registry.terraform.io/terraform-aws-modules/vpc/aws", "Version": "3.0.0", "Dir": ".terraform/modules/vpc"},
+            ]}))
+    return str(path), str(data_dir)
+
+@pytest.fixture
+def cache(tmp_path, monkeypatch):
+    monkeypatch.delenv('TFBUILD_MODULE_CACHE_TTL', raising=False)
+    cache = ModuleCache(str(tmp_path / "cache"))
+    assert cache.save(*make_resource(tmp_path / "first", installed=True)) == 1
+    return cache
+
+def test_linked_module_shares_no_file(cache, tmp_path):
+    location, data_dir = make_resource(tmp_path / "second")
+    assert cache.link(location, data_dir) == (["vpc"], [])
+    target = os.path.join(data_dir, "modules", "vpc")
+    assert os.path.islink(target)
+    assert not os.stat(os.path.join(target, "main.tf")).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    assert os.stat(os.path.join(target, "main.tf")).st_ino != os.stat(str(tmp_path / "first" / ".terraform" / "modules" / "vpc" / "main.tf")).st_ino
+
+def test_version_range_resolved_again(cache, tmp_path, monkeypatch):
+    monkeypatch.setenv('TFBUILD_MODULE_CACHE_TTL', '-1')
+    location, data_dir = make_resource(tmp_path / "second")
+    assert ModuleCache(cache.cache_dir).link(location, data_dir) == ([], ["vpc"])
+
+def test_refresh_replaces_read_only_package(cache, tmp_path):
+    location, data_dir = make_resource(tmp_path / "first2", installed=True)
+    assert cache.save(location, data_dir, refresh=True) == 1
@@ -0,0 +1,82 @@
+import hcl
+import json
+import os
+import pytest
+import stat
+
+from tfbuild.providers import get_mirror_environment
+
+@pytest.fixture
+def rc_file(tmp_path, monkeypatch):
+    monkeypatch.setenv('TFBUILD_CACHE_DIR', str(tmp_path / "cache"))
+    return tmp_path / "terraformrc"
+
+def load_generated(environment):
+    with open(environment["TF_CLI_CONFIG_FILE"]) as fp:
+        return hcl.load(fp)
+
+def test_json_rc_file(rc_file, tmp_path):
+    # As written by Workspace.get_token
+    rc_file.write_text(json.dumps({
+        "credentials": {"app.terraform.io": {"token": "secret"}},
+        "disable_checkpoint": "true",
+        "plugin_cache_dir": "/plugins",
+        }, indent=4, sort_keys=True))
+    environment = get_mirror_environment({"TF_CLI_CONFIG_FILE": str(rc_file)}, str(tmp_path / "mirror"))
+    config = load_generated(environment)
+    assert config["credentials"]["app.terraform.io"]["token"] == "secret"
+    assert config["plugin_cache_dir"] == "/plugins"
+    assert config["provider_installation"]["filesystem_mirror"]["path"] == str(tmp_path / "mirror")
+    assert stat.S_IMODE(os.stat(environment["TF_CLI_CONFIG_FILE"]).st_mode) == 0o600
+
+def test_hcl_rc_file(rc_file, tmp_path):
+    rc_file.write_text(
+        'credentials "app.terraform.io" {\n  token = "secret"\n}\n'
+        'host "example.com" {\n  services = {\n    "tfe.v2" = "https://example.com/api/v2/"\n  }\n}\n'
+        'disable_checkpoint = true\n'
+        )
+    environment = get_mirror_environment({"TF_CLI_CONFIG_FILE": str(rc_file)}, str(tmp_path / "mirror"))
+    config = load_generated(environment)
+    assert config["credentials"]["app.terraform.io"]["token"] == "secret"
+    assert config["host"]["example.com"]["services"] == {"tfe.v2": "https://example.com/api/v2/"}
+    assert config["disable_checkpoint"] is True
+    assert "filesystem_mirror" in config["provider_installation"]
+
+def test_missing_rc_file(rc_file, tmp_path):
+    environment = get_mirror_environment({"TF_CLI_CONFIG_FILE": str(rc_file)}, str(tmp_path / "mirror"))
+    assert list(load_generated(environment)) == ["provider_installation"]
+
+def test_own_provider_installation(rc_file, tmp_path):
+    rc_file.write_text('provider_installation {\n  direct {}\n}\n')
+    assert get_mirror_environment({"TF_CLI_CONFIG_FILE": str(rc_file)}, str(tmp_path / "mirror")) == {}
+
+def test_unparseable_rc_file(rc_file, tmp_path):
+    rc_file.write_text('{"credentials": {}}\ncredentials "x" {}\n')
+    assert get_mirror_environment({"TF_CLI_CONFIG_FILE": str(rc_file)}, str(tmp_path / "mirror")) == {}
+
+@pytest.fixture
+def mirrored_resource(rc_file, tmp_path):
+    from tfbuild.providers import ProviderMirror
+    mirror = ProviderMirror(str(tmp_path / "mirror"))
+    provider_dir = tmp_path / "mirror" / "registry.terraform.io" / "hashicorp" / "aws"
+    provider_dir.mkdir(parents=True)
+    (provider_dir / "index.json").write_text(json.dumps({"versions": {"5.30.0": {}}}))
+    with open(mirror.index_file, 'w') as fp:
+        json.dump({"registry.terraform.io/hashicorp/aws ~> 5.0 current": True}, fp)
+    resource = tmp_path / "resource"
+    resource.mkdir()
+    (resource / "main.tf").write_text(
+        'terraform {\n  required_providers {\n'
+        '    aws = { source = "hashicorp/aws", version = "~> 5.0" }\n'
+        '    null = { source = "hashicorp/null" }\n  }\n}\n'
+        )
+    return resource
+
+def test_mirrored_providers_excluded_from_direct(mirrored_resource, rc_file, tmp_path):
+    environment = get_mirror_environment({"TF_CLI_CONFIG_FILE": str(rc_file)}, str(tmp_path / "mirror"), [str(mirrored_resource)])
+    assert load_generated(environment)["provider_installation"]["direct"] == {"exclude": ["registry.terraform.io/hashicorp/aws"]}
+
+def test_locked_version_not_mirrored(mirrored_resource, rc_file, tmp_path):
+    (mirrored_resource / ".terraform.lock.hcl").write_text('provider "registry.terraform.io/hashicorp/aws" {\n  version     = "5.1.0"\n  constraints = "~> 5.0"\n}\n')
+    environment = get_mirror_environment({"TF_CLI_CONFIG_FILE": str(rc_file)}, str(tmp_path / "mirror"), [str(mirrored_resource)])
+    assert not load_generated(environment)["provider_installation"]["direct"]
@@ -0,0 +1,26 @@
+import sys
+
+from tfbuild.report import RunReport
+
+def exit_command(code):
+    return [sys.executable, '-c', 'import sys; sys.exit({})'.format(code)]
+
+def test_failed_phase_fails_the_run():
+    report = RunReport('apply', path='')
+    report.run(exit_command(1))
+    report.run(exit_command(0))
+    assert report.returncode == 1
+
+def test_fallback_after_a_failed_attempt():
+    # Stale saved plan, followed by a successful regular apply
+    report = RunReport('applynoprompt', path='')
+    assert report.run(exit_command(1), fatal=False) == 1
+    report.run(exit_command(0))
+    assert report.returncode == 0
+    assert [phase['fatal'] for phase in report.phases] == [False, True]
+
+def test_failed_fallback_fails_the_run():
+    report = RunReport('applynoprompt', path='')
+    report.run(exit_command(1), fatal=False)
+    report.run(exit_command(3))
+    assert report.returncode == 3